@@ -0,0 +1,269 @@
+"""
+方舟客户端与 HTTP 会话注册表 - 进程内复用连接池，避免每次请求重新握手
+"""
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from openai import AsyncOpenAI, OpenAI
+
+try:
+    import httpx
+except ImportError:  # 未安装 httpx 时退回 OpenAI SDK 默认的连接配置
+    httpx = None
+
+_lock = threading.Lock()
+_ark_clients = {}
+_async_ark_clients = {}
+_http_session = None
+_async_http_client = None
+_httpx_warned = False
+
+# 统计信息：注册表命中次数与连接复用情况
+_stats = {
+    'ark_client_hits': 0,
+    'ark_client_creates': 0,
+    'ark_requests': 0,
+    'ark_connections_new': 0,
+    'ark_connections_reused': 0,
+    'http_session_hits': 0,
+    'http_session_creates': 0,
+}
+_seen_streams = weakref.WeakSet()
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_pool_settings():
+    """读取连接池配置（每次读取环境变量，便于 .env 在导入后加载）"""
+    return {
+        'max_connections': _env_int('ARK_POOL_MAX_CONNECTIONS', 32),
+        'max_keepalive': _env_int('ARK_POOL_MAX_KEEPALIVE', 16),
+        'keepalive_expiry': _env_float('ARK_KEEPALIVE_EXPIRY', 60.0),
+        'http2': os.environ.get('ARK_HTTP2', 'false').lower() == 'true',
+        'timeout': _env_float('ARK_TIMEOUT', 600.0),
+        'connect_timeout': _env_float('ARK_CONNECT_TIMEOUT', 10.0),
+        'download_pool_connections': _env_int('DOWNLOAD_POOL_CONNECTIONS', 8),
+        'download_pool_maxsize': _env_int('DOWNLOAD_POOL_MAXSIZE', 32),
+    }
+
+
+def _track_ark_response(response):
+    """httpx 响应钩子：根据底层网络流判断连接是新建还是复用"""
+    stream = response.extensions.get('network_stream') if hasattr(response, 'extensions') else None
+    with _lock:
+        _stats['ark_requests'] += 1
+        if stream is None:
+            return
+        try:
+            if stream in _seen_streams:
+                _stats['ark_connections_reused'] += 1
+            else:
+                _seen_streams.add(stream)
+                _stats['ark_connections_new'] += 1
+        except TypeError:
+            # 不支持弱引用的流对象，无法统计复用
+            pass
+
+
+async def _track_ark_response_async(response):
+    _track_ark_response(response)
+
+
+def _http2_enabled(settings):
+    if not settings['http2']:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("提示：未安装 h2，ARK_HTTP2 已忽略。安装命令: pip install -r requirements.txt")
+        return False
+    return True
+
+
+def _client_options(settings):
+    return {
+        'limits': httpx.Limits(
+            max_connections=settings['max_connections'],
+            max_keepalive_connections=settings['max_keepalive'],
+            keepalive_expiry=settings['keepalive_expiry'],
+        ),
+        'timeout': httpx.Timeout(settings['timeout'], connect=settings['connect_timeout']),
+        'http2': _http2_enabled(settings),
+        'follow_redirects': True,
+    }
+
+
+def _warn_default_client():
+    """未安装 httpx 时提示一次：SDK 默认客户端不使用 ARK_POOL_* / ARK_TIMEOUT 配置，也不统计连接复用"""
+    global _httpx_warned
+    if _httpx_warned:
+        return
+    _httpx_warned = True
+    print("⚠️  未安装 httpx，方舟客户端使用 OpenAI SDK 默认的连接配置，ARK_POOL_* / ARK_TIMEOUT / ARK_HTTP2 不生效。"
+          "安装命令: pip install -r requirements.txt")
+
+
+def _build_http_client(settings):
+    """构建带连接池参数的 httpx 客户端，httpx 不可用时返回 None"""
+    if httpx is None:
+        _warn_default_client()
+        return None
+    return httpx.Client(event_hooks={'response': [_track_ark_response]}, **_client_options(settings))
+
+
+def _build_async_http_client(settings, track=True):
+    """构建异步 httpx 客户端，httpx 不可用时返回 None"""
+    if httpx is None:
+        _warn_default_client()
+        return None
+    hooks = {'response': [_track_ark_response_async]} if track else {}
+    return httpx.AsyncClient(event_hooks=hooks, **_client_options(settings))
+
+
+def get_ark_client(api_key=None, base_url=None):
+    """
+    获取共享的方舟（OpenAI 兼容）客户端
+
+    相同 api_key + base_url 在进程内只创建一次，后续调用复用其连接池。
+    """
+    api_key = api_key or os.environ.get('ARK_API_KEY')
+    base_url = base_url or os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+    key = (api_key, base_url)
+
+    with _lock:
+        client = _ark_clients.get(key)
+        if client is not None:
+            _stats['ark_client_hits'] += 1
+            return client
+
+    http_client = _build_http_client(get_pool_settings())
+    if http_client is not None:
+        new_client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    else:
+        new_client = OpenAI(api_key=api_key, base_url=base_url)
+
+    with _lock:
+        client = _ark_clients.get(key)
+        if client is not None:
+            # 其他线程已抢先创建，丢弃本次创建的客户端
+            _stats['ark_client_hits'] += 1
+            new_client.close()
+            return client
+        _ark_clients[key] = new_client
+        _stats['ark_client_creates'] += 1
+        return new_client
+
+
+def get_async_ark_client(api_key=None, base_url=None):
+    """
+    获取共享的异步方舟客户端（AsyncOpenAI）
+
+    只应在批量事件循环（batch_async）中使用，异步连接池与该事件循环绑定。
+    """
+    api_key = api_key or os.environ.get('ARK_API_KEY')
+    base_url = base_url or os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+    key = (api_key, base_url)
+
+    with _lock:
+        client = _async_ark_clients.get(key)
+        if client is not None:
+            _stats['ark_client_hits'] += 1
+            return client
+
+        http_client = _build_async_http_client(get_pool_settings())
+        if http_client is not None:
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+        else:
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url)
+        _async_ark_clients[key] = client
+        _stats['ark_client_creates'] += 1
+        return client
+
+
+def get_async_http_client():
+    """获取共享的异步图片下载客户端，httpx 不可用时返回 None"""
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            _async_http_client = _build_async_http_client(get_pool_settings(), track=False)
+        return _async_http_client
+
+
+def get_http_session():
+    """获取共享的图片下载会话（requests.Session，带 keep-alive 连接池）"""
+    global _http_session
+    with _lock:
+        if _http_session is not None:
+            _stats['http_session_hits'] += 1
+            return _http_session
+
+        settings = get_pool_settings()
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=settings['download_pool_connections'],
+            pool_maxsize=settings['download_pool_maxsize'],
+            pool_block=False,
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _http_session = session
+        _stats['http_session_creates'] += 1
+        return session
+
+
+def _download_pool_stats():
+    """汇总下载会话中 urllib3 连接池的新建连接数与请求数"""
+    result = {'download_requests': 0, 'download_connections_new': 0, 'download_connections_reused': 0}
+    session = _http_session
+    if session is None:
+        return result
+
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            result['download_requests'] += getattr(pool, 'num_requests', 0)
+            result['download_connections_new'] += getattr(pool, 'num_connections', 0)
+    result['download_connections_reused'] = max(
+        result['download_requests'] - result['download_connections_new'], 0
+    )
+    return result
+
+
+def get_pool_stats():
+    """返回注册表命中与连接复用统计"""
+    with _lock:
+        stats = dict(_stats)
+        stats['ark_clients'] = len(_ark_clients) + len(_async_ark_clients)
+    stats.update(_download_pool_stats())
+
+    ark_total = stats['ark_connections_new'] + stats['ark_connections_reused']
+    stats['ark_connection_reuse_rate'] = round(stats['ark_connections_reused'] / ark_total, 4) if ark_total else 0.0
+    download_total = stats['download_requests']
+    stats['download_connection_reuse_rate'] = (
+        round(stats['download_connections_reused'] / download_total, 4) if download_total else 0.0
+    )
+    stats['settings'] = get_pool_settings()
+    stats['httpx_available'] = httpx is not None
+    return stats
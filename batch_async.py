@@ -0,0 +1,88 @@
+"""
+asyncio 批量执行器 - 在独立的事件循环线程中并发执行批量生成请求
+"""
+import asyncio
+import contextlib
+import os
+import threading
+
+_lock = threading.Lock()
+_loop = None
+_thread = None
+_semaphore = None
+
+# 统计信息（只在事件循环线程内修改）
+_stats = {
+    'in_flight': 0,
+    'waiting': 0,
+    'peak_in_flight': 0,
+    'total_requests': 0,
+}
+
+
+def get_concurrency():
+    """全局同时进行的图片请求数上限（BATCH_ASYNC_CONCURRENCY）"""
+    try:
+        return max(1, int(os.environ.get('BATCH_ASYNC_CONCURRENCY', '64')))
+    except ValueError:
+        return 64
+
+
+def _run_loop(loop, ready):
+    global _semaphore
+    asyncio.set_event_loop(loop)
+    _semaphore = asyncio.Semaphore(get_concurrency())
+    ready.set()
+    loop.run_forever()
+
+
+def get_loop():
+    """获取批量事件循环，首次调用时在后台线程中启动"""
+    global _loop, _thread
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            thread = threading.Thread(target=_run_loop, args=(loop, ready), name='batch-async', daemon=True)
+            thread.start()
+            ready.wait()
+            _loop, _thread = loop, thread
+        return _loop
+
+
+def _report_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"批量协程执行失败: {future.exception()}")
+
+
+def submit(coro):
+    """提交协程到批量事件循环，返回 concurrent.futures.Future"""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    future.add_done_callback(_report_exception)
+    return future
+
+
+@contextlib.asynccontextmanager
+async def slot():
+    """占用一个全局并发名额（API 调用 + 下载期间持有）"""
+    _stats['waiting'] += 1
+    try:
+        await _semaphore.acquire()
+    finally:
+        _stats['waiting'] -= 1
+    _stats['in_flight'] += 1
+    _stats['total_requests'] += 1
+    _stats['peak_in_flight'] = max(_stats['peak_in_flight'], _stats['in_flight'])
+    try:
+        yield
+    finally:
+        _stats['in_flight'] -= 1
+        _semaphore.release()
+
+
+def get_stats():
+    """返回事件循环的并发统计"""
+    stats = dict(_stats)
+    stats['concurrency'] = get_concurrency()
+    stats['running'] = _loop is not None
+    return stats
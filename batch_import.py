@@ -0,0 +1,181 @@
+"""
+服务端批量任务导入 - 逐行读取上传的 .xlsx / .csv，校验后分块写入持久化批次队列
+
+表格在后台线程中流式读取（.xlsx 使用 openpyxl 只读模式，.csv 使用标准库 csv），
+内存中只保留当前行和一个待写入的任务块，几万行的表格也不会占用更多内存；
+任务边导入边被队列工作线程领取执行。列名与页面上的 Excel 模板相同。
+"""
+import codecs
+import csv
+import datetime
+import os
+import re
+
+try:
+    import openpyxl
+except ImportError:  # 未安装 openpyxl 时只支持 .csv
+    openpyxl = None
+
+
+SUPPORTED_EXTENSIONS = ('.xlsx', '.csv')
+MAX_IMAGES_PER_TASK = 10
+MAX_SAMPLE_IMAGES = 4
+
+# 任务字段 -> 表格列名（兼容旧的"示例图文件名"列）
+COLUMNS = {
+    'prompt': ('提示词',),
+    'negative_prompt': ('负面提示词',),
+    'aspect_ratio': ('图片比例',),
+    'resolution': ('分辨率',),
+    'ref_images_text': ('参考图', '示例图文件名'),
+    'num_images': ('生成数量',),
+    'filename': ('文件名',),
+}
+
+# Excel 可能把 1:1、16:9 这样的比例解析成数字
+_NUMERIC_RATIOS = {
+    1.0: '1:1', 0.6667: '2:3', 1.5: '3:2', 0.75: '3:4', 1.3333: '4:3', 1.7778: '16:9', 0.5625: '9:16',
+}
+
+
+class BatchImportError(ValueError):
+    """表格无法解析（格式不支持、缺少依赖或没有表头）"""
+
+
+def check_format(filename):
+    """检查文件格式是否支持，不支持时抛出 BatchImportError，返回小写扩展名"""
+    ext = os.path.splitext(filename or '')[1].lower()
+    if ext not in SUPPORTED_EXTENSIONS:
+        raise BatchImportError(f"不支持的文件格式: {ext or '未知'}，请上传 .xlsx 或 .csv")
+    if ext == '.xlsx' and openpyxl is None:
+        raise BatchImportError('服务器未安装 openpyxl，无法解析 .xlsx（pip install openpyxl），请改为上传 .csv')
+    return ext
+
+
+def iter_rows(path):
+    """逐行读取表格，产出 (行号, {列名: 值})，第一行为表头，空行跳过"""
+    ext = check_format(path)
+    rows = _iter_xlsx(path) if ext == '.xlsx' else _iter_csv(path)
+    header = None
+    for row_number, values in rows:
+        if header is None:
+            header = [str(v).strip() if v is not None else '' for v in values]
+            if not any(header):
+                raise BatchImportError('表格第一行没有表头')
+            continue
+        if all(v is None or str(v).strip() == '' for v in values):
+            continue
+        yield row_number, dict(zip(header, values))
+    if header is None:
+        raise BatchImportError('表格是空的')
+
+
+def _iter_xlsx(path):
+    # 只读模式按需解压和解析工作表，不会把整个工作簿载入内存
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        for row_number, values in enumerate(sheet.iter_rows(values_only=True), start=1):
+            yield row_number, values
+    finally:
+        workbook.close()
+
+
+def _csv_encoding(path):
+    # Excel 另存的 CSV 在中文 Windows 上是 GBK 编码，先按 UTF-8 试读开头一段
+    with open(path, 'rb') as f:
+        head = f.read(64 * 1024)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'gb18030'
+
+
+def _iter_csv(path):
+    with open(path, newline='', encoding=_csv_encoding(path)) as f:
+        for row_number, values in enumerate(csv.reader(f), start=1):
+            yield row_number, values
+
+
+def _cell(values, field):
+    for column in COLUMNS[field]:
+        value = values.get(column)
+        if value is not None and str(value).strip() != '':
+            return value
+    return None
+
+
+def _text(value, default=''):
+    if value is None:
+        return default
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip() or default
+
+
+def _aspect_ratio(value):
+    if value is None:
+        return '1:1'
+    if isinstance(value, datetime.time):
+        # 单元格中的 16:9 被识别成时间
+        return f'{value.hour}:{value.minute}'
+    if isinstance(value, (int, float)):
+        for number, ratio in _NUMERIC_RATIOS.items():
+            if abs(value - number) < 0.01:
+                return ratio
+        return None
+    return str(value).strip()
+
+
+def match_sample_images(text, sample_images):
+    """按文件名（模糊匹配）在示例图中查找参考图，最多 MAX_SAMPLE_IMAGES 张"""
+    matched = []
+    for name in re.split(r'[,，;\s]+', text or ''):
+        name = name.strip()
+        if not name:
+            continue
+        for image in sample_images:
+            filename = image.get('filename') or ''
+            if name in filename or (filename and filename.split('.')[0] in name):
+                if image.get('url') and all(m['url'] != image['url'] for m in matched):
+                    matched.append(image)
+                break
+        if len(matched) >= MAX_SAMPLE_IMAGES:
+            break
+    return matched[:MAX_SAMPLE_IMAGES]
+
+
+def row_to_task(values, sample_images, aspect_ratios):
+    """把一行转成批量任务，返回 (任务, 错误信息)"""
+    prompt = _text(_cell(values, 'prompt'))
+    if not prompt:
+        return None, '缺少提示词'
+
+    raw_ratio = _cell(values, 'aspect_ratio')
+    aspect_ratio = _aspect_ratio(raw_ratio)
+    if aspect_ratio not in aspect_ratios:
+        return None, f'不支持的图片比例: {raw_ratio}'
+    resolution = _text(_cell(values, 'resolution'), '2k').lower()
+    if resolution not in aspect_ratios[aspect_ratio]:
+        return None, f'不支持的分辨率: {resolution}'
+
+    raw_count = _cell(values, 'num_images')
+    try:
+        num_images = int(float(raw_count)) if raw_count is not None else 1
+    except (TypeError, ValueError):
+        return None, f'生成数量不是数字: {raw_count}'
+    if not 1 <= num_images <= MAX_IMAGES_PER_TASK:
+        return None, f'生成数量需要在 1~{MAX_IMAGES_PER_TASK} 之间: {num_images}'
+
+    ref_images_text = _text(_cell(values, 'ref_images_text'))
+    return {
+        'prompt': prompt,
+        'negative_prompt': _text(_cell(values, 'negative_prompt')),
+        'aspect_ratio': aspect_ratio,
+        'resolution': resolution,
+        'ref_images_text': ref_images_text,
+        'sample_images': match_sample_images(ref_images_text, sample_images),
+        'num_images': num_images,
+        'filename': _text(_cell(values, 'filename'), 'generated'),
+    }, None
@@ -0,0 +1,129 @@
+"""
+测试公共夹具 - 每个测试使用临时目录中的独立数据库，不读写仓库中的 generation_records.db
+"""
+import base64
+import io
+import os
+import threading
+import time
+import types
+
+import pytest
+from PIL import Image
+
+import database
+
+# scripts/ 下是手动运行的 SDK 调试脚本（需要 volcengine 等依赖），不作为测试收集
+collect_ignore = ['scripts']
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """指向临时文件的数据库（已建表）"""
+    monkeypatch.setattr(database, 'DB_PATH', str(tmp_path / 'test.db'))
+    database.init_database()
+    return database
+
+
+@pytest.fixture(scope='session')
+def web_app_module(tmp_path_factory):
+    """
+    导入 web_app（整个测试会话只导入一次）
+
+    导入时会创建 logs / uploads / output 目录并初始化数据库，在临时目录中导入，不影响仓库目录；
+    导入不会启动批量任务队列（见 web_app.init_app），提交的批次只写入数据库。
+    """
+    workdir = tmp_path_factory.mktemp('web_app')
+    cwd = os.getcwd()
+    original_db = database.DB_PATH
+    os.chdir(workdir)
+    database.DB_PATH = str(workdir / 'import.db')
+    try:
+        import web_app
+    finally:
+        os.chdir(cwd)
+        database.DB_PATH = original_db
+    web_app.app.config['SECRET_KEY'] = 'test'
+    return web_app
+
+
+@pytest.fixture
+def client(web_app_module, db):
+    """已登录的测试客户端，返回 (客户端, 用户ID)"""
+    db.create_user('tester', 'pw')
+    user = db.verify_user('tester', 'pw')
+    test_client = web_app_module.app.test_client()
+    with test_client.session_transaction() as session:
+        session['user_id'] = user['id']
+        session['username'] = user['username']
+    return test_client, user['id']
+
+
+def _jpeg_b64(size=(16, 16)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 120, 80)).save(buffer, 'JPEG')
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+class FakeArkClient:
+    """
+    代替 OpenAI 客户端的假方舟接口：images.generate 返回 b64_json 图片
+
+    记录每次调用的参数和同时进行的最大调用数；delay 为每次调用的耗时。
+    """
+
+    def __init__(self, delay=0.0):
+        self.images = self
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.image_b64 = _jpeg_b64()
+        self._lock = threading.Lock()
+
+    def with_options(self, **kwargs):
+        return self
+
+    def generate(self, **kwargs):
+        with self._lock:
+            self.calls.append(kwargs)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.delay)
+            return types.SimpleNamespace(data=[types.SimpleNamespace(url=None, b64_json=self.image_b64)])
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def fake_ark(web_app_module, db, tmp_path, monkeypatch):
+    """
+    把 web_app 的方舟客户端换成 FakeArkClient，图片以 b64_json 返回并保存到临时目录
+
+    结束时把内存中的耗时统计写入临时数据库，不留到进程退出时写入仓库中的数据库。
+    """
+    fake = FakeArkClient()
+    monkeypatch.setenv('ARK_API_KEY', 'test-key')
+    monkeypatch.setenv('ARK_HEDGE_ENABLED', 'false')
+    monkeypatch.setattr(web_app_module.ark_clients, 'get_ark_client', lambda *args, **kwargs: fake)
+    monkeypatch.setattr(web_app_module, 'ARK_RESPONSE_FORMAT', 'b64_json')
+    monkeypatch.setitem(web_app_module.app.config, 'OUTPUT_FOLDER', str(tmp_path / 'output'))
+    monkeypatch.setitem(web_app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    yield fake
+    web_app_module.latency_stats.flush()
+
+
+@pytest.fixture
+def wait_for_task():
+    """返回等待函数：轮询 /generate 任务状态直到完成或失败，返回任务状态"""
+    def wait(test_client, task_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            task = test_client.get(f'/api/single-generation-status/{task_id}').get_json()['task']
+            if task['status'] in ('completed', 'failed'):
+                return task
+            time.sleep(0.05)
+        raise AssertionError(f'任务 {task_id} 未在 {timeout} 秒内结束')
+    return wait
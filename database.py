@@ -4,6 +4,7 @@
 import sqlite3
 import json
 import hashlib
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -95,14 +96,33 @@ def init_database():
                 filename TEXT NOT NULL,
                 batch_id TEXT,
                 status TEXT DEFAULT 'success',
+                requested_width INTEGER,
+                requested_height INTEGER,
+                actual_width INTEGER,
+                actual_height INTEGER,
+                params_hash TEXT,
+                reused_from INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users(id)
             )
         ''')
     
+    # 补充请求尺寸 / 实际生成尺寸列（旧数据库）
+    cursor.execute("PRAGMA table_info(generation_records)")
+    columns = [column[1] for column in cursor.fetchall()]
+    for column in ('requested_width', 'requested_height', 'actual_width', 'actual_height'):
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE generation_records ADD COLUMN {column} INTEGER')
+    # 生成参数哈希（批量任务去重 / 复用已有结果）和复用来源记录
+    if 'params_hash' not in columns:
+        cursor.execute('ALTER TABLE generation_records ADD COLUMN params_hash TEXT')
+    if 'reused_from' not in columns:
+        cursor.execute('ALTER TABLE generation_records ADD COLUMN reused_from INTEGER')
+    
     # 创建索引
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_username ON users(username)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_created ON generation_records(user_id, created_at DESC)')
     cursor.execute('CREATE INDEX IF NOT EXISTS idx_batch_id ON generation_records(batch_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_params_hash ON generation_records(user_id, params_hash)')
     
     # 创建人物库和场景库表
     cursor.execute('''
@@ -128,6 +148,168 @@ def init_database():
         )
     ''')
     
+    # 生成结果缓存索引（按请求内容哈希寻址，last_access 用于 LRU 淘汰）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_cache (
+            cache_key TEXT PRIMARY KEY,
+            file_path TEXT NOT NULL,
+            bytes INTEGER DEFAULT 0,
+            sha256 TEXT,
+            created_at TIMESTAMP,
+            last_access TIMESTAMP,
+            hits INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_access ON generation_cache(last_access)')
+    
+    # 参考图预处理缓存（按原图内容哈希 + 预处理参数寻址）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reference_images (
+            cache_key TEXT PRIMARY KEY,
+            source_url TEXT,
+            prepared_path TEXT NOT NULL,
+            prepared_url TEXT,
+            original_bytes INTEGER DEFAULT 0,
+            prepared_bytes INTEGER DEFAULT 0,
+            width INTEGER,
+            height INTEGER,
+            created_at TIMESTAMP,
+            last_used TIMESTAMP,
+            uses INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_reference_source ON reference_images(source_url)')
+    # 原图 URL -> 内容哈希：同一 URL 的内容可能被覆盖，按 ETag / Last-Modified 重新验证后才直接使用
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reference_sources (
+            source_url TEXT NOT NULL,
+            variant TEXT NOT NULL,
+            cache_key TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            checked_at REAL,
+            PRIMARY KEY (source_url, variant)
+        )
+    ''')
+    
+    # 持久化批量任务队列：批次、任务（带租约）、已完成图片和批次日志
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            batch_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            total INTEGER NOT NULL,
+            completed INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            status TEXT DEFAULT 'running',
+            start_time TEXT,
+            end_time TEXT,
+            priority TEXT DEFAULT 'batch',
+            cancelled INTEGER DEFAULT 0,
+            importing INTEGER DEFAULT 0,
+            import_heartbeat REAL,
+            closed INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(batch_jobs)")
+    batch_job_columns = [column[1] for column in cursor.fetchall()]
+    if 'priority' not in batch_job_columns:
+        cursor.execute("ALTER TABLE batch_jobs ADD COLUMN priority TEXT DEFAULT 'batch'")
+    if 'cancelled' not in batch_job_columns:
+        cursor.execute('ALTER TABLE batch_jobs ADD COLUMN cancelled INTEGER DEFAULT 0')
+    if 'importing' not in batch_job_columns:
+        cursor.execute('ALTER TABLE batch_jobs ADD COLUMN importing INTEGER DEFAULT 0')
+        cursor.execute('ALTER TABLE batch_jobs ADD COLUMN import_heartbeat REAL')
+    if 'closed' not in batch_job_columns:
+        cursor.execute('ALTER TABLE batch_jobs ADD COLUMN closed INTEGER DEFAULT 0')
+        # 已结束的旧批次不会再写入结束日志，直接标记为已关闭
+        cursor.execute("UPDATE batch_jobs SET closed = 1 WHERE status IN ('completed', 'cancelled')")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            task_index INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            heartbeat_at REAL,
+            error TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            cost REAL DEFAULT 1,
+            linked_to INTEGER,
+            UNIQUE (batch_id, task_index)
+        )
+    ''')
+    cursor.execute("PRAGMA table_info(batch_tasks)")
+    batch_task_columns = [column[1] for column in cursor.fetchall()]
+    if 'cost' not in batch_task_columns:
+        cursor.execute('ALTER TABLE batch_tasks ADD COLUMN cost REAL DEFAULT 1')
+    # 与同一批次中较早的任务参数相同：不单独领取，随该任务一起结束并复用它的图片
+    if 'linked_to' not in batch_task_columns:
+        cursor.execute('ALTER TABLE batch_tasks ADD COLUMN linked_to INTEGER')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_batch_tasks_status ON batch_tasks(status, id)')
+    # 公平调度：每个用户的权重、并发上限和已获得服务的虚拟时间
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS scheduler_users (
+            user_id INTEGER PRIMARY KEY,
+            weight REAL DEFAULT 1,
+            max_concurrency INTEGER,
+            virtual_time REAL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_task_images (
+            task_id INTEGER NOT NULL,
+            image_index INTEGER NOT NULL,
+            PRIMARY KEY (task_id, image_index)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS batch_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            time TEXT,
+            message TEXT,
+            type TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_batch_logs_batch ON batch_logs(batch_id, id)')
+    
+    # 幂等键：同一用户在同一接口重复提交相同的键时返回原来的任务/批次，而不是重新生成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            scope TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            fingerprint TEXT,
+            resource_id TEXT NOT NULL,
+            created_at REAL,
+            expires_at REAL,
+            PRIMARY KEY (user_id, scope, idempotency_key)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at)')
+    
+    # 生成耗时统计（按模型和请求尺寸）：累计值按半衰期衰减，批量预估以最近的耗时为主
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation_timings (
+            model TEXT NOT NULL,
+            size TEXT NOT NULL,
+            api_calls REAL DEFAULT 0,
+            api_images REAL DEFAULT 0,
+            api_seconds REAL DEFAULT 0,
+            downloads REAL DEFAULT 0,
+            download_seconds REAL DEFAULT 0,
+            total_api_calls INTEGER DEFAULT 0,
+            total_downloads INTEGER DEFAULT 0,
+            updated_at REAL,
+            PRIMARY KEY (model, size)
+        )
+    ''')
+    
     conn.commit()
     conn.close()
     print(f"数据库初始化完成: {DB_PATH}")
@@ -143,6 +325,10 @@ def save_generation_record(data):
             - width, height, num_images, seed, steps
             - sample_images (list), image_path, filename
             - batch_id (optional)
+            - requested_width, requested_height (optional, 默认等于 width / height)
+            - actual_width, actual_height (optional, 模型实际生成的尺寸)
+            - params_hash (optional, 生成参数哈希，用于复用已有结果)
+            - reused_from (optional, 复用的原记录 ID，图片与原记录相同)
     """
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
@@ -151,12 +337,21 @@ def save_generation_record(data):
     # 使用本地时间
     local_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
-    # 防止重复保存相同的 image_path（避免前端/网络重试导致重复记录）
+    # 防止重复保存相同的 image_path（避免前端/网络重试导致重复记录）；
+    # 复用已有图片的记录与原记录的 image_path 相同，改为按批次、文件名和复用来源判断是否重复
     existing = None
     try:
-        cursor.execute('SELECT id FROM generation_records WHERE user_id = ? AND image_path = ? LIMIT 1', (
-            data.get('user_id'), data.get('image_path')
-        ))
+        if data.get('reused_from') is None:
+            cursor.execute('SELECT id FROM generation_records WHERE user_id = ? AND image_path = ? LIMIT 1', (
+                data.get('user_id'), data.get('image_path')
+            ))
+        else:
+            cursor.execute('''
+                SELECT id FROM generation_records
+                WHERE user_id = ? AND reused_from = ? AND batch_id IS ? AND filename IS ? LIMIT 1
+            ''', (
+                data.get('user_id'), data.get('reused_from'), data.get('batch_id'), data.get('filename')
+            ))
         row = cursor.fetchone()
         if row:
             existing = row[0]
@@ -171,8 +366,9 @@ def save_generation_record(data):
     cursor.execute('''
         INSERT INTO generation_records 
         (user_id, created_at, prompt, negative_prompt, aspect_ratio, resolution, width, height, 
-         num_images, seed, steps, sample_images, image_path, filename, batch_id, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+         num_images, seed, steps, sample_images, image_path, filename, batch_id, status,
+         requested_width, requested_height, actual_width, actual_height, params_hash, reused_from)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         data.get('user_id'),
         local_time,
@@ -189,7 +385,13 @@ def save_generation_record(data):
         data.get('image_path'),
         data.get('filename'),
         data.get('batch_id'),
-        data.get('status', 'success')
+        data.get('status', 'success'),
+        data.get('requested_width', data.get('width')),
+        data.get('requested_height', data.get('height')),
+        data.get('actual_width'),
+        data.get('actual_height'),
+        data.get('params_hash'),
+        data.get('reused_from')
     ))
     
     record_id = cursor.lastrowid
@@ -199,6 +401,860 @@ def save_generation_record(data):
     return record_id
 
 
+def find_reusable_records(user_id, params_hash, limit, since=None, batch_id=None):
+    """
+    按生成参数哈希查找可以复用的成功记录（每张图片一条，最新的在前）
+    
+    since 为最早的创建时间（'%Y-%m-%d %H:%M:%S'）；batch_id 不为空时只在该批次中查找。
+    复用产生的记录与原记录指向同一张图片，按 image_path 去重后返回最早的那条。
+    """
+    conditions = ["user_id = ?", "params_hash = ?", "status = 'success'"]
+    args = [user_id, params_hash]
+    if since:
+        conditions.append('created_at >= ?')
+        args.append(since)
+    if batch_id:
+        conditions.append('batch_id = ?')
+        args.append(batch_id)
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT MIN(id) AS id, image_path, seed, actual_width, actual_height FROM generation_records
+        WHERE {' AND '.join(conditions)}
+        GROUP BY image_path ORDER BY MAX(id) DESC LIMIT ?
+    ''', args + [limit])
+    rows = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return rows
+
+
+def _cache_time():
+    # 精确到微秒，保证 LRU 顺序
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def get_cache_entry(cache_key):
+    """按缓存键查询缓存条目"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM generation_cache WHERE cache_key = ?', (cache_key,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def save_cache_entry(cache_key, file_path, size, sha256):
+    """保存（或覆盖）缓存条目"""
+    now = _cache_time()
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO generation_cache (cache_key, file_path, bytes, sha256, created_at, last_access, hits)
+        VALUES (?, ?, ?, ?, ?, ?, 0)
+    ''', (cache_key, file_path, size, sha256, now, now))
+    conn.commit()
+    conn.close()
+
+
+def touch_cache_entry(cache_key):
+    """缓存命中：更新最近访问时间和命中次数"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE generation_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?', (_cache_time(), cache_key))
+    conn.commit()
+    conn.close()
+
+
+def delete_cache_entry(cache_key):
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM generation_cache WHERE cache_key = ?', (cache_key,))
+    conn.commit()
+    conn.close()
+
+
+def get_cache_usage():
+    """返回 (缓存条目数, 缓存文件总字节数)"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM generation_cache')
+    count, total = cursor.fetchone()
+    conn.close()
+    return count, total
+
+
+def get_lru_cache_entries(limit=50):
+    """返回最久未访问的缓存条目"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM generation_cache ORDER BY last_access ASC LIMIT ?', (limit,))
+    rows = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return rows
+
+
+def get_reference_image(cache_key):
+    """按缓存键（原图内容哈希 + 预处理参数）查询预处理后的参考图"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM reference_images WHERE cache_key = ?', (cache_key,))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def get_reference_source(source_url, variant):
+    """查询原图 URL 上次对应的内容（缓存键、ETag、Last-Modified、上次验证时间）"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM reference_sources WHERE source_url = ? AND variant = ?', (source_url, variant))
+    row = cursor.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+
+def save_reference_source(source_url, variant, cache_key, etag=None, last_modified=None):
+    """记录原图 URL 当前对应的内容（验证时间为现在）"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO reference_sources (source_url, variant, cache_key, etag, last_modified, checked_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (source_url, variant, cache_key, etag, last_modified, time.time()))
+    conn.commit()
+    conn.close()
+
+
+def save_reference_image(data):
+    """保存预处理后的参考图索引"""
+    now = _cache_time()
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO reference_images
+        (cache_key, source_url, prepared_path, prepared_url, original_bytes, prepared_bytes, width, height, created_at, last_used, uses)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)
+    ''', (
+        data['cache_key'], data.get('source_url'), data['prepared_path'], data.get('prepared_url'),
+        data.get('original_bytes', 0), data.get('prepared_bytes', 0), data.get('width'), data.get('height'), now, now
+    ))
+    conn.commit()
+    conn.close()
+
+
+def touch_reference_image(cache_key, source_url=None):
+    """参考图被复用：更新使用时间和次数（记录新的来源 URL，便于下次直接按 URL 命中）"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    if source_url:
+        cursor.execute('UPDATE reference_images SET last_used = ?, uses = uses + 1, source_url = ? WHERE cache_key = ?',
+                       (_cache_time(), source_url, cache_key))
+    else:
+        cursor.execute('UPDATE reference_images SET last_used = ?, uses = uses + 1 WHERE cache_key = ?', (_cache_time(), cache_key))
+    conn.commit()
+    conn.close()
+
+
+# ==================== 幂等键 ====================
+def claim_idempotency_key(user_id, scope, key, fingerprint, resource_id, ttl):
+    """
+    登记幂等键并返回该键对应的记录
+    
+    键不存在（或已过期）时以 resource_id 登记，返回的 resource_id 与传入的相同；
+    否则返回原请求登记的记录，由调用方返回原来的任务/批次。
+    """
+    now = time.time()
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    try:
+        # 过期的键先删除；INSERT OR IGNORE 保证并发提交同一个键时只有一个登记成功
+        cursor.execute('DELETE FROM idempotency_keys WHERE expires_at < ?', (now,))
+        cursor.execute('''
+            INSERT OR IGNORE INTO idempotency_keys (user_id, scope, idempotency_key, fingerprint, resource_id, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, scope, key, fingerprint, resource_id, now, now + ttl))
+        cursor.execute('SELECT * FROM idempotency_keys WHERE user_id = ? AND scope = ? AND idempotency_key = ?', (user_id, scope, key))
+        row = dict(cursor.fetchone())
+        conn.commit()
+        return row
+    finally:
+        conn.close()
+
+
+def release_idempotency_key(user_id, scope, key, resource_id):
+    """请求没有创建任务（参数错误、提交失败）时删除登记，客户端可以用同一个键重试"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM idempotency_keys WHERE user_id = ? AND scope = ? AND idempotency_key = ? AND resource_id = ?',
+                   (user_id, scope, key, resource_id))
+    conn.commit()
+    conn.close()
+
+
+def get_idempotency_stats():
+    """幂等键登记数（按接口）"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT scope, COUNT(*) FROM idempotency_keys WHERE expires_at >= ? GROUP BY scope', (time.time(),))
+    scopes = {scope: count for scope, count in cursor.fetchall()}
+    conn.close()
+    return {'entries': sum(scopes.values()), 'scopes': scopes}
+
+
+# ==================== 生成耗时统计 ====================
+def merge_generation_timings(samples, half_life_seconds):
+    """
+    把一批耗时样本合并到 generation_timings
+    
+    samples: {(model, size): {'api_calls', 'api_images', 'api_seconds', 'downloads', 'download_seconds'}}
+    已有的累计值先按距上次更新的时间衰减（half_life_seconds 后减半）再加上新样本。
+    """
+    now = time.time()
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        for (model, size), sample in samples.items():
+            cursor.execute('SELECT * FROM generation_timings WHERE model = ? AND size = ?', (model, size))
+            row = cursor.fetchone()
+            if row is None:
+                old, decay = {}, 0.0
+            else:
+                old = dict(row)
+                decay = 0.5 ** (max(0.0, now - (row['updated_at'] or now)) / half_life_seconds) if half_life_seconds > 0 else 1.0
+            values = {
+                column: old.get(column, 0) * decay + sample.get(column, 0)
+                for column in ('api_calls', 'api_images', 'api_seconds', 'downloads', 'download_seconds')
+            }
+            cursor.execute('''
+                INSERT OR REPLACE INTO generation_timings
+                (model, size, api_calls, api_images, api_seconds, downloads, download_seconds, total_api_calls, total_downloads, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                model, size, values['api_calls'], values['api_images'], values['api_seconds'],
+                values['downloads'], values['download_seconds'],
+                old.get('total_api_calls', 0) + sample.get('api_calls', 0),
+                old.get('total_downloads', 0) + sample.get('downloads', 0),
+                now
+            ))
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def get_generation_timings(model=None):
+    """按模型和尺寸返回平均耗时（每张图片的 API 耗时、每次下载耗时）和样本数"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    if model:
+        cursor.execute('SELECT * FROM generation_timings WHERE model = ? ORDER BY size', (model,))
+    else:
+        cursor.execute('SELECT * FROM generation_timings ORDER BY model, size')
+    timings = []
+    for row in cursor.fetchall():
+        timings.append({
+            'model': row['model'],
+            'size': row['size'],
+            'api_seconds_per_image': round(row['api_seconds'] / row['api_images'], 3) if row['api_images'] else None,
+            'api_seconds_per_call': round(row['api_seconds'] / row['api_calls'], 3) if row['api_calls'] else None,
+            'download_seconds': round(row['download_seconds'] / row['downloads'], 3) if row['downloads'] else None,
+            'api_calls': row['total_api_calls'],
+            'downloads': row['total_downloads'],
+            'updated_at': datetime.fromtimestamp(row['updated_at']).isoformat() if row['updated_at'] else None,
+        })
+    conn.close()
+    return timings
+
+
+# ==================== 批量任务队列 ====================
+def _queue_connect():
+    # 多个工作线程同时写队列，等待锁的时间放宽一些
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def create_batch_job(batch_id, user_id, username, tasks, costs=None, priority='batch', importing=False):
+    """
+    创建批次并把所有任务写入队列（同一个事务）
+    
+    costs 为每个任务的调度成本（按图片数和分辨率估算），用于用户之间的加权公平调度；
+    priority 为 batch 或 backfill，有 batch 任务等待时不领取 backfill 任务。
+    importing 为 True 时任务随后由 append_batch_tasks 分块写入，finish_batch_import 之前批次不会标记完成。
+    """
+    costs = costs or [1.0] * len(tasks)
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO batch_jobs (batch_id, user_id, username, total, status, start_time, priority, importing, import_heartbeat)
+        VALUES (?, ?, ?, ?, 'running', ?, ?, ?, ?)
+    ''', (batch_id, user_id, username, len(tasks), datetime.now().isoformat(), priority,
+          1 if importing else 0, time.time() if importing else None))
+    cursor.executemany(
+        'INSERT INTO batch_tasks (batch_id, task_index, payload, cost, status, linked_to) VALUES (?, ?, ?, ?, ?, ?)',
+        [_batch_task_row(batch_id, i, task, cost) for i, (task, cost) in enumerate(zip(tasks, costs))]
+    )
+    conn.commit()
+    conn.close()
+
+
+def _batch_task_row(batch_id, index, task, cost):
+    # 带 linked_to 的任务与同批次中较早的任务参数相同，不进入待领取队列
+    linked_to = task.get('linked_to')
+    status = 'pending' if linked_to is None else 'linked'
+    return (batch_id, index, json.dumps(task, ensure_ascii=False), cost, status, linked_to)
+
+
+def append_batch_tasks(batch_id, start_index, tasks, costs=None):
+    """
+    向导入中的批次追加一块任务（同时刷新导入心跳）
+    
+    批次已取消或已结束时不再写入，返回 False。
+    """
+    costs = costs or [1.0] * len(tasks)
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            UPDATE batch_jobs SET total = total + ?, import_heartbeat = ?
+            WHERE batch_id = ? AND importing = 1 AND status IN ('running', 'paused')
+        ''', (len(tasks), time.time(), batch_id))
+        if cursor.rowcount == 0:
+            cursor.execute('ROLLBACK')
+            return False
+        cursor.executemany(
+            'INSERT INTO batch_tasks (batch_id, task_index, payload, cost, status, linked_to) VALUES (?, ?, ?, ?, ?, ?)',
+            [_batch_task_row(batch_id, start_index + i, task, cost) for i, (task, cost) in enumerate(zip(tasks, costs))]
+        )
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return True
+
+
+def finish_batch_import(batch_id):
+    """
+    结束导入：之后批次按任务结果正常完成
+    
+    返回批次信息，其中 finished 表示导入结束时所有任务都已执行完（由调用方标记批次完成）。
+    """
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('UPDATE batch_jobs SET importing = 0 WHERE batch_id = ? AND importing = 1', (batch_id,))
+        if cursor.rowcount == 0:
+            cursor.execute('ROLLBACK')
+            return None
+        cursor.execute('''
+            UPDATE batch_jobs SET status = 'completed', end_time = ?
+            WHERE batch_id = ? AND status IN ('running', 'paused') AND completed + failed >= total
+        ''', (datetime.now().isoformat(), batch_id))
+        finished = cursor.rowcount > 0
+        cursor.execute('SELECT * FROM batch_jobs WHERE batch_id = ?', (batch_id,))
+        job = dict(cursor.fetchone())
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    
+    job['finished'] = finished
+    return job
+
+
+def get_stale_batch_imports(stale_seconds):
+    """导入心跳超时的批次（导入进程已退出），返回批次 ID 列表"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT batch_id FROM batch_jobs WHERE importing = 1 AND import_heartbeat < ?', (time.time() - stale_seconds,))
+    batch_ids = [row['batch_id'] for row in cursor.fetchall()]
+    conn.close()
+    return batch_ids
+
+
+# scheduler_users 中保存系统虚拟时钟的行（用户 ID 从 1 开始）
+SCHEDULER_CLOCK_ID = 0
+
+
+def _pick_fair_user(cursor, now, default_max_concurrency):
+    """
+    加权公平调度：在有待执行任务、且未达到并发上限的用户中，选虚拟时间最小的用户
+    
+    每领取一个任务，用户的虚拟时间增加 成本 / 权重；系统虚拟时钟为最近一次领取时的起始时间，
+    长时间空闲的用户回来时从系统时钟开始，不能攒下额度一次性占满工作线程。
+    优先级高的批次（batch）先于 backfill 调度，同一优先级内按上述规则公平调度；暂停或取消的批次不参与调度。
+    返回 (用户ID, 任务ID, 起始虚拟时间, 新的用户虚拟时间)，没有可调度的用户时返回 None。
+    """
+    cursor.execute('''
+        SELECT j.user_id, CASE j.priority WHEN 'backfill' THEN 1 ELSE 0 END AS lane, MIN(t.id) AS task_id
+        FROM batch_tasks t
+        JOIN batch_jobs j ON j.batch_id = t.batch_id
+        WHERE j.status = 'running' AND (t.status = 'pending' OR (t.status = 'running' AND t.lease_expires_at < ?))
+        GROUP BY j.user_id, lane
+    ''', (now,))
+    candidates = [(row['user_id'], row['lane'], row['task_id']) for row in cursor.fetchall()]
+    if not candidates:
+        return None
+    
+    cursor.execute('''
+        SELECT j.user_id, COUNT(*) AS running FROM batch_tasks t
+        JOIN batch_jobs j ON j.batch_id = t.batch_id
+        WHERE t.status = 'running' AND t.lease_expires_at >= ?
+        GROUP BY j.user_id
+    ''', (now,))
+    running = {row['user_id']: row['running'] for row in cursor.fetchall()}
+    
+    cursor.execute('SELECT * FROM scheduler_users')
+    settings = {row['user_id']: dict(row) for row in cursor.fetchall()}
+    clock = settings.pop(SCHEDULER_CLOCK_ID, {}).get('virtual_time') or 0.0
+    
+    def vtime(user_id):
+        return settings.get(user_id, {}).get('virtual_time') or 0.0
+    
+    best = None
+    for user_id, lane, task_id in candidates:
+        limit = settings.get(user_id, {}).get('max_concurrency')
+        if limit is None:
+            limit = default_max_concurrency
+        if limit and running.get(user_id, 0) >= limit:
+            continue
+        start = max(vtime(user_id), clock)
+        if best is None or (lane, start, task_id) < best[1:]:
+            best = (user_id, lane, start, task_id)
+    if best is None:
+        return None
+    
+    user_id, _, start, task_id = best
+    cursor.execute('SELECT cost FROM batch_tasks WHERE id = ?', (task_id,))
+    cost = cursor.fetchone()['cost']
+    # 复用已有结果的任务成本为 0，不占用户的份额；只有缺少成本（旧数据）时按 1 计算
+    cost = 1.0 if cost is None else cost
+    weight = settings.get(user_id, {}).get('weight') or 1.0
+    return user_id, task_id, start, start + cost / weight
+
+
+def claim_batch_task(owner, lease_seconds, default_max_concurrency=0):
+    """
+    领取一个待执行的任务（或租约已过期的任务），返回任务信息，没有可领取的任务时返回 None
+    
+    按用户加权公平调度（见 _pick_fair_user），同一用户的任务按提交顺序执行；
+    default_max_concurrency 为每个用户同时执行的任务数上限（0 表示不限制，可按用户单独设置）。
+    领取时写入租约持有者和过期时间，attempts 加一；持有者需要在过期前续约。
+    """
+    now = time.time()
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        # BEGIN IMMEDIATE 先拿写锁，避免两个进程领到同一个任务
+        cursor.execute('BEGIN IMMEDIATE')
+        picked = _pick_fair_user(cursor, now, default_max_concurrency)
+        if picked is None:
+            cursor.execute('COMMIT')
+            return None
+        user_id, task_id, start, virtual_time = picked
+        cursor.executemany('''
+            INSERT INTO scheduler_users (user_id, virtual_time) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET virtual_time = excluded.virtual_time
+        ''', [(user_id, virtual_time), (SCHEDULER_CLOCK_ID, start)])
+        cursor.execute('''
+            SELECT t.*, j.user_id, j.username, j.total, j.priority FROM batch_tasks t
+            JOIN batch_jobs j ON j.batch_id = t.batch_id
+            WHERE t.id = ?
+        ''', (task_id,))
+        row = cursor.fetchone()
+        cursor.execute('''
+            UPDATE batch_tasks SET status = 'running', lease_owner = ?, lease_expires_at = ?, heartbeat_at = ?,
+                attempts = attempts + 1, started_at = COALESCE(started_at, ?)
+            WHERE id = ?
+        ''', (owner, now + lease_seconds, now, datetime.now().isoformat(), task_id))
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    
+    claim = dict(row)
+    claim['attempts'] += 1
+    claim['lease_owner'] = owner
+    claim['task'] = json.loads(claim.pop('payload'))
+    return claim
+
+
+def renew_batch_leases(owner, task_ids, lease_seconds):
+    """心跳：为当前持有的任务续约，返回续约成功的任务数"""
+    if not task_ids:
+        return 0
+    now = time.time()
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(task_ids))
+    cursor.execute(f'''
+        UPDATE batch_tasks SET lease_expires_at = ?, heartbeat_at = ?
+        WHERE lease_owner = ? AND status = 'running' AND id IN ({placeholders})
+    ''', (now + lease_seconds, now, owner, *task_ids))
+    renewed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return renewed
+
+
+def release_batch_leases(owner):
+    """进程退出时把自己持有的任务放回队列，重启后立即恢复而不用等租约过期"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE batch_tasks SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        WHERE lease_owner = ? AND status = 'running'
+    ''', (owner,))
+    released = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return released
+
+
+def mark_batch_image_done(task_id, image_index):
+    """记录任务中的一张图片已完成（恢复时跳过）"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO batch_task_images (task_id, image_index) VALUES (?, ?)', (task_id, image_index))
+    conn.commit()
+    conn.close()
+
+
+def get_batch_task_done_images(task_id):
+    """返回任务中已完成的图片序号集合"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT image_index FROM batch_task_images WHERE task_id = ?', (task_id,))
+    done = {row[0] for row in cursor.fetchall()}
+    conn.close()
+    return done
+
+
+def complete_batch_task(task_id, owner, success, error=None):
+    """
+    结束任务并更新批次计数
+    
+    只有仍持有租约时才生效（租约过期后任务可能已被其他工作线程领取），否则返回 None；
+    关联到该任务的重复任务（linked）以相同的结果一起结束。
+    成功时返回批次信息，其中 finished 表示这是批次的最后一个任务（批次已取消时不再标记完成）。
+    """
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            UPDATE batch_tasks SET status = ?, error = ?, finished_at = ?, lease_owner = NULL, lease_expires_at = NULL
+            WHERE id = ? AND lease_owner = ? AND status = 'running'
+        ''', ('succeeded' if success else 'failed', error, datetime.now().isoformat(), task_id, owner))
+        if cursor.rowcount == 0:
+            cursor.execute('ROLLBACK')
+            return None
+        cursor.execute('SELECT batch_id, task_index FROM batch_tasks WHERE id = ?', (task_id,))
+        row = cursor.fetchone()
+        batch_id = row['batch_id']
+        cursor.execute('''
+            UPDATE batch_tasks SET status = ?, error = ?, finished_at = ?
+            WHERE batch_id = ? AND linked_to = ? AND status = 'linked'
+        ''', ('succeeded' if success else 'failed', error, datetime.now().isoformat(), batch_id, row['task_index']))
+        finished_tasks = 1 + cursor.rowcount
+        column = 'completed' if success else 'failed'
+        cursor.execute(f'UPDATE batch_jobs SET {column} = {column} + ? WHERE batch_id = ?', (finished_tasks, batch_id))
+        cursor.execute('''
+            UPDATE batch_jobs SET status = 'completed', end_time = ?
+            WHERE batch_id = ? AND status IN ('running', 'paused') AND importing = 0 AND completed + failed >= total
+        ''', (datetime.now().isoformat(), batch_id))
+        finished = cursor.rowcount > 0
+        cursor.execute('SELECT * FROM batch_jobs WHERE batch_id = ?', (batch_id,))
+        job = dict(cursor.fetchone())
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    
+    job['finished'] = finished
+    return job
+
+
+def get_linked_batch_tasks(batch_id, task_index):
+    """关联到指定任务、等待复用其结果的重复任务"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT task_index, payload FROM batch_tasks
+        WHERE batch_id = ? AND linked_to = ? AND status = 'linked' ORDER BY task_index
+    ''', (batch_id, task_index))
+    tasks = [{'task_index': row['task_index'], 'task': json.loads(row['payload'])} for row in cursor.fetchall()]
+    conn.close()
+    return tasks
+
+
+def stop_batch_task(task_id, owner):
+    """
+    执行中的任务在两张图片之间停止（批次被暂停或取消）
+    
+    批次已取消时任务标记为 cancelled；否则放回队列（不计入中断次数），继续后跳过已完成的图片。
+    只有仍持有租约时才生效，否则返回 None；成功时返回批次信息，task_status 为任务的新状态。
+    """
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            SELECT t.batch_id, j.status FROM batch_tasks t JOIN batch_jobs j ON j.batch_id = t.batch_id
+            WHERE t.id = ? AND t.lease_owner = ? AND t.status = 'running'
+        ''', (task_id, owner))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('ROLLBACK')
+            return None
+        batch_id = row['batch_id']
+        if row['status'] == 'cancelled':
+            task_status = 'cancelled'
+            cursor.execute('''
+                UPDATE batch_tasks SET status = 'cancelled', finished_at = ?, lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ?
+            ''', (datetime.now().isoformat(), task_id))
+            cursor.execute('UPDATE batch_jobs SET cancelled = cancelled + 1 WHERE batch_id = ?', (batch_id,))
+        else:
+            task_status = 'pending'
+            cursor.execute('''
+                UPDATE batch_tasks SET status = 'pending', attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_expires_at = NULL
+                WHERE id = ?
+            ''', (task_id,))
+        cursor.execute('SELECT * FROM batch_jobs WHERE batch_id = ?', (batch_id,))
+        job = dict(cursor.fetchone())
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    
+    job['task_status'] = task_status
+    return job
+
+
+def get_batch_job_status(batch_id):
+    """批次当前状态（running / paused / cancelled / completed），不存在时返回 None"""
+    conn = _queue_connect()
+    row = conn.execute('SELECT status FROM batch_jobs WHERE batch_id = ?', (batch_id,)).fetchone()
+    conn.close()
+    return row['status'] if row else None
+
+
+def set_batch_job_paused(batch_id, paused):
+    """暂停或继续批次，状态没有变化（批次已结束或已处于目标状态）时返回 False"""
+    source, target = ('running', 'paused') if paused else ('paused', 'running')
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('UPDATE batch_jobs SET status = ? WHERE batch_id = ? AND status = ?', (target, batch_id, source))
+    changed = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return changed
+
+
+def cancel_batch_job(batch_id):
+    """
+    取消批次：尚未执行的任务直接标记为 cancelled，执行中的任务由工作线程在两张图片之间停止
+    
+    返回直接取消的任务数，批次已结束时返回 None。
+    """
+    now = time.time()
+    conn = _queue_connect()
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+            UPDATE batch_jobs SET status = 'cancelled', end_time = ?
+            WHERE batch_id = ? AND status IN ('running', 'paused')
+        ''', (datetime.now().isoformat(), batch_id))
+        if cursor.rowcount == 0:
+            cursor.execute('ROLLBACK')
+            return None
+        cursor.execute('''
+            UPDATE batch_tasks SET status = 'cancelled', finished_at = ?, lease_owner = NULL, lease_expires_at = NULL
+            WHERE batch_id = ? AND (status IN ('pending', 'linked') OR (status = 'running' AND lease_expires_at < ?))
+        ''', (datetime.now().isoformat(), batch_id, now))
+        cancelled = cursor.rowcount
+        cursor.execute('UPDATE batch_jobs SET cancelled = cancelled + ? WHERE batch_id = ?', (cancelled, batch_id))
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+    return cancelled
+
+
+def add_batch_log(batch_id, message, log_type='info', max_entries=None, close=False):
+    """
+    追加一条批次日志
+    
+    max_entries 为每个批次保留的日志条数（环形缓冲），超出时删除最早的日志；None 表示不限制。
+    close 为 True 时，如果批次已完成（或已取消且没有执行中的任务），在同一个事务中把批次标记为已关闭：
+    这是批次的最后一条日志，进度推送读到这条日志后结束。
+    """
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('INSERT INTO batch_logs (batch_id, time, message, type) VALUES (?, ?, ?, ?)',
+                   (batch_id, datetime.now().isoformat(), message, log_type))
+    if close:
+        cursor.execute('''
+            UPDATE batch_jobs SET closed = 1 WHERE batch_id = ? AND (status = 'completed' OR (status = 'cancelled'
+                AND NOT EXISTS (SELECT 1 FROM batch_tasks WHERE batch_id = ? AND status = 'running')))
+        ''', (batch_id, batch_id))
+    if max_entries:
+        cursor.execute('''
+            DELETE FROM batch_logs WHERE batch_id = ? AND id <= (
+                SELECT id FROM batch_logs WHERE batch_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            )
+        ''', (batch_id, batch_id, max_entries))
+    conn.commit()
+    conn.close()
+
+
+def get_batch_log_stats():
+    """批次日志的总条数和单个批次的最多条数"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*), COUNT(DISTINCT batch_id) FROM batch_logs')
+    total, batches = cursor.fetchone()
+    cursor.execute('SELECT MAX(n) FROM (SELECT COUNT(*) AS n FROM batch_logs GROUP BY batch_id)')
+    largest = cursor.fetchone()[0] or 0
+    conn.close()
+    return {'entries': total, 'batches': batches, 'largest_batch': largest}
+
+
+def get_batch_job(batch_id, log_limit=100):
+    """查询批次进度和最近的日志，批次不存在时返回 None"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM batch_jobs WHERE batch_id = ?', (batch_id,))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return None
+    job = dict(row)
+    cursor.execute("SELECT COUNT(*) FROM batch_tasks WHERE batch_id = ? AND status = 'running'", (batch_id,))
+    job['running'] = cursor.fetchone()[0]
+    cursor.execute('SELECT time, message, type FROM batch_logs WHERE batch_id = ? ORDER BY id DESC LIMIT ?', (batch_id, log_limit))
+    job['logs'] = [dict(r) for r in reversed(cursor.fetchall())]
+    conn.close()
+    return job
+
+
+def get_batch_logs_after(batch_id, after_id=0, limit=500):
+    """读取批次中 ID 大于 after_id 的日志（按 ID 升序），用于增量推送"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, time, message, type FROM batch_logs WHERE batch_id = ? AND id > ? ORDER BY id LIMIT ?
+    ''', (batch_id, after_id, limit))
+    logs = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return logs
+
+
+def get_batch_records_after(batch_id, after_id=0, limit=200):
+    """读取批次中 ID 大于 after_id 的生成记录（按 ID 升序），用于增量推送新生成的图片"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, created_at, prompt, filename, image_path, width, height FROM generation_records
+        WHERE batch_id = ? AND id > ? ORDER BY id LIMIT ?
+    ''', (batch_id, after_id, limit))
+    records = [dict(r) for r in cursor.fetchall()]
+    conn.close()
+    return records
+
+
+def get_batch_queue_counts():
+    """按状态统计队列中的任务数"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('SELECT status, COUNT(*) FROM batch_tasks GROUP BY status')
+    counts = {status: count for status, count in cursor.fetchall()}
+    conn.close()
+    return counts
+
+
+def set_scheduler_user(user_id, weight=None, max_concurrency=None):
+    """设置用户的调度权重和并发上限（max_concurrency 为 0 表示不限制，None 表示使用全局默认值）"""
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR IGNORE INTO scheduler_users (user_id) VALUES (?)', (user_id,))
+    cursor.execute('UPDATE scheduler_users SET weight = ?, max_concurrency = ? WHERE user_id = ?',
+                   (weight if weight and weight > 0 else 1.0, max_concurrency, user_id))
+    conn.commit()
+    conn.close()
+
+
+def get_scheduler_state():
+    """返回每个用户的调度状态：权重、并发上限、虚拟时间、待执行 / 执行中的任务数和成本"""
+    now = time.time()
+    conn = _queue_connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT j.user_id, MAX(j.username) AS username,
+            SUM(CASE WHEN t.status = 'pending' OR (t.status = 'running' AND t.lease_expires_at < ?) THEN 1 ELSE 0 END) AS pending,
+            SUM(CASE WHEN t.status = 'pending' OR (t.status = 'running' AND t.lease_expires_at < ?) THEN t.cost ELSE 0 END) AS pending_cost,
+            SUM(CASE WHEN t.status = 'running' AND t.lease_expires_at >= ? THEN 1 ELSE 0 END) AS running,
+            SUM(CASE WHEN t.status = 'running' AND t.lease_expires_at >= ? THEN t.cost ELSE 0 END) AS running_cost
+        FROM batch_tasks t JOIN batch_jobs j ON j.batch_id = t.batch_id
+        WHERE t.status IN ('pending', 'running')
+        GROUP BY j.user_id
+    ''', (now, now, now, now))
+    users = {row['user_id']: dict(row) for row in cursor.fetchall()}
+    cursor.execute('SELECT * FROM scheduler_users WHERE user_id != ?', (SCHEDULER_CLOCK_ID,))
+    for row in cursor.fetchall():
+        entry = users.setdefault(row['user_id'], {
+            'user_id': row['user_id'], 'username': None,
+            'pending': 0, 'pending_cost': 0, 'running': 0, 'running_cost': 0,
+        })
+        entry['weight'] = row['weight']
+        entry['max_concurrency'] = row['max_concurrency']
+        entry['virtual_time'] = round(row['virtual_time'] or 0.0, 3)
+    missing = [user_id for user_id, entry in users.items() if not entry['username']]
+    if missing:
+        cursor.execute(f"SELECT id, username FROM users WHERE id IN ({','.join('?' * len(missing))})", missing)
+        for row in cursor.fetchall():
+            users[row['id']]['username'] = row['username']
+    conn.close()
+    for entry in users.values():
+        entry.setdefault('weight', 1.0)
+        entry.setdefault('max_concurrency', None)
+        entry.setdefault('virtual_time', 0.0)
+        entry['pending_cost'] = round(entry['pending_cost'] or 0, 3)
+        entry['running_cost'] = round(entry['running_cost'] or 0, 3)
+    return sorted(users.values(), key=lambda e: (e['virtual_time'], e['user_id']))
+
+
 def save_person_asset(user_id, filename, url, meta=None):
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
@@ -341,6 +1397,14 @@ def get_record_by_id(record_id):
     conn.close()
     return None
 
+def update_record_image_path(record_id, image_path):
+    """更新记录的图片地址（本地图片上传 OSS 后改为 OSS URL）"""
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute('UPDATE generation_records SET image_path = ? WHERE id = ?', (image_path, record_id))
+    conn.commit()
+    conn.close()
+
 def delete_record(record_id):
     """删除记录"""
     conn = sqlite3.connect(DB_PATH)
@@ -0,0 +1,144 @@
+"""
+服务器推送事件（SSE）- 单图生成和批量任务的增量进度推送
+
+每个任务（批次）对应一个频道，频道中的每个订阅者（推送连接）有自己的条件变量和待处理计数。
+发布方（写批次日志、保存图片、更新任务状态）只唤醒该频道的订阅者，订阅者被唤醒后读取上次之后的
+新事件（增量，带事件ID）推送给浏览器；两次事件之间订阅者阻塞在自己的条件变量上，不查询数据库也不占用 CPU。
+
+每隔 SSE_KEEPALIVE_INTERVAL 秒发送一次注释行保持连接（避免代理断开空闲连接），同时重新检查一次状态：
+多进程部署时其他进程发布的事件唤醒不了本进程的订阅者，最迟在这个间隔内送达。
+
+WSGI 没有异步响应，每个推送连接在整个任务期间占用一个处理请求的线程（阻塞在条件变量上，不占 CPU）：
+每个进程能同时打开的推送连接数受线程数限制（gunicorn 需使用 gthread 等多线程 worker，见 gunicorn.conf.py）。
+同时打开的连接数不超过 SSE_MAX_STREAMS，超出时拒绝连接，页面改为轮询，不会占满处理普通请求的线程。
+"""
+import contextlib
+import json
+import os
+import threading
+
+
+def keepalive_interval():
+    try:
+        return max(1.0, float(os.environ.get('SSE_KEEPALIVE_INTERVAL', 15)))
+    except (TypeError, ValueError):
+        return 15.0
+
+
+def max_streams():
+    """本进程同时打开的推送连接数上限，0 表示不限制"""
+    try:
+        return max(0, int(os.environ.get('SSE_MAX_STREAMS', 32)))
+    except (TypeError, ValueError):
+        return 32
+
+
+class _Subscriber:
+    __slots__ = ('cond', 'version')
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.version = 0
+
+
+_lock = threading.Lock()
+_channels = {}
+_active = {'streams': 0}
+_stats = {'published': 0, 'streams': 0, 'events': 0, 'rejected': 0}
+
+
+def acquire_stream():
+    """占用一个推送连接名额，已达 SSE_MAX_STREAMS 时返回 False（调用方拒绝连接，页面改为轮询）"""
+    limit = max_streams()
+    with _lock:
+        if limit and _active['streams'] >= limit:
+            _stats['rejected'] += 1
+            return False
+        _active['streams'] += 1
+        return True
+
+
+def release_stream():
+    """推送连接关闭时归还名额"""
+    with _lock:
+        _active['streams'] = max(0, _active['streams'] - 1)
+
+
+def publish(channel):
+    """通知频道的订阅者有新事件（没有订阅者时直接返回）"""
+    with _lock:
+        _stats['published'] += 1
+        subscribers = list(_channels.get(channel, ()))
+    for subscriber in subscribers:
+        with subscriber.cond:
+            subscriber.version += 1
+            subscriber.cond.notify()
+
+
+@contextlib.contextmanager
+def _subscribe(channel):
+    subscriber = _Subscriber()
+    with _lock:
+        _channels.setdefault(channel, set()).add(subscriber)
+        _stats['streams'] += 1
+    try:
+        yield subscriber
+    finally:
+        with _lock:
+            subscribers = _channels.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del _channels[channel]
+
+
+def format_event(event, data, event_id=None):
+    """格式化一条 SSE 消息"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    payload = json.dumps(data, ensure_ascii=False)
+    lines.extend(f'data: {line}' for line in payload.split('\n'))
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream(channel, poll, cursor=None):
+    """
+    生成 SSE 响应内容
+
+    poll(cursor) 返回 (events, cursor, finished)，events 为 (事件名, 数据, 事件ID) 列表；
+    连接建立、频道有发布或到达保活间隔时调用 poll，finished 为 True 时发送完事件后结束。
+    """
+    interval = keepalive_interval()
+    with _subscribe(channel) as subscriber:
+        # 先订阅、记下版本再读取：读取期间的发布会让下一次等待立即返回，不会漏掉事件
+        version = subscriber.version
+        # 浏览器断线重连的间隔（毫秒）
+        yield 'retry: 3000\n\n'
+        while True:
+            events, cursor, finished = poll(cursor)
+            for event, data, event_id in events:
+                yield format_event(event, data, event_id)
+            if events:
+                with _lock:
+                    _stats['events'] += len(events)
+            if finished:
+                return
+            with subscriber.cond:
+                if subscriber.version == version:
+                    subscriber.cond.wait(interval)
+                changed = subscriber.version != version
+                version = subscriber.version
+            if not changed:
+                yield ': keepalive\n\n'
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['channels'] = len(_channels)
+        stats['subscribers'] = sum(len(subscribers) for subscribers in _channels.values())
+        stats['active_streams'] = _active['streams']
+    stats['max_streams'] = max_streams()
+    return stats
@@ -0,0 +1,24 @@
+"""
+gunicorn 配置 - gunicorn -c gunicorn.conf.py web_app:app
+
+进度推送（SSE）连接在整个任务期间占用一个处理线程，默认的 sync worker 每个进程只能同时处理一个请求，
+一个打开的推送页面就会占满进程；这里使用 gthread worker，每个进程 GUNICORN_THREADS 个线程，
+推送连接数另由 SSE_MAX_STREAMS 限制（应小于线程数），超出时页面改为轮询。
+
+每个工作进程在启动后调用 web_app.init_app()（读取会话密钥、启动批量任务队列），
+多个工作进程共享状态时需要 STATE_BACKEND=sqlite（见 .env.example）。
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5050')
+workers = int(os.environ.get('GUNICORN_WORKERS', '2'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '64'))
+# 推送连接是长连接，不能按请求超时杀掉工作进程（gthread 下由心跳判断进程是否存活）
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = 5
+
+
+def post_worker_init(worker):
+    import web_app
+    web_app.init_app()
@@ -0,0 +1,267 @@
+"""
+图片流式下载 - 分块写入临时文件、边下载边计算 SHA-256，完成后原子重命名
+
+同时支持 b64_json 响应：分块解码 base64 直接写盘，并按响应方式（url / b64_json）统计耗时。
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import ark_clients
+
+CHUNK_SIZE = 256 * 1024
+# base64 每次解码的字符数（4 的倍数，对应 CHUNK_SIZE 字节）
+B64_CHUNK_CHARS = CHUNK_SIZE // 3 * 4
+
+_telemetry_lock = threading.Lock()
+_telemetry = {}
+
+
+class DownloadError(Exception):
+    """图片下载失败（状态码异常或传输中断）"""
+
+
+def get_timeouts():
+    """下载超时配置：(连接超时, 读取超时)，单位秒"""
+    try:
+        connect_timeout = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', '10'))
+        read_timeout = float(os.environ.get('DOWNLOAD_READ_TIMEOUT', '60'))
+    except ValueError:
+        connect_timeout, read_timeout = 10.0, 60.0
+    return connect_timeout, read_timeout
+
+
+def _open_temp_file(dest_path):
+    """在目标目录中创建临时文件（同一文件系统内 os.replace 才是原子的）"""
+    folder = os.path.dirname(dest_path) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(dest_path)}.", suffix='.part', dir=folder)
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+def _discard(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def file_digest(path):
+    """返回本地文件的 (字节数, SHA-256)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def download_image(url, dest_path, session=None):
+    """
+    流式下载图片到 dest_path
+
+    数据分块写入同目录下的临时文件，下载完成后用 os.replace 原子替换，
+    读取方不会看到写了一半的文件。
+
+    Returns:
+        dict: path, bytes, sha256, status_code, duration
+    """
+    session = session or ark_clients.get_http_session()
+    start = time.time()
+
+    with session.get(url, stream=True, timeout=get_timeouts()) as response:
+        if response.status_code != 200:
+            raise DownloadError(f"下载失败，状态码: {response.status_code}")
+
+        digest = hashlib.sha256()
+        size = 0
+        fh, tmp_path = _open_temp_file(dest_path)
+        try:
+            with fh:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    fh.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            _discard(tmp_path)
+            raise
+
+    return {
+        'path': dest_path,
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+        'status_code': response.status_code,
+        'duration': time.time() - start,
+    }
+
+
+async def download_image_async(url, dest_path):
+    """download_image 的异步版本，使用共享的 httpx.AsyncClient 流式读取"""
+    client = ark_clients.get_async_http_client()
+    if client is None:
+        # 没有 httpx 时在线程中使用共享的 requests 会话
+        return await asyncio.to_thread(download_image, url, dest_path)
+
+    connect_timeout, read_timeout = get_timeouts()
+    timeout = ark_clients.httpx.Timeout(read_timeout, connect=connect_timeout)
+    start = time.time()
+
+    async with client.stream('GET', url, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise DownloadError(f"下载失败，状态码: {response.status_code}")
+
+        digest = hashlib.sha256()
+        size = 0
+        fh, tmp_path = _open_temp_file(dest_path)
+        try:
+            with fh:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    fh.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            _discard(tmp_path)
+            raise
+
+    return {
+        'path': dest_path,
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+        'status_code': response.status_code,
+        'duration': time.time() - start,
+    }
+
+
+def save_b64_image(data, dest_path):
+    """
+    将 b64_json 响应分块解码写入 dest_path
+
+    每次只解码一小段，内存中不会同时存在完整的编码串副本和解码后的图片；
+    写入方式与 download_image 相同（临时文件 + 原子重命名）。
+    """
+    start = time.time()
+    if data.startswith('data:'):
+        data = data.split(',', 1)[-1]
+    if '\n' in data or '\r' in data:
+        # 带换行的编码串会打乱分块边界，先去掉空白
+        data = ''.join(data.split())
+
+    digest = hashlib.sha256()
+    size = 0
+    fh, tmp_path = _open_temp_file(dest_path)
+    try:
+        with fh:
+            for offset in range(0, len(data), B64_CHUNK_CHARS):
+                try:
+                    chunk = base64.b64decode(data[offset:offset + B64_CHUNK_CHARS], validate=True)
+                except (binascii.Error, ValueError) as e:
+                    raise DownloadError(f"base64 解码失败: {e}")
+                fh.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+        if size == 0:
+            raise DownloadError("b64_json 响应为空")
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        _discard(tmp_path)
+        raise
+
+    return {
+        'path': dest_path,
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+        'status_code': 200,
+        'duration': time.time() - start,
+    }
+
+
+def _mode_stats(mode):
+    return _telemetry.setdefault(mode, {
+        'api_calls': 0,
+        'api_images': 0,
+        'api_seconds': 0.0,
+        'fetches': 0,
+        'fetch_seconds': 0.0,
+        'bytes': 0,
+    })
+
+
+def record_api_time(mode, seconds, images=1):
+    """记录一次生成 API 调用的耗时（组图调用的 images 为返回的图片数）"""
+    with _telemetry_lock:
+        stats = _mode_stats(mode)
+        stats['api_calls'] += 1
+        stats['api_images'] += images
+        stats['api_seconds'] += seconds
+
+
+def _record_fetch(mode, seconds, size):
+    with _telemetry_lock:
+        stats = _mode_stats(mode)
+        stats['fetches'] += 1
+        stats['fetch_seconds'] += seconds
+        stats['bytes'] += size
+
+
+def get_telemetry():
+    """按响应方式汇总：平均 API 耗时、平均下载/解码耗时、平均端到端耗时（每张图片）"""
+    result = {}
+    with _telemetry_lock:
+        for mode, stats in _telemetry.items():
+            item = dict(stats)
+            api_avg = stats['api_seconds'] / stats['api_images'] if stats['api_images'] else 0.0
+            fetch_avg = stats['fetch_seconds'] / stats['fetches'] if stats['fetches'] else 0.0
+            item['avg_api_seconds'] = round(api_avg, 3)
+            item['avg_fetch_seconds'] = round(fetch_avg, 3)
+            item['avg_end_to_end_seconds'] = round(api_avg + fetch_avg, 3)
+            item['avg_kb'] = round(stats['bytes'] / stats['fetches'] / 1024, 2) if stats['fetches'] else 0.0
+            result[mode] = item
+    return result
+
+
+def _image_source(image):
+    b64 = getattr(image, 'b64_json', None)
+    if b64:
+        return 'b64_json', b64
+    url = getattr(image, 'url', None)
+    if url:
+        return 'url', url
+    raise DownloadError("响应中没有图片数据")
+
+
+def save_image(image, dest_path, session=None):
+    """
+    保存 API 返回的一张图片（response.data 中的元素）
+
+    b64_json 响应直接解码写盘，url 响应流式下载；返回值在 download_image 的基础上增加 mode。
+    """
+    mode, source = _image_source(image)
+    if mode == 'b64_json':
+        result = save_b64_image(source, dest_path)
+    else:
+        result = download_image(source, dest_path, session=session)
+    result['mode'] = mode
+    _record_fetch(mode, result['duration'], result['bytes'])
+    return result
+
+
+async def save_image_async(image, dest_path):
+    """save_image 的异步版本（base64 解码放到线程中，不阻塞事件循环）"""
+    mode, source = _image_source(image)
+    if mode == 'b64_json':
+        result = await asyncio.to_thread(save_b64_image, source, dest_path)
+    else:
+        result = await download_image_async(source, dest_path)
+    result['mode'] = mode
+    _record_fetch(mode, result['duration'], result['bytes'])
+    return result
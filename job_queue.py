@@ -0,0 +1,221 @@
+"""
+持久化批量任务队列 - 批次和任务保存在 SQLite 中，工作线程按租约领取任务并定期续约（心跳）
+
+进程重启、重新部署或崩溃后，未完成的任务在租约过期（正常退出时立即）后被重新领取，
+并跳过已经完成的图片，从中断处继续生成。
+
+所有批次共用同一组工作线程，领取时在用户之间按任务成本（图片数 x 分辨率）做加权公平调度，
+一个用户提交再多的批次也只能分到自己的份额；每个用户同时执行的任务数可以设置上限。
+
+服务端导入的批次边导入边执行，导入线程定期刷新导入心跳；心跳超时（导入所在的进程已退出）的批次
+由心跳线程结束导入，已写入的任务照常执行。
+"""
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+
+import database
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_settings():
+    """读取队列配置"""
+    lease_seconds = max(5.0, _env_float('BATCH_LEASE_SECONDS', 60))
+    return {
+        'lease_seconds': lease_seconds,
+        # 心跳间隔默认为租约的 1/4，续约失败几次也不会过期
+        'heartbeat_interval': max(1.0, _env_float('BATCH_HEARTBEAT_INTERVAL', lease_seconds / 4)),
+        'poll_interval': max(0.1, _env_float('BATCH_QUEUE_POLL_INTERVAL', 2)),
+        # 同一任务因进程中断被领取超过这么多次后标记失败，避免一个会导致崩溃的任务反复执行
+        'max_attempts': max(1, int(_env_float('BATCH_TASK_MAX_ATTEMPTS', 3))),
+        # 每个用户同时执行的任务数上限（0 表示不限制；可在调度接口中按用户单独设置）
+        'user_max_concurrency': max(0, int(_env_float('BATCH_USER_MAX_CONCURRENCY', 0))),
+    }
+
+
+class JobQueue:
+    """
+    从数据库领取批量任务并执行
+
+    runner(claim) 执行一个任务并返回 {'success': bool, 'error': str}；
+    on_result(claim, result) 在任务结束后调用，负责写回结果和日志；
+    on_stale_import(batch_id) 在导入心跳超时时调用，负责结束导入并写日志。
+    """
+
+    def __init__(self, runner, on_result, workers, on_stale_import=None):
+        self.runner = runner
+        self.on_result = on_result
+        self.on_stale_import = on_stale_import
+        self.workers = max(1, workers)
+        self.settings = get_settings()
+        # 租约持有者：主机名 + 进程号 + 随机后缀，同一主机上的多个进程互不冲突
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._cond = threading.Condition()
+        self._active = set()
+        self._started = False
+        self.stats = {
+            'claimed': 0,
+            'resumed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'abandoned': 0,
+            'stopped': 0,
+            'heartbeats': 0,
+            'lost_leases': 0,
+            'stale_imports': 0,
+        }
+
+    def start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        for n in range(self.workers):
+            threading.Thread(target=self._worker, name=f'batch-queue-{n}', daemon=True).start()
+        threading.Thread(target=self._heartbeat, name='batch-queue-heartbeat', daemon=True).start()
+        atexit.register(self._release)
+        print(f"批量任务队列已启动: {self.workers} 个工作线程，租约 {self.settings['lease_seconds']:.0f} 秒 ({self.owner})")
+
+    def notify(self):
+        """有新任务入队时唤醒空闲的工作线程"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    def _worker(self):
+        while True:
+            try:
+                claim = database.claim_batch_task(self.owner, self.settings['lease_seconds'], self.settings['user_max_concurrency'])
+            except Exception as e:
+                print(f"领取批量任务失败: {e}")
+                claim = None
+            if claim is None:
+                with self._cond:
+                    self._cond.wait(self.settings['poll_interval'])
+                continue
+
+            with self._cond:
+                self._active.add(claim['id'])
+                self.stats['claimed'] += 1
+                if claim['attempts'] > 1:
+                    self.stats['resumed'] += 1
+            try:
+                self._run(claim)
+            finally:
+                with self._cond:
+                    self._active.discard(claim['id'])
+                    # 任务结束后用户的并发名额释放，唤醒其他空闲工作线程重新调度
+                    self._cond.notify_all()
+
+    def _run(self, claim):
+        try:
+            claim['done_images'] = database.get_batch_task_done_images(claim['id'])
+            if claim['attempts'] > self.settings['max_attempts']:
+                self._count('abandoned')
+                result = {'success': False, 'error': f"任务执行中断 {claim['attempts'] - 1} 次，不再重试"}
+            else:
+                result = self.runner(claim)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+
+        if result.get('stopped'):
+            # 批次被暂停或取消，任务在图片之间停止
+            self._count('stopped')
+        else:
+            self._count('succeeded' if result.get('success') else 'failed')
+        try:
+            self.on_result(claim, result)
+        except Exception as e:
+            # 结果没有写回时任务保持 running，租约过期后会被重新领取
+            print(f"批量任务结果写入失败: {e}")
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.settings['heartbeat_interval'])
+            self._recover_imports()
+            with self._cond:
+                task_ids = list(self._active)
+            if not task_ids:
+                continue
+            try:
+                renewed = database.renew_batch_leases(self.owner, task_ids, self.settings['lease_seconds'])
+            except Exception as e:
+                print(f"批量任务续约失败: {e}")
+                continue
+            with self._cond:
+                self.stats['heartbeats'] += 1
+                self.stats['lost_leases'] += len(task_ids) - renewed
+
+    def _recover_imports(self):
+        if self.on_stale_import is None:
+            return
+        try:
+            batch_ids = database.get_stale_batch_imports(self.settings['lease_seconds'])
+        except Exception as e:
+            print(f"检查批次导入状态失败: {e}")
+            return
+        for batch_id in batch_ids:
+            try:
+                self.on_stale_import(batch_id)
+                self._count('stale_imports')
+            except Exception as e:
+                print(f"结束中断的批次导入失败: {e}")
+
+    def _release(self):
+        try:
+            released = database.release_batch_leases(self.owner)
+            if released:
+                print(f"进程退出，{released} 个批量任务已放回队列")
+        except Exception as e:
+            print(f"释放批量任务租约失败: {e}")
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self.stats)
+            stats['active'] = len(self._active)
+        stats['workers'] = self.workers
+        stats['owner'] = self.owner
+        stats['settings'] = self.settings
+        try:
+            stats['tasks'] = database.get_batch_queue_counts()
+            stats['scheduler'] = database.get_scheduler_state()
+        except Exception as e:
+            stats['tasks'] = {'error': str(e)}
+        return stats
+
+
+_lock = threading.Lock()
+_queue = None
+
+
+def start(runner, on_result, workers, on_stale_import=None):
+    """创建并启动进程级队列（重复调用只启动一次）"""
+    global _queue
+    with _lock:
+        if _queue is None:
+            _queue = JobQueue(runner, on_result, workers, on_stale_import)
+        queue = _queue
+    queue.start()
+    return queue
+
+
+def notify():
+    if _queue is not None:
+        _queue.notify()
+
+
+def get_stats():
+    return _queue.get_stats() if _queue is not None else None
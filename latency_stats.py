@@ -0,0 +1,100 @@
+"""
+生成耗时统计 - 按模型和请求尺寸记录 API 调用耗时和图片下载耗时，持久化到数据库
+
+耗时先在内存中累计，每 LATENCY_FLUSH_SECONDS 秒（以及进程退出时）合并写入 generation_timings 表，
+不在每次调用时写库；表中的累计值按 LATENCY_HALF_LIFE_HOURS 半衰期衰减，平均值以最近的耗时为主。
+批量预估（/api/batch/estimate）按这些历史耗时预测批次的 API 调用数和总耗时。
+"""
+import atexit
+import os
+import threading
+import time
+
+import database
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_pending = {}
+_last_flush = time.time()
+_stats = {
+    'flushes': 0,
+    'flush_errors': 0,
+    'api_samples': 0,
+    'download_samples': 0,
+}
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_settings():
+    return {
+        'flush_seconds': max(1.0, _env_float('LATENCY_FLUSH_SECONDS', 30)),
+        'half_life_hours': max(0.0, _env_float('LATENCY_HALF_LIFE_HOURS', 24)),
+    }
+
+
+def _add(model, size, counter, **values):
+    global _last_flush
+    with _lock:
+        _stats[counter] += 1
+        sample = _pending.setdefault((model, size), {})
+        for column, value in values.items():
+            sample[column] = sample.get(column, 0) + value
+        due = time.time() - _last_flush >= get_settings()['flush_seconds']
+        if due:
+            _last_flush = time.time()
+    if due:
+        flush()
+
+
+def record_api(model, size, seconds, images=1):
+    """记录一次生成 API 调用的耗时（组图调用的 images 为返回的图片数）"""
+    _add(model, size, 'api_samples', api_calls=1, api_images=images, api_seconds=seconds)
+
+
+def record_download(model, size, seconds):
+    """记录一张图片的下载（或 b64_json 解码写盘）耗时"""
+    _add(model, size, 'download_samples', downloads=1, download_seconds=seconds)
+
+
+def flush():
+    """把内存中累计的耗时写入数据库，写入失败时保留到下次"""
+    global _pending
+    with _flush_lock:
+        with _lock:
+            samples, _pending = _pending, {}
+        if not samples:
+            return
+        try:
+            database.merge_generation_timings(samples, get_settings()['half_life_hours'] * 3600)
+            _stats['flushes'] += 1
+        except Exception as e:
+            _stats['flush_errors'] += 1
+            print(f"写入生成耗时统计失败: {e}")
+            with _lock:
+                for key, sample in samples.items():
+                    pending = _pending.setdefault(key, {})
+                    for column, value in sample.items():
+                        pending[column] = pending.get(column, 0) + value
+
+
+def get_timings(model=None):
+    """先写入内存中的样本，再返回数据库中按模型和尺寸汇总的平均耗时"""
+    flush()
+    return database.get_generation_timings(model)
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+        stats['pending_samples'] = sum(int(sample.get('api_calls', 0) + sample.get('downloads', 0)) for sample in _pending.values())
+    stats['settings'] = get_settings()
+    return stats
+
+
+atexit.register(flush)
@@ -0,0 +1,109 @@
+"""
+分阶段生成流水线 - 每个阶段有独立的有界队列和工作线程，阶段之间通过队列形成背压
+"""
+import queue
+import threading
+import time
+
+
+class PipelineStage:
+    """流水线中的一个阶段"""
+
+    def __init__(self, name, handler, workers=1, queue_size=32):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.next_stage = None
+
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0
+        self.total_seconds = 0.0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'processed': self.processed,
+                'failed': self.failed,
+                'avg_seconds': round(self.total_seconds / self.processed, 3) if self.processed else 0.0,
+            }
+
+
+class StagedPipeline:
+    """
+    分阶段流水线
+
+    任务（dict）从第一个阶段进入，每个阶段的 handler 处理后返回：
+    - dict：交给下一阶段
+    - list：拆分成多个任务交给下一阶段
+    - None：任务已由 handler 自行结束，不再向下传递
+
+    handler 抛出异常或任务走完最后一个阶段时，调用任务中的 on_done(job, error)。
+    下游队列已满时上游工作线程会阻塞等待，慢阶段不会无限堆积任务。
+    """
+
+    def __init__(self, stages, name='pipeline'):
+        self.name = name
+        self.stages = stages
+        for current, following in zip(stages, stages[1:]):
+            current.next_stage = following
+
+        for stage in stages:
+            for n in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._worker, args=(stage,), name=f'{name}-{stage.name}-{n}', daemon=True
+                )
+                thread.start()
+
+    def submit(self, job, timeout=None):
+        """提交任务到第一个阶段，队列满时阻塞（背压）"""
+        self.stages[0].queue.put(job, timeout=timeout)
+
+    def _finish(self, job, error):
+        callback = job.get('on_done')
+        if callback is None:
+            return
+        try:
+            callback(job, error)
+        except Exception as e:
+            print(f"流水线回调执行失败: {e}")
+
+    def _worker(self, stage):
+        while True:
+            job = stage.queue.get()
+            with stage._lock:
+                stage.busy += 1
+            start = time.time()
+            try:
+                result = stage.handler(job)
+            except Exception as e:
+                with stage._lock:
+                    stage.failed += 1
+                self._finish(job, e)
+                continue
+            finally:
+                with stage._lock:
+                    stage.busy -= 1
+                    stage.processed += 1
+                    stage.total_seconds += time.time() - start
+                stage.queue.task_done()
+
+            if result is None:
+                continue
+            outputs = result if isinstance(result, list) else [result]
+            for output in outputs:
+                if stage.next_stage is None:
+                    self._finish(output, None)
+                else:
+                    stage.next_stage.queue.put(output)
+
+    def get_stats(self):
+        """返回各阶段的队列长度、忙碌线程数与处理统计"""
+        return [stage.get_stats() for stage in self.stages]
@@ -0,0 +1,418 @@
+"""
+方舟 API 全局限流 - 令牌桶控制请求速率，AIMD 根据 429 / 5xx 自动调整并发上限
+
+所有图片生成调用（单图、批量、组图）共用同一个限流器：
+- 令牌桶：平均速率 ARK_RATE_LIMIT_RPS，突发 ARK_RATE_LIMIT_BURST
+- 并发上限：成功时缓慢增加（加性增），被限流或服务端错误时减半（乘性减）
+- Retry-After：收到后在指定时间内暂停发出新请求
+- 被限流的请求按 Retry-After（或指数退避）重试，不再直接丢弃
+- 优先级：interactive（页面上的单图生成）> batch（批量任务）> backfill（后台补量），
+  有高优先级请求在等待时低优先级请求不能拿到名额，批量任务在两张图片之间让出；
+  并发上限中预留 ARK_INTERACTIVE_RESERVED 个名额只给 interactive 使用
+"""
+import asyncio
+import collections
+import contextlib
+import contextvars
+import os
+import random
+import threading
+import time
+
+import openai
+
+# 连续降速之间的最短间隔，避免同一波并发的多个 429 把并发上限一次压到最低
+DECREASE_COOLDOWN = 1.0
+
+# 优先级从高到低
+PRIORITY_CLASSES = ('interactive', 'batch', 'backfill')
+
+_priority = contextvars.ContextVar('ark_priority', default='batch')
+# 外层（retry_policy）负责重试时为 True：限流器不再自行重试，避免两层重试相乘
+_external_retries = contextvars.ContextVar('ark_external_retries', default=False)
+
+
+@contextlib.contextmanager
+def priority(name):
+    """在 with 块内发出的 API 调用使用指定的优先级"""
+    token = _priority.set(name if name in PRIORITY_CLASSES else 'batch')
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextlib.contextmanager
+def external_retries():
+    """with 块内的 API 调用由调用方负责重试（429 / 5xx 时限流器只调整并发和暂停，直接抛出异常）"""
+    token = _external_retries.set(True)
+    try:
+        yield
+    finally:
+        _external_retries.reset(token)
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class AdaptiveLimiter:
+    """令牌桶 + AIMD 并发控制"""
+
+    def __init__(self, rate, burst, initial, minimum, maximum, reserved=0, interactive_slo=None):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.minimum = max(1.0, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+
+        self._cond = threading.Condition()
+        self.tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        self.reserved = max(0, int(reserved))
+        self.interactive_slo = interactive_slo
+        self.waiting_by_class = dict.fromkeys(PRIORITY_CLASSES, 0)
+        # 等待名额的协程：(事件循环, future)，名额变化时由 _notify_locked 唤醒
+        self._async_waiters = []
+        self.lanes = {
+            name: {'acquired': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+                   'slo_violations': 0, 'recent': collections.deque(maxlen=500)}
+            for name in PRIORITY_CLASSES
+        }
+
+        self.stats = {
+            'acquired': 0,
+            'succeeded': 0,
+            'throttled_429': 0,
+            'server_errors': 0,
+            'retries': 0,
+            'dropped': 0,
+            'cancelled': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _try_acquire_locked(self, now, lane):
+        """尝试占用一个名额，成功返回 0，否则返回建议等待的秒数"""
+        self._refill(now)
+        if now < self.paused_until:
+            return self.paused_until - now
+        # 更高优先级的请求在等待时先让它们拿名额
+        rank = PRIORITY_CLASSES.index(lane)
+        if any(self.waiting_by_class[name] for name in PRIORITY_CLASSES[:rank]):
+            # 高优先级请求离开等待队列时会唤醒等待者，这里的时间只是兜底
+            return 0.5
+        limit = int(self.limit)
+        if lane != 'interactive':
+            limit = max(1, limit - self.reserved)
+        if self.in_flight >= limit:
+            return 0.5
+        if self.rate > 0 and self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        if self.rate > 0:
+            self.tokens -= 1
+        self.in_flight += 1
+        self.stats['acquired'] += 1
+        return 0
+
+    def _record_wait(self, waited, lane):
+        self.stats['wait_seconds_total'] += waited
+        self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
+        stats = self.lanes[lane]
+        stats['acquired'] += 1
+        stats['wait_seconds_total'] += waited
+        stats['wait_seconds_max'] = max(stats['wait_seconds_max'], waited)
+        stats['recent'].append(waited)
+        if lane == 'interactive' and self.interactive_slo and waited > self.interactive_slo:
+            stats['slo_violations'] += 1
+
+    def _enter_wait(self, lane):
+        self.waiting += 1
+        self.waiting_by_class[lane] += 1
+
+    def _leave_wait(self, lane):
+        self.waiting -= 1
+        self.waiting_by_class[lane] -= 1
+        # 高优先级请求离开等待队列后，被它挡住的低优先级请求可以继续
+        self._notify_locked()
+
+    def _notify_locked(self):
+        """唤醒等待名额的线程和协程（调用方持有 self._cond）"""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+    def acquire(self, lane=None):
+        """阻塞直到拿到名额，返回等待时间（秒）；lane 默认为当前上下文的优先级"""
+        lane = lane or current_priority()
+        start = time.monotonic()
+        with self._cond:
+            self._enter_wait(lane)
+            try:
+                while True:
+                    wait = self._try_acquire_locked(time.monotonic(), lane)
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+            finally:
+                self._leave_wait(lane)
+            waited = time.monotonic() - start
+            self._record_wait(waited, lane)
+        return waited
+
+    async def acquire_async(self, lane=None):
+        """
+        acquire 的异步版本，等待期间让出事件循环
+
+        名额归还或高优先级请求离开等待队列时立即被唤醒（不轮询），
+        等令牌补充或 Retry-After 暂停结束时按计算出的时间等待。
+        """
+        lane = lane or current_priority()
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        with self._cond:
+            self._enter_wait(lane)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_acquire_locked(time.monotonic(), lane)
+                    if wait == 0:
+                        break
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait((waiter,), timeout=wait)
+                finally:
+                    with self._cond:
+                        if (loop, waiter) in self._async_waiters:
+                            self._async_waiters.remove((loop, waiter))
+        finally:
+            with self._cond:
+                self._leave_wait(lane)
+        waited = time.monotonic() - start
+        with self._cond:
+            self._record_wait(waited, lane)
+        return waited
+
+    def release(self, outcome, retry_after=None):
+        """
+        归还名额并根据结果调整并发上限
+
+        outcome: success（加性增）、throttled / server_error（乘性减）、error（不调整）、
+        cancelled（调用被取消，如对冲请求中输掉的一方，不调整）
+        """
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == 'success':
+                self.stats['succeeded'] += 1
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            elif outcome in ('throttled', 'server_error'):
+                self.stats['throttled_429' if outcome == 'throttled' else 'server_errors'] += 1
+                if now - self._last_decrease >= DECREASE_COOLDOWN:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif outcome == 'cancelled':
+                self.stats['cancelled'] += 1
+            self._notify_locked()
+
+    def count(self, key):
+        with self._cond:
+            self.stats[key] += 1
+
+    def _lane_stats(self, name):
+        stats = self.lanes[name]
+        recent = sorted(stats['recent'])
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            'waiting': self.waiting_by_class[name],
+            'acquired': stats['acquired'],
+            'avg_wait_ms': round(stats['wait_seconds_total'] / stats['acquired'] * 1000, 1) if stats['acquired'] else 0.0,
+            'p95_wait_ms': round(p95 * 1000, 1),
+            'max_wait_ms': round(stats['wait_seconds_max'] * 1000, 1),
+            'slo_violations': stats['slo_violations'],
+        }
+
+    def get_stats(self):
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            stats = dict(self.stats)
+            stats.update({
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'tokens': round(self.tokens, 2),
+                'rate': self.rate,
+                'burst': self.burst,
+                'min_limit': self.minimum,
+                'max_limit': self.maximum,
+                'paused_seconds': round(max(0.0, self.paused_until - now), 2),
+                'interactive_reserved': self.reserved,
+                'interactive_wait_slo': self.interactive_slo,
+                'lanes': {name: self._lane_stats(name) for name in PRIORITY_CLASSES},
+            })
+        stats['avg_wait_ms'] = round(stats['wait_seconds_total'] / stats['acquired'] * 1000, 1) if stats['acquired'] else 0.0
+        stats['wait_seconds_total'] = round(stats['wait_seconds_total'], 3)
+        stats['wait_seconds_max'] = round(stats['wait_seconds_max'], 3)
+        return stats
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_lock = threading.Lock()
+_limiter = None
+
+
+def get_limiter():
+    """获取进程级限流器（首次调用时按环境变量创建）"""
+    global _limiter
+    with _lock:
+        if _limiter is None:
+            _limiter = AdaptiveLimiter(
+                rate=_env_float('ARK_RATE_LIMIT_RPS', 8),
+                burst=_env_float('ARK_RATE_LIMIT_BURST', 16),
+                initial=_env_float('ARK_CONCURRENCY_INITIAL', 8),
+                minimum=_env_float('ARK_CONCURRENCY_MIN', 1),
+                maximum=_env_float('ARK_CONCURRENCY_MAX', 32),
+                reserved=_env_float('ARK_INTERACTIVE_RESERVED', 1),
+                interactive_slo=_env_float('ARK_INTERACTIVE_WAIT_SLO', 2.0),
+            )
+        return _limiter
+
+
+def get_max_retries():
+    if _external_retries.get():
+        return 0
+    try:
+        return max(0, int(os.environ.get('ARK_THROTTLE_RETRIES', '3')))
+    except ValueError:
+        return 3
+
+
+def retry_after(error):
+    """解析 Retry-After 响应头（秒），没有或无法解析时返回 None"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+    return None
+
+
+def classify(error):
+    """判断异常属于限流（throttled）、服务端错误（server_error）还是其他错误（error）"""
+    if isinstance(error, openai.RateLimitError):
+        return 'throttled'
+    if isinstance(error, openai.APIStatusError) and getattr(error, 'status_code', 0) >= 500:
+        return 'server_error'
+    return 'error'
+
+
+def _backoff(attempt, retry_after):
+    if retry_after is not None:
+        return retry_after
+    return min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def call(func, *args, **kwargs):
+    """
+    在限流器下执行一次 API 调用
+
+    429 / 5xx 按 Retry-After 或指数退避重试 ARK_THROTTLE_RETRIES 次，用完后抛出原始异常；
+    在 external_retries() 内（由 retry_policy 调用时）不重试，由外层统一重试并计入重试预算。
+    """
+    limiter = get_limiter()
+    max_retries = get_max_retries()
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            outcome = classify(e)
+            delay = retry_after(e) if outcome != 'error' else None
+            limiter.release(outcome, delay)
+            if outcome == 'error' or attempt >= max_retries:
+                if outcome != 'error':
+                    limiter.count('dropped')
+                raise
+            limiter.count('retries')
+            time.sleep(_backoff(attempt, delay))
+            attempt += 1
+            continue
+        except BaseException:
+            limiter.release('cancelled')
+            raise
+        limiter.release('success')
+        return result
+
+
+async def call_async(func, *args, **kwargs):
+    """call 的异步版本，func 返回协程"""
+    limiter = get_limiter()
+    max_retries = get_max_retries()
+    attempt = 0
+    while True:
+        await limiter.acquire_async()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            outcome = classify(e)
+            delay = retry_after(e) if outcome != 'error' else None
+            limiter.release(outcome, delay)
+            if outcome == 'error' or attempt >= max_retries:
+                if outcome != 'error':
+                    limiter.count('dropped')
+                raise
+            limiter.count('retries')
+            await asyncio.sleep(_backoff(attempt, delay))
+            attempt += 1
+            continue
+        except BaseException:
+            # 被取消（对冲请求中输掉的一方会被取消）时也要归还名额，否则 in_flight 不再减少
+            limiter.release('cancelled')
+            raise
+        limiter.release('success')
+        return result
+
+
+def get_stats():
+    return get_limiter().get_stats()
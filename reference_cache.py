@@ -0,0 +1,276 @@
+"""
+参考图预处理缓存 - 示例图 / 人物库 / 场景库 / 上传图片在发送给模型前统一预处理：
+按模型有用的最大输入尺寸缩小、去掉元数据、转成体积更小的格式，按内容哈希缓存复用
+
+原图只从两处读取：服务端自己传入的本地路径（刚上传的图片），或允许列表中的 http(s) 地址
+（OSS_ENDPOINT 与 REFERENCE_ALLOWED_HOSTS），不读取请求中给出的本地路径，也不访问其他地址。
+同一 URL 的内容可能被覆盖，URL 到内容的对应关系超过 REFERENCE_URL_TTL 秒后按 ETag / Last-Modified 重新验证。
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+from PIL import Image, ImageOps
+
+import ark_clients
+import database
+import image_download
+import singleflight
+
+_lock = threading.Lock()
+_stats = {
+    'url_hits': 0,
+    'revalidated': 0,
+    'content_hits': 0,
+    'rejected': 0,
+    'passed_through': 0,
+    'prepared': 0,
+    'failed': 0,
+    'original_bytes': 0,
+    'prepared_bytes': 0,
+}
+
+
+def get_settings():
+    """读取预处理配置"""
+    fmt = os.environ.get('REFERENCE_FORMAT', 'jpeg').lower()
+    if fmt not in ('jpeg', 'webp'):
+        fmt = 'jpeg'
+    try:
+        max_side = max(256, int(os.environ.get('REFERENCE_MAX_SIDE', '2048')))
+        quality = min(100, max(50, int(os.environ.get('REFERENCE_QUALITY', '90'))))
+        url_ttl = max(0.0, float(os.environ.get('REFERENCE_URL_TTL', '300')))
+    except ValueError:
+        max_side, quality, url_ttl = 2048, 90, 300.0
+    return {
+        'enabled': os.environ.get('REFERENCE_PREPROCESS', 'true').lower() == 'true',
+        'max_side': max_side,
+        'format': fmt,
+        'quality': quality,
+        # auto：有上传函数（启用 OSS）时上传预处理后的图片并传 URL，否则在 base64 比原图小时内联、
+        # 不比原图小时传原 URL（由模型自己下载）；base64：始终内联
+        'delivery': os.environ.get('REFERENCE_DELIVERY', 'auto').lower(),
+        'cache_dir': os.environ.get('REFERENCE_CACHE_DIR', os.path.join('output', 'reference_cache')),
+        # URL 到内容的对应关系在这么多秒内直接使用，超过后重新验证
+        'url_ttl': url_ttl,
+        'allowed_hosts': allowed_hosts(),
+    }
+
+
+def allowed_hosts():
+    """允许服务端下载参考图的主机：OSS 存储桶域名和 REFERENCE_ALLOWED_HOSTS（逗号分隔）"""
+    hosts = [h.strip().lower() for h in os.environ.get('REFERENCE_ALLOWED_HOSTS', '').split(',') if h.strip()]
+    oss_endpoint = os.environ.get('OSS_ENDPOINT', 'shor-file.oss-cn-wulanchabu.aliyuncs.com').strip().lower()
+    if oss_endpoint:
+        hosts.append(oss_endpoint)
+    return hosts
+
+
+def is_allowed_source(source):
+    """只允许 http(s) 且主机在允许列表中的地址"""
+    try:
+        parsed = urlparse(source)
+    except (TypeError, ValueError):
+        return False
+    return parsed.scheme in ('http', 'https') and (parsed.hostname or '') in allowed_hosts()
+
+
+class SourceNotAllowed(ValueError):
+    """参考图地址不在允许列表中（或不是 http(s) 地址）"""
+
+
+def _variant(settings):
+    return f"{settings['max_side']}-{settings['format']}-{settings['quality']}"
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _fetch_source(source, known=None):
+    """
+    下载原图，返回 (字节, ETag, Last-Modified)；内容与 known 记录的相同（304）时字节为 None
+
+    不跟随重定向，避免允许列表中的地址跳转到内网或其他主机。
+    """
+    if not is_allowed_source(source):
+        raise SourceNotAllowed(f"参考图地址不在允许列表中: {source}")
+    headers = {}
+    if known and known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known and known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+    response = ark_clients.get_http_session().get(
+        source, headers=headers, timeout=image_download.get_timeouts(), allow_redirects=False
+    )
+    if response.status_code == 304 and headers:
+        return None, known.get('etag'), known.get('last_modified')
+    if response.status_code != 200:
+        raise image_download.DownloadError(f"参考图下载失败，状态码: {response.status_code}")
+    return response.content, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+
+def _preprocess(data, settings):
+    """缩小到 max_side、按 EXIF 方向摆正后去掉元数据，重新编码"""
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        img.thumbnail((settings['max_side'], settings['max_side']), Image.LANCZOS)
+        out = io.BytesIO()
+        # 重新编码时不传 exif / icc_profile，元数据随之去掉
+        img.save(out, format=settings['format'].upper(), quality=settings['quality'], optimize=True)
+        return out.getvalue(), img.size
+
+
+def _is_http(source):
+    return urlparse(str(source)).scheme in ('http', 'https')
+
+
+def _deliverable(entry, settings, source):
+    """
+    返回发送给模型的参考图：预处理后上传得到的 URL、原 URL 或 base64 data URL
+
+    没有上传得到的 URL 时，内联的 base64（预处理后体积的 4/3）不比原图小就传原 URL，
+    只有 delivery=base64、来源不是 http(s) 地址或内联更小时才内联。
+    """
+    if entry.get('prepared_url'):
+        return entry['prepared_url']
+    encoded_bytes = (entry['prepared_bytes'] + 2) // 3 * 4
+    if settings['delivery'] != 'base64' and _is_http(source) and encoded_bytes >= entry['original_bytes']:
+        _count('passed_through')
+        return source
+    with open(entry['prepared_path'], 'rb') as fh:
+        encoded = base64.b64encode(fh.read()).decode('ascii')
+    return f"data:image/{settings['format']};base64,{encoded}"
+
+
+def _cached_entry(cache_key):
+    entry = database.get_reference_image(cache_key)
+    if entry and os.path.exists(entry['prepared_path']):
+        return entry
+    return None
+
+
+def _prepare_one(source, settings, local_path=None, uploader=None):
+    variant = _variant(settings)
+    etag = last_modified = None
+
+    if local_path:
+        # 服务端传入的本地文件（刚上传的图片），直接读取
+        with open(local_path, 'rb') as fh:
+            data = fh.read()
+    else:
+        # 同一 URL 之前处理过：在有效期内直接使用，过期后按 ETag / Last-Modified 验证内容是否变化
+        known = database.get_reference_source(source, variant)
+        entry = _cached_entry(known['cache_key']) if known else None
+        if entry and time.time() - (known['checked_at'] or 0) < settings['url_ttl']:
+            database.touch_reference_image(entry['cache_key'])
+            _count('url_hits')
+            return entry
+        data, etag, last_modified = _fetch_source(source, known if entry else None)
+        if data is None:
+            database.save_reference_source(source, variant, entry['cache_key'], etag, last_modified)
+            database.touch_reference_image(entry['cache_key'])
+            _count('revalidated')
+            return entry
+
+    cache_key = f"{hashlib.sha256(data).hexdigest()}:{variant}"
+
+    def build():
+        # 内容相同的参考图（不同 URL / 重复上传）直接复用
+        existing = _cached_entry(cache_key)
+        if existing:
+            database.touch_reference_image(cache_key, source)
+            _count('content_hits')
+            return existing
+
+        prepared, (width, height) = _preprocess(data, settings)
+        ext = 'jpg' if settings['format'] == 'jpeg' else settings['format']
+        os.makedirs(settings['cache_dir'], exist_ok=True)
+        prepared_path = os.path.join(settings['cache_dir'], f"ref_{cache_key[:32]}_{variant}.{ext}")
+        fh, tmp_path = image_download._open_temp_file(prepared_path)
+        with fh:
+            fh.write(prepared)
+        os.replace(tmp_path, prepared_path)
+
+        prepared_url = None
+        if uploader:
+            prepared_url = uploader(prepared_path)
+
+        entry = {
+            'cache_key': cache_key,
+            'source_url': source,
+            'prepared_path': prepared_path,
+            'prepared_url': prepared_url,
+            'original_bytes': len(data),
+            'prepared_bytes': len(prepared),
+            'width': width,
+            'height': height,
+        }
+        database.save_reference_image(entry)
+        _count('prepared')
+        _count('original_bytes', len(data))
+        _count('prepared_bytes', len(prepared))
+        return entry
+
+    # 多个任务同时使用同一张新参考图时只处理一次
+    entry, _ = singleflight.get_group('reference-prepare').do(cache_key, build)
+    if not local_path:
+        database.save_reference_source(source, variant, cache_key, etag, last_modified)
+    return entry
+
+
+def prepare(sources, local_paths=None, uploader=None, with_keys=False):
+    """
+    预处理参考图，返回可直接放进 API 请求 image 字段的列表（URL 或 data URL）
+
+    with_keys 为 True 时返回 (列表, 内容键列表)，内容键为原图的内容哈希 + 预处理参数，
+    未经预处理（关闭预处理、处理失败或原样传给模型）的图片为 None。
+
+    Args:
+        sources: 原图 URL 列表
+        local_paths: {URL: 本地文件路径}，服务端刚保存的上传图片，直接读取不用重新下载
+        uploader: 上传函数（本地路径 -> URL），为 None 时按 _deliverable 内联或传原 URL
+    单张处理失败时退回原 URL（由模型自己下载），不影响生成；不在允许列表中的来源
+    （其他主机、data URL 等非 http(s) 地址）不在服务端读取，原样传给模型。
+    返回的列表与 sources 一一对应。
+    """
+    settings = get_settings()
+    sources = list(sources or [])
+    if not settings['enabled']:
+        return (sources, [None] * len(sources)) if with_keys else sources
+    if settings['delivery'] == 'base64':
+        uploader = None
+
+    prepared = []
+    keys = []
+    for source in sources:
+        try:
+            entry = _prepare_one(source, settings, (local_paths or {}).get(source), uploader)
+            prepared.append(_deliverable(entry, settings, source))
+            keys.append(entry['cache_key'])
+        except SourceNotAllowed as e:
+            _count('rejected')
+            print(f"{e}，不在服务端读取，原样传给模型")
+            prepared.append(source)
+            keys.append(None)
+        except Exception as e:
+            _count('failed')
+            print(f"参考图预处理失败，使用原图: {source} ({e})")
+            prepared.append(source)
+            keys.append(None)
+    return (prepared, keys) if with_keys else prepared
+
+
+def get_stats():
+    with _lock:
+        stats = dict(_stats)
+    stats['bytes_saved'] = max(0, stats['original_bytes'] - stats['prepared_bytes'])
+    stats['settings'] = get_settings()
+    return stats
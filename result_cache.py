@@ -0,0 +1,133 @@
+"""
+生成结果缓存 - 按规范化后的 API 请求内容寻址，完全相同的确定性请求直接使用已保存的图片
+
+缓存文件保存在 RESULT_CACHE_DIR 下（按键的前两位分目录），索引记录在 generation_cache 表中；
+总大小超过 RESULT_CACHE_MAX_MB 时按最近访问时间淘汰。
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import database
+
+_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    'bypassed': 0,
+}
+
+
+def is_enabled():
+    return os.environ.get('RESULT_CACHE_ENABLED', 'true').lower() == 'true'
+
+
+def get_cache_dir():
+    return os.environ.get('RESULT_CACHE_DIR', os.path.join('output', 'cache'))
+
+
+def get_max_bytes():
+    try:
+        return int(float(os.environ.get('RESULT_CACHE_MAX_MB', '1024')) * 1024 * 1024)
+    except ValueError:
+        return 1024 * 1024 * 1024
+
+
+def make_key(request_params):
+    """对实际发送给 API 的参数做规范化 JSON 序列化后取 SHA-256"""
+    canonical = json.dumps(request_params, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dest):
+    """优先硬链接（不占额外空间），跨文件系统时复制；通过临时名 + os.replace 原子落盘"""
+    folder = os.path.dirname(dest) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(dest)}.", suffix='.part', dir=folder)
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def record_bypass():
+    with _lock:
+        _stats['bypassed'] += 1
+
+
+def lookup(cache_key, dest_path):
+    """
+    查找缓存，命中时把缓存图片放到 dest_path 并返回缓存条目，未命中返回 None
+
+    索引存在但文件已丢失时删除该索引，按未命中处理。
+    """
+    entry = database.get_cache_entry(cache_key)
+    if entry and os.path.exists(entry['file_path']):
+        _link_or_copy(entry['file_path'], dest_path)
+        database.touch_cache_entry(cache_key)
+        with _lock:
+            _stats['hits'] += 1
+        return entry
+
+    if entry:
+        database.delete_cache_entry(cache_key)
+    with _lock:
+        _stats['misses'] += 1
+    return None
+
+
+def store(cache_key, src_path, size, sha256):
+    """把新生成的图片加入缓存，超过容量上限时淘汰最久未访问的条目"""
+    ext = os.path.splitext(src_path)[1] or '.jpg'
+    cache_path = os.path.join(get_cache_dir(), cache_key[:2], cache_key + ext)
+    _link_or_copy(src_path, cache_path)
+    database.save_cache_entry(cache_key, cache_path, size, sha256)
+    with _lock:
+        _stats['stores'] += 1
+    evict()
+
+
+def evict():
+    """按 LRU 淘汰缓存，直到总大小不超过上限"""
+    max_bytes = get_max_bytes()
+    with _lock:
+        _, total = database.get_cache_usage()
+        while total > max_bytes:
+            entries = database.get_lru_cache_entries()
+            if not entries:
+                break
+            for entry in entries:
+                if total <= max_bytes:
+                    break
+                try:
+                    os.remove(entry['file_path'])
+                except OSError:
+                    pass
+                database.delete_cache_entry(entry['cache_key'])
+                total -= entry['bytes'] or 0
+                _stats['evictions'] += 1
+
+
+def get_stats():
+    """返回命中/未命中计数与缓存占用"""
+    with _lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+    stats['entries'], stats['bytes'] = database.get_cache_usage()
+    stats['max_bytes'] = get_max_bytes()
+    stats['enabled'] = is_enabled()
+    return stats
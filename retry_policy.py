@@ -0,0 +1,254 @@
+"""
+API 调用重试与对冲 - 指数退避（带抖动）重试失败调用，慢调用超过 p95 延迟时发出对冲请求
+
+重试和对冲共用一个预算：每次正常调用向预算存入 ARK_RETRY_BUDGET_RATIO 个额度，
+每次重试 / 对冲消耗 1 个，余额上限为 ARK_RETRY_BUDGET_RESERVE，避免故障时重试放大流量。
+经过这里的调用只在这一层重试：限流器在 external_retries() 内不再自行重试 429 / 5xx，
+被限流时按 Retry-After 等待后重试，同样计入预算。
+"""
+import asyncio
+import collections
+import contextvars
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import openai
+
+import rate_limiter
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_settings():
+    """读取重试 / 对冲配置"""
+    return {
+        'max_attempts': max(1, int(_env_float('ARK_RETRY_ATTEMPTS', 3))),
+        'base_delay': _env_float('ARK_RETRY_BASE_DELAY', 0.5),
+        'max_delay': _env_float('ARK_RETRY_MAX_DELAY', 8.0),
+        'hedge_enabled': os.environ.get('ARK_HEDGE_ENABLED', 'false').lower() == 'true',
+        'hedge_min_delay': _env_float('ARK_HEDGE_MIN_DELAY', 2.0),
+        'hedge_min_samples': int(_env_float('ARK_HEDGE_MIN_SAMPLES', 20)),
+        'budget_ratio': _env_float('ARK_RETRY_BUDGET_RATIO', 0.2),
+        'budget_reserve': _env_float('ARK_RETRY_BUDGET_RESERVE', 10),
+    }
+
+
+_lock = threading.Lock()
+_latencies = collections.deque(maxlen=500)
+_budget = {'balance': None}
+_stats = {
+    'calls': 0,
+    'retries': 0,
+    'retry_successes': 0,
+    'hedges': 0,
+    'hedge_wins': 0,
+    'budget_denied': 0,
+    'failures': 0,
+}
+_hedge_executor = None
+
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+
+
+def _deposit(settings):
+    with _lock:
+        if _budget['balance'] is None:
+            _budget['balance'] = settings['budget_reserve']
+        _budget['balance'] = min(settings['budget_reserve'], _budget['balance'] + settings['budget_ratio'])
+        _stats['calls'] += 1
+
+
+def _withdraw():
+    """从预算中取出一次重试 / 对冲的额度，余额不足时返回 False"""
+    with _lock:
+        if (_budget['balance'] or 0) >= 1:
+            _budget['balance'] -= 1
+            return True
+        _stats['budget_denied'] += 1
+        return False
+
+
+def _record_latency(seconds):
+    with _lock:
+        _latencies.append(seconds)
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def _hedge_delay(settings):
+    """返回发出对冲请求前的等待时间；未开启、样本不足或限流器正在排队时返回 None"""
+    if not settings['hedge_enabled']:
+        return None
+    with _lock:
+        if len(_latencies) < settings['hedge_min_samples']:
+            return None
+        p95 = _percentile(_latencies, 0.95)
+    # 限流器已有请求在排队时不再对冲，避免加重拥塞
+    if rate_limiter.get_limiter().waiting > 0:
+        return None
+    return max(p95, settings['hedge_min_delay'])
+
+
+def is_retryable(error):
+    """连接错误、超时、429 和 5xx 可以重试；参数错误、内容审核、鉴权失败等不重试"""
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return rate_limiter.classify(error) in ('throttled', 'server_error')
+
+
+def _backoff(settings, attempt, error=None):
+    # full jitter：在 [0, min(上限, 基数 * 2^n)] 内随机等待；服务端给出 Retry-After 时至少等待这么久
+    delay = random.uniform(0, min(settings['max_delay'], settings['base_delay'] * 2 ** attempt))
+    retry_after = rate_limiter.retry_after(error) if error is not None else None
+    return max(delay, retry_after or 0.0)
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _lock:
+        if _hedge_executor is None:
+            workers = max(2, int(_env_float('ARK_HEDGE_WORKERS', 32)))
+            _hedge_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hedge')
+        return _hedge_executor
+
+
+def _run_hedged(func, delay):
+    executor = _get_hedge_executor()
+    # 在调用方的上下文副本中执行，保留 API 调用的优先级
+    primary = executor.submit(contextvars.copy_context().run, func)
+    done, _ = wait([primary], timeout=delay)
+    if done or not _withdraw():
+        return primary.result()
+
+    _count('hedges')
+    hedge = executor.submit(contextvars.copy_context().run, func)
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # 同步请求无法中途取消，落后的一方完成后结果直接丢弃
+                if future is hedge:
+                    _count('hedge_wins')
+                return future.result()
+            first_error = first_error or future.exception()
+    raise first_error
+
+
+async def _run_hedged_async(func, delay):
+    primary = asyncio.ensure_future(func())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not _withdraw():
+        return await primary
+
+    _count('hedges')
+    hedge = asyncio.ensure_future(func())
+    pending = {primary, hedge}
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge:
+                        _count('hedge_wins')
+                    return task.result()
+                first_error = first_error or task.exception()
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def call(func, hedge=True):
+    """
+    执行 func()，失败时按退避策略重试，开启对冲时慢调用会发出一次对冲请求
+
+    func 应当是完整的一次 API 调用（含限流），可能被并发执行两次；
+    hedge 为 False 时不对冲（如一次请求多张图片的组图调用）。
+    """
+    with rate_limiter.external_retries():
+        return _call(func, hedge)
+
+
+def _call(func, hedge):
+    settings = get_settings()
+    _deposit(settings)
+    attempt = 0
+    while True:
+        start = time.time()
+        try:
+            delay = _hedge_delay(settings) if hedge else None
+            result = _run_hedged(func, delay) if delay else func()
+        except Exception as e:
+            if not is_retryable(e) or attempt + 1 >= settings['max_attempts'] or not _withdraw():
+                _count('failures')
+                raise
+            _count('retries')
+            time.sleep(_backoff(settings, attempt, e))
+            attempt += 1
+            continue
+        _record_latency(time.time() - start)
+        if attempt:
+            _count('retry_successes')
+        return result
+
+
+async def call_async(func, hedge=True):
+    """call 的异步版本，func 返回协程"""
+    with rate_limiter.external_retries():
+        return await _call_async(func, hedge)
+
+
+async def _call_async(func, hedge):
+    settings = get_settings()
+    _deposit(settings)
+    attempt = 0
+    while True:
+        start = time.time()
+        try:
+            delay = _hedge_delay(settings) if hedge else None
+            result = await (_run_hedged_async(func, delay) if delay else func())
+        except Exception as e:
+            if not is_retryable(e) or attempt + 1 >= settings['max_attempts'] or not _withdraw():
+                _count('failures')
+                raise
+            _count('retries')
+            await asyncio.sleep(_backoff(settings, attempt, e))
+            attempt += 1
+            continue
+        _record_latency(time.time() - start)
+        if attempt:
+            _count('retry_successes')
+        return result
+
+
+def get_stats():
+    """返回重试 / 对冲计数、预算余额和延迟分位数"""
+    with _lock:
+        stats = dict(_stats)
+        samples = list(_latencies)
+        stats['budget_balance'] = round(_budget['balance'] or 0, 2)
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        value = _percentile(samples, q)
+        stats[f'latency_{name}'] = round(value, 3) if value is not None else None
+    stats['latency_samples'] = len(samples)
+    stats['settings'] = get_settings()
+    return stats
@@ -0,0 +1,94 @@
+"""
+进行中请求合并（singleflight） - 相同的请求同时到达时只执行一次，其余请求等待并共用结果
+"""
+import hashlib
+import json
+import threading
+
+_registry_lock = threading.Lock()
+_groups = {}
+
+
+def make_key(*parts):
+    """对请求内容做规范化 JSON 序列化后取 SHA-256"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """按键合并进行中的调用"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {
+            'executed': 0,
+            'coalesced': 0,
+            'saved_calls': 0,
+        }
+
+    def do(self, key, func, weight=1):
+        """
+        执行 func()；同一个 key 已在执行时等待其完成并返回同一个结果
+
+        weight 为该请求对应的上游调用数（如图片张数），用于统计节省的调用次数。
+        Returns:
+            (result, shared): shared 为 True 表示结果来自其他请求
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.stats['coalesced'] += 1
+                self.stats['saved_calls'] += weight
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.stats['executed'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._calls)
+        return stats
+
+
+def get_group(name):
+    """获取（或创建）指定名称的合并组"""
+    with _registry_lock:
+        group = _groups.get(name)
+        if group is None:
+            group = _groups[name] = SingleFlight(name)
+        return group
+
+
+def get_stats():
+    with _registry_lock:
+        groups = list(_groups.values())
+    return {group.name: group.get_stats() for group in groups}
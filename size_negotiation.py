@@ -0,0 +1,137 @@
+"""
+分辨率协商 - 把 (宽高比, 分辨率) 映射成模型支持的最小且能覆盖所需尺寸的像素尺寸，
+模型生成的图片大于需要时在本地线程池中居中裁剪并缩放到请求尺寸
+"""
+import asyncio
+import math
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_constraints():
+    """
+    模型的尺寸约束（默认值为 doubao-seedream-4.5：总像素 2560x1440 ~ 4096x4096）
+    """
+    return {
+        'min_pixels': _env_int('ARK_MIN_PIXELS', 2560 * 1440),
+        'max_pixels': _env_int('ARK_MAX_PIXELS', 4096 * 4096),
+        'multiple': max(1, _env_int('ARK_SIZE_MULTIPLE', 8)),
+    }
+
+
+def local_resize_enabled():
+    return os.environ.get('ARK_LOCAL_RESIZE', 'true').lower() == 'true'
+
+
+def negotiate(width, height):
+    """
+    计算发送给模型的尺寸
+
+    Returns:
+        dict: requested_width/requested_height（请求尺寸）、actual_width/actual_height（模型生成尺寸）、
+              size（传给 API 的 "宽x高"）、needs_resize（是否需要本地缩放到请求尺寸）
+    """
+    c = get_constraints()
+    pixels = width * height
+    scale = 1.0
+    if pixels < c['min_pixels']:
+        scale = math.sqrt(c['min_pixels'] / pixels)
+    elif pixels > c['max_pixels']:
+        scale = math.sqrt(c['max_pixels'] / pixels)
+
+    m = c['multiple']
+    if pixels > c['max_pixels']:
+        # 超过上限时只能尽量接近（向下取整，保证不超出）
+        actual_w = max(m, int(width * scale) // m * m)
+        actual_h = max(m, int(height * scale) // m * m)
+    else:
+        # 向上取整到倍数，保证能覆盖请求尺寸且不少于最小像素
+        actual_w = math.ceil(width * scale / m) * m
+        actual_h = math.ceil(height * scale / m) * m
+
+    return {
+        'requested_width': width,
+        'requested_height': height,
+        'actual_width': actual_w,
+        'actual_height': actual_h,
+        'size': f"{actual_w}x{actual_h}",
+        'needs_resize': (actual_w, actual_h) != (width, height),
+    }
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            workers = max(1, _env_int('RESIZE_WORKERS', min(4, os.cpu_count() or 1)))
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resize')
+        return _executor
+
+
+def _fit(path, width, height):
+    """居中裁剪到目标宽高比后缩放，原子替换原文件；返回 (原始宽, 原始高)"""
+    with Image.open(path) as img:
+        original = img.size
+        if original == (width, height):
+            return original
+        src_w, src_h = original
+        target_ratio = width / height
+        if src_w / src_h > target_ratio:
+            crop_w = round(src_h * target_ratio)
+            left = (src_w - crop_w) // 2
+            box = (left, 0, left + crop_w, src_h)
+        else:
+            crop_h = round(src_w / target_ratio)
+            top = (src_h - crop_h) // 2
+            box = (0, top, src_w, top + crop_h)
+        fmt = img.format or 'JPEG'
+        resized = img.convert('RGB') if fmt == 'JPEG' and img.mode not in ('RGB', 'L') else img
+        resized = resized.resize((width, height), Image.LANCZOS, box=box)
+
+    folder = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.part', dir=folder)
+    os.close(fd)
+    try:
+        resized.save(tmp_path, format=fmt, quality=95)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return original
+
+
+def fit_image(path, negotiation):
+    """
+    按协商结果把图片缩放到请求尺寸（在缩放线程池中执行，限制同时占用的 CPU）
+
+    Returns:
+        (actual_width, actual_height): 模型实际生成的尺寸
+    """
+    if not (negotiation['needs_resize'] and local_resize_enabled()):
+        return negotiation['actual_width'], negotiation['actual_height']
+    return _get_executor().submit(
+        _fit, path, negotiation['requested_width'], negotiation['requested_height']
+    ).result()
+
+
+async def fit_image_async(path, negotiation):
+    """fit_image 的异步版本"""
+    if not (negotiation['needs_resize'] and local_resize_enabled()):
+        return negotiation['actual_width'], negotiation['actual_height']
+    future = _get_executor().submit(_fit, path, negotiation['requested_width'], negotiation['requested_height'])
+    return await asyncio.wrap_future(future)
@@ -0,0 +1,296 @@
+"""
+任务状态存储 - 单图生成任务等运行状态的可插拔后端
+
+- memory（默认）：保存在当前进程内，只适合单进程部署
+- sqlite：保存在共享的 SQLite 文件中，多个工作进程（如 gunicorn -w 4）看到同一份状态，
+  状态查询落到任何一个进程都能拿到结果，不需要粘性路由
+
+STATE_BACKEND 选择后端，STATE_DB_PATH 指定 sqlite 后端的文件（默认与生成记录同一个数据库）。
+
+两种后端都有上限，长时间运行的服务内存不会随处理过的任务数增长：
+- memory 后端超过 STATE_TTL_SECONDS 未更新的状态（通常是已结束的任务）、以及超出 STATE_MAX_ENTRIES
+  的最久未更新的状态转存到 SQLite，之后的读取和修改直接在数据库中进行，调用方无感知
+- 数据库中超过 STATE_RETENTION_SECONDS 未更新的状态被删除
+"""
+import collections
+import copy
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+import database
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class MemoryStateStore:
+    """
+    进程内状态存储
+
+    按最近更新时间排序；超过 ttl 秒未更新或超出 max_entries 的状态转存到 spill（SqliteStateStore），
+    spill 为 None 时直接丢弃。
+    """
+
+    backend = 'memory'
+
+    def __init__(self, namespace, ttl=None, max_entries=None, spill=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.spill = spill
+        self._lock = threading.Lock()
+        # key -> [状态, 最近更新时间]，最久未更新的在前
+        self._data = collections.OrderedDict()
+        self.stats = {'evicted': 0, 'spill_reads': 0}
+
+    def _touch_locked(self, key, state):
+        self._data[key] = [state, time.time()]
+        self._data.move_to_end(key)
+        self._evict_locked()
+
+    def _evict_locked(self):
+        # 在锁内转存，转存过程中其他线程不会在内存和数据库中都找不到这个状态
+        deadline = time.time() - self.ttl if self.ttl else None
+        while self._data:
+            key, (state, updated_at) = next(iter(self._data.items()))
+            over_cap = self.max_entries and len(self._data) > self.max_entries
+            expired = deadline is not None and updated_at < deadline
+            if not (over_cap or expired):
+                break
+            del self._data[key]
+            self.stats['evicted'] += 1
+            if self.spill is not None:
+                try:
+                    self.spill.set(key, state)
+                except Exception as e:
+                    print(f"任务状态转存失败: {e}")
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                return copy.deepcopy(entry[0])
+        if self.spill is None:
+            return None
+        value = self.spill.get(key)
+        if value is not None:
+            with self._lock:
+                self.stats['spill_reads'] += 1
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._touch_locked(key, copy.deepcopy(value))
+
+    def update(self, key, func):
+        """
+        原子地修改已存在的状态：func(state) 直接修改传入的字典
+
+        key 不存在时不调用 func，返回 None；否则返回修改后的状态副本。
+        已转存的状态在数据库中原子修改。
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                state = entry[0]
+                func(state)
+                self._touch_locked(key, state)
+                return copy.deepcopy(state)
+        return self.spill.update(key, func) if self.spill is not None else None
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        if self.spill is not None:
+            self.spill.delete(key)
+
+    def sweep(self):
+        """转存已过期的状态（写入时也会顺带检查）"""
+        with self._lock:
+            self._evict_locked()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get_stats(self):
+        self.sweep()
+        with self._lock:
+            stats = dict(self.stats, backend=self.backend, entries=len(self._data),
+                         max_entries=self.max_entries, ttl_seconds=self.ttl)
+        if self.spill is not None:
+            stats['spilled'] = self.spill.get_stats()
+        return stats
+
+
+class SqliteStateStore:
+    """基于共享 SQLite 文件的状态存储，多个进程之间通过写事务保证 update 的原子性"""
+
+    backend = 'sqlite'
+
+    # 两次清理过期状态之间的最短间隔（秒）
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, namespace, path, retention=None):
+        self.namespace = namespace
+        self.path = path
+        self.retention = retention
+        self._last_prune = 0.0
+        self.pruned = 0
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_state (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at REAL,
+                PRIMARY KEY (namespace, key)
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute('SELECT value FROM task_state WHERE namespace = ? AND key = ?', (self.namespace, key)).fetchone()
+        conn.close()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO task_state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)',
+                     (self.namespace, key, json.dumps(value, ensure_ascii=False), time.time()))
+        conn.commit()
+        conn.close()
+        self._maybe_prune()
+
+    def _maybe_prune(self):
+        """删除超过保留时间未更新的状态（每个进程最多每分钟一次）"""
+        now = time.time()
+        if not self.retention or now - self._last_prune < self.PRUNE_INTERVAL:
+            return
+        self._last_prune = now
+        conn = self._connect()
+        cursor = conn.execute('DELETE FROM task_state WHERE namespace = ? AND updated_at < ?', (self.namespace, now - self.retention))
+        self.pruned += cursor.rowcount
+        conn.commit()
+        conn.close()
+
+    def update(self, key, func):
+        """与 MemoryStateStore.update 相同；读取和写回在同一个写事务中，其他进程的修改不会丢失"""
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT value FROM task_state WHERE namespace = ? AND key = ?', (self.namespace, key)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            state = json.loads(row[0])
+            func(state)
+            conn.execute('UPDATE task_state SET value = ?, updated_at = ? WHERE namespace = ? AND key = ?',
+                         (json.dumps(state, ensure_ascii=False), time.time(), self.namespace, key))
+            conn.execute('COMMIT')
+            return state
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def delete(self, key):
+        conn = self._connect()
+        conn.execute('DELETE FROM task_state WHERE namespace = ? AND key = ?', (self.namespace, key))
+        conn.commit()
+        conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        count = conn.execute('SELECT COUNT(*) FROM task_state WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+        conn.close()
+        return count
+
+    def get_stats(self):
+        return {'backend': self.backend, 'entries': len(self), 'retention_seconds': self.retention, 'pruned': self.pruned}
+
+
+def get_backend():
+    backend = os.environ.get('STATE_BACKEND', 'memory').lower()
+    if backend not in ('memory', 'sqlite'):
+        print(f"⚠️  不支持的 STATE_BACKEND: {backend}，使用 memory")
+        backend = 'memory'
+    return backend
+
+
+_lock = threading.Lock()
+_stores = {}
+
+
+def get_store(namespace):
+    """获取（或创建）指定命名空间的状态存储，后端由 STATE_BACKEND 决定"""
+    with _lock:
+        store = _stores.get(namespace)
+        if store is None:
+            path = os.environ.get('STATE_DB_PATH', database.DB_PATH)
+            # 默认保留 7 天，0 表示不清理
+            retention = _env_float('STATE_RETENTION_SECONDS', 7 * 24 * 3600) or None
+            if get_backend() == 'sqlite':
+                store = SqliteStateStore(namespace, path, retention)
+            else:
+                store = MemoryStateStore(
+                    namespace,
+                    ttl=_env_float('STATE_TTL_SECONDS', 600) or None,
+                    max_entries=int(_env_float('STATE_MAX_ENTRIES', 1000)) or None,
+                    spill=SqliteStateStore(namespace, path, retention),
+                )
+            _stores[namespace] = store
+        return store
+
+
+def get_stats():
+    """各命名空间状态存储的当前大小"""
+    with _lock:
+        stores = dict(_stores)
+    return {namespace: store.get_stats() for namespace, store in stores.items()}
+
+
+def load_secret_key(path=None):
+    """
+    返回会话签名密钥：优先使用 SECRET_KEY，否则读取（首次时生成）SECRET_KEY_FILE
+
+    每个进程随机生成密钥时，多进程部署下会话在进程之间无法通用（请求落到其他进程就变成未登录）；
+    密钥文件用 O_EXCL 创建，多个进程同时启动时只有一个写入，其余读取同一个密钥。
+    """
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+
+    path = path or os.environ.get('SECRET_KEY_FILE', '.secret_key')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(path, 'r', encoding='utf-8') as fh:
+                key = fh.read().strip()
+            if key:
+                return key
+            # 其他进程刚创建文件、尚未写入
+            time.sleep(0.1)
+        raise RuntimeError(f"密钥文件为空: {path}")
+
+    key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+        fh.write(key)
+    print(f"⚠️  未配置 SECRET_KEY，已生成密钥文件 {path}（多台机器部署时请在环境变量中配置相同的 SECRET_KEY）")
+    return key
@@ -0,0 +1,77 @@
+"""
+测试 b64_json 响应：分块解码直接写盘，不再下载一次
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import types
+
+import pytest
+
+import image_download
+
+
+def _image(data=None, url=None):
+    return types.SimpleNamespace(b64_json=data, url=url)
+
+
+def test_decodes_across_chunk_boundaries(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_download, 'B64_CHUNK_CHARS', 8)
+    payload = os.urandom(1000)
+    dest = tmp_path / 'out.jpg'
+    result = image_download.save_b64_image(base64.b64encode(payload).decode(), str(dest))
+    assert dest.read_bytes() == payload
+    assert result['bytes'] == len(payload)
+    assert result['sha256'] == hashlib.sha256(payload).hexdigest()
+
+
+def test_accepts_data_url_and_line_breaks(tmp_path):
+    payload = os.urandom(300)
+    encoded = base64.encodebytes(payload).decode()
+    assert '\n' in encoded
+    dest = tmp_path / 'out.jpg'
+    image_download.save_b64_image('data:image/jpeg;base64,' + encoded, str(dest))
+    assert dest.read_bytes() == payload
+
+
+@pytest.mark.parametrize('data', ['not base64!!', ''])
+def test_bad_payload_leaves_no_file(tmp_path, data):
+    dest = tmp_path / 'out.jpg'
+    with pytest.raises(image_download.DownloadError):
+        image_download.save_b64_image(data, str(dest))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save_image_prefers_b64_without_download(tmp_path, monkeypatch):
+    def no_download(*args, **kwargs):
+        raise AssertionError('b64_json 响应不应再下载')
+
+    monkeypatch.setattr(image_download, 'download_image', no_download)
+    payload = os.urandom(64)
+    image = _image(base64.b64encode(payload).decode(), url='https://example.com/a.jpg')
+    result = image_download.save_image(image, str(tmp_path / 'out.jpg'))
+    assert result['mode'] == 'b64_json'
+    assert image_download.get_telemetry()['b64_json']['fetches'] >= 1
+
+
+def test_save_image_async_b64(tmp_path):
+    payload = os.urandom(64)
+    dest = tmp_path / 'out.jpg'
+    result = asyncio.run(image_download.save_image_async(_image(base64.b64encode(payload).decode()), str(dest)))
+    assert result['mode'] == 'b64_json' and dest.read_bytes() == payload
+
+
+def test_response_without_image_data(tmp_path):
+    with pytest.raises(image_download.DownloadError):
+        image_download.save_image(_image(), str(tmp_path / 'out.jpg'))
+
+
+def test_generate_requests_b64_json(client, fake_ark, wait_for_task):
+    """ARK_RESPONSE_FORMAT=b64_json 时请求参数带上 response_format，图片直接解码保存"""
+    test_client, user_id = client
+    response = test_client.post('/generate', data={'prompt': '一只猫', 'output_filename': 'cat'})
+    task = wait_for_task(test_client, response.get_json()['task_id'])
+    assert task['status'] == 'completed'
+    assert fake_ark.calls[0]['response_format'] == 'b64_json'
+    assert task['result']['images'][0]['url'] == f'/output/{user_id}/cat.jpg'
@@ -0,0 +1,94 @@
+"""
+测试批次的暂停 / 继续 / 取消：队列中的状态变化和 HTTP 接口
+"""
+
+
+def _create(db, batch_id='b1', tasks=2, user_id=1):
+    db.create_batch_job(batch_id, user_id, 'tester', [{'prompt': f'p{i}'} for i in range(tasks)])
+
+
+def test_pause_stops_claims_and_requeues_running_task(db):
+    _create(db)
+    claim = db.claim_batch_task('w1', 60)
+    assert db.set_batch_job_paused('b1', True)
+    assert db.claim_batch_task('w2', 60) is None
+
+    progress = db.stop_batch_task(claim['id'], 'w1')
+    assert progress['task_status'] == 'pending'
+    assert db.set_batch_job_paused('b1', False)
+    resumed = db.claim_batch_task('w2', 60)
+    assert resumed['id'] == claim['id']
+    # 暂停不计入中断次数
+    assert resumed['attempts'] == 1
+
+
+def test_cancel_marks_pending_and_running_tasks(db):
+    _create(db, tasks=3)
+    claim = db.claim_batch_task('w1', 60)
+    assert db.cancel_batch_job('b1') == 2
+    assert db.claim_batch_task('w2', 60) is None
+    progress = db.stop_batch_task(claim['id'], 'w1')
+    assert progress['task_status'] == 'cancelled'
+    assert progress['cancelled'] == 3
+    assert db.cancel_batch_job('b1') is None
+
+
+def test_pause_resume_cancel_endpoints(client, db):
+    test_client, user_id = client
+    _create(db, tasks=2, user_id=user_id)
+
+    assert test_client.post('/api/batch/b1/resume').status_code == 409
+    response = test_client.post('/api/batch/b1/pause')
+    assert response.get_json() == {'success': True, 'status': 'paused'}
+    assert db.get_batch_job_status('b1') == 'paused'
+    assert test_client.post('/api/batch/b1/pause').status_code == 409
+
+    assert test_client.post('/api/batch/b1/resume').get_json()['status'] == 'running'
+    assert db.claim_batch_task('w1', 60) is not None
+
+    body = test_client.post('/api/batch/b1/cancel').get_json()
+    assert body['status'] == 'cancelled' and body['cancelled_tasks'] == 1
+    assert test_client.post('/api/batch/b1/cancel').status_code == 409
+    assert test_client.post('/api/batch/b1/resume').status_code == 409
+
+    logs = [entry['message'] for entry in db.get_batch_job('b1')['logs']]
+    assert any('暂停' in message for message in logs) and any('取消' in message for message in logs)
+
+
+def test_control_endpoints_check_owner(client, db):
+    test_client, user_id = client
+    _create(db, user_id=user_id + 1)
+    for action in ('pause', 'resume', 'cancel'):
+        assert test_client.post(f'/api/batch/b1/{action}').status_code == 403
+        assert test_client.post(f'/api/batch/missing/{action}').status_code == 404
+    assert db.get_batch_job_status('b1') == 'running'
+
+
+def test_pause_stops_running_task_between_images(web_app_module, db, client, fake_ark, tmp_path, monkeypatch):
+    """执行中的任务在两张图片之间停止，已完成的图片在继续后不再生成"""
+    monkeypatch.chdir(tmp_path)
+    _, user_id = client
+    task = {'prompt': '一只猫', 'num_images': 3, 'aspect_ratio': '1:1', 'resolution': '2k'}
+    db.create_batch_job('b1', user_id, 'tester', [task])
+    generate = fake_ark.generate
+
+    def pause_after_first(**kwargs):
+        result = generate(**kwargs)
+        db.set_batch_job_paused('b1', True)
+        return result
+
+    fake_ark.generate = pause_after_first
+    claim = db.claim_batch_task('w1', 60)
+    result = web_app_module.run_batch_task(claim)
+    assert result.get('stopped')
+    assert len(fake_ark.calls) == 1
+    assert db.stop_batch_task(claim['id'], 'w1')['task_status'] == 'pending'
+
+    fake_ark.generate = generate
+    assert db.set_batch_job_paused('b1', False)
+    resumed = db.claim_batch_task('w1', 60)
+    # 与队列工作线程相同，领取后带上已完成的图片
+    resumed['done_images'] = db.get_batch_task_done_images(resumed['id'])
+    assert resumed['done_images'] == {0}
+    assert web_app_module.run_batch_task(resumed)['success']
+    assert len(fake_ark.calls) == 3
@@ -0,0 +1,171 @@
+"""
+测试批量任务去重 / 复用：默认不复用；选择复用后批次内相同的行关联到第一行，与最近成功记录相同的行直接复用
+"""
+import io
+import types
+
+import pytest
+from PIL import Image
+
+import ark_clients
+
+
+def _tasks(*prompts, num_images=1):
+    return [{'prompt': prompt, 'num_images': num_images, 'aspect_ratio': '1:1', 'resolution': '2k'} for prompt in prompts]
+
+
+def test_reuse_is_off_by_default(web_app_module, db):
+    tasks = _tasks('猫', '猫')
+    assert web_app_module.dedupe_batch_tasks(tasks, 1) == {'duplicates': 0, 'reused': 0}
+    assert tasks == _tasks('猫', '猫')
+
+
+def test_reuse_results_requested(web_app_module):
+    requested = web_app_module._reuse_results_requested
+    assert not requested({})
+    assert requested({'reuse_results': True}) and requested({'reuse_results': 'on'})
+    assert not requested({'reuse_results': 'true', 'force_regenerate': 'true'})
+
+
+def test_duplicate_rows_link_to_first(web_app_module, db):
+    tasks = _tasks('猫', '狗', '猫', ' 猫 ')
+    result = web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True)
+    assert result == {'duplicates': 2, 'reused': 0}
+    assert 'linked_to' not in tasks[0] and 'linked_to' not in tasks[1]
+    assert tasks[2]['linked_to'] == 0 and tasks[3]['linked_to'] == 0
+    assert tasks[0]['params_hash'] == tasks[2]['params_hash']
+    assert all(task['reuse_results'] for task in tasks)
+
+
+def test_different_counts_or_sizes_are_not_linked(web_app_module, db):
+    tasks = _tasks('猫') + _tasks('猫', num_images=2) + [dict(_tasks('猫')[0], resolution='4k')]
+    assert web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True)['duplicates'] == 0
+
+
+def test_row_force_regenerate_skips_dedupe(web_app_module, db):
+    tasks = _tasks('猫', '猫')
+    tasks[1]['force_regenerate'] = True
+    assert web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True) == {'duplicates': 0, 'reused': 0}
+    assert 'reuse_results' not in tasks[1]
+
+
+def test_start_index_offsets_links(web_app_module, db):
+    """导入时按块去重，关联的是整个批次中的行号"""
+    tasks = _tasks('猫', '猫')
+    web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True, start_index=500)
+    assert tasks[1]['linked_to'] == 500
+
+
+def test_recent_success_is_reused(web_app_module, db):
+    tasks = _tasks('猫')
+    params_hash = web_app_module.batch_task_fingerprint(tasks[0])
+    db.save_generation_record({
+        'user_id': 1, 'prompt': '猫', 'image_path': '/output/1/a.jpg', 'filename': 'a.jpg',
+        'status': 'success', 'params_hash': params_hash,
+    })
+    assert web_app_module.dedupe_batch_tasks(_tasks('猫'), 1)['reused'] == 0
+    assert web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True) == {'duplicates': 0, 'reused': 1}
+    assert tasks[0]['reuse']
+    # 其他用户的记录不复用
+    other = _tasks('猫')
+    assert web_app_module.dedupe_batch_tasks(other, 2, reuse_results=True)['reused'] == 0
+
+
+def test_runtime_reuse_requires_opt_in(web_app_module, db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    task = _tasks('猫')[0]
+    db.save_generation_record({
+        'user_id': 1, 'prompt': '猫', 'image_path': '/output/1/a.jpg', 'filename': 'a.jpg',
+        'status': 'success', 'params_hash': web_app_module.batch_task_fingerprint(task),
+    })
+    claim = {'batch_id': 'b1', 'task_index': 0, 'user_id': 1}
+    assert web_app_module._reuse_batch_task(claim, dict(task), set()) is None
+    db.create_batch_job('b1', 1, 'tester', [task])
+    assert web_app_module._reuse_batch_task(claim, dict(task, reuse_results=True), set())['reused']
+
+
+def test_linked_tasks_finish_with_original(web_app_module, db):
+    tasks = _tasks('猫', '猫', '狗')
+    web_app_module.dedupe_batch_tasks(tasks, 1, reuse_results=True)
+    db.create_batch_job('b1', 1, 'tester', tasks, [web_app_module.batch_task_cost(task) for task in tasks])
+
+    claims = [db.claim_batch_task('w1', 60), db.claim_batch_task('w1', 60)]
+    # 关联的行不单独执行
+    assert db.claim_batch_task('w1', 60) is None
+    assert sorted(claim['task_index'] for claim in claims) == [0, 2]
+    assert [t['task_index'] for t in db.get_linked_batch_tasks('b1', 0)] == [1]
+
+    first = next(claim for claim in claims if claim['task_index'] == 0)
+    progress = db.complete_batch_task(first['id'], 'w1', True)
+    assert progress['completed'] == 2
+    assert db.get_linked_batch_tasks('b1', 0) == []
+
+
+def test_reuse_records_share_image_path(db):
+    """复用记录与原记录指向同一张图片；同一图片的普通记录重复保存时仍返回原记录"""
+    record = {'user_id': 1, 'prompt': '猫', 'image_path': '/output/1/a.jpg', 'filename': 'a.jpg', 'status': 'success'}
+    original = db.save_generation_record(record)
+    assert db.save_generation_record(dict(record, filename='b.jpg')) == original
+
+    reused = dict(record, filename='b.jpg', batch_id='b1', reused_from=original)
+    first = db.save_generation_record(reused)
+    assert first != original
+    # 复用记录重复写入（任务重试）时不重复插入
+    assert db.save_generation_record(reused) == first
+    assert db.save_generation_record(dict(reused, filename='c.jpg')) not in (original, first)
+
+
+def _noise_png(seed):
+    img = Image.frombytes('RGB', (64, 64), bytes((seed * 7 + n) % 256 for n in range(64 * 64 * 3)))
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def references(db, tmp_path, monkeypatch):
+    """允许列表中的参考图地址，内容可以在测试中修改"""
+    files = {}
+    monkeypatch.setenv('REFERENCE_ALLOWED_HOSTS', 'img.test')
+    monkeypatch.setenv('REFERENCE_CACHE_DIR', str(tmp_path / 'refs'))
+    monkeypatch.setenv('REFERENCE_URL_TTL', '0')
+    session = types.SimpleNamespace(
+        get=lambda url, headers=None, **kwargs: types.SimpleNamespace(status_code=200, content=files[url], headers={})
+    )
+    monkeypatch.setattr(ark_clients, 'get_http_session', lambda: session)
+    return files
+
+
+def _with_reference(url):
+    return dict(_tasks('猫')[0], sample_images=[{'url': url}])
+
+
+def test_fingerprint_uses_reference_content(web_app_module, references):
+    references['https://img.test/a.png'] = _noise_png(1)
+    references['https://img.test/copy.png'] = _noise_png(1)
+    fingerprint = web_app_module.batch_task_fingerprint
+    first = fingerprint(_with_reference('https://img.test/a.png'))
+    # 不同 URL 的相同图片可以复用
+    assert fingerprint(_with_reference('https://img.test/copy.png')) == first
+    # 同一 URL 的内容被覆盖后不再匹配
+    references['https://img.test/a.png'] = _noise_png(2)
+    assert fingerprint(_with_reference('https://img.test/a.png')) != first
+
+
+def test_unprepared_reference_falls_back_to_url(web_app_module, references):
+    fingerprint = web_app_module.batch_task_fingerprint
+    assert fingerprint(_with_reference('https://other.test/a.png')) != fingerprint(_with_reference('https://other.test/b.png'))
+    assert fingerprint(_with_reference('https://other.test/a.png')) == fingerprint(_with_reference('https://other.test/a.png'))
+
+
+def test_batch_generate_all_reuses_only_when_requested(web_app_module, client, db, monkeypatch):
+    test_client, user_id = client
+    monkeypatch.setattr(web_app_module.job_queue, 'notify', lambda: None)
+    tasks = _tasks('猫', '猫')
+    body = test_client.post('/api/batch-generate-all', json={'tasks': tasks}).get_json()
+    assert body['dedupe'] == {'duplicates': 0, 'reused': 0}
+    assert db.get_batch_queue_counts() == {'pending': 2}
+
+    body = test_client.post('/api/batch-generate-all', json={'tasks': tasks, 'reuse_results': True}).get_json()
+    assert body['dedupe'] == {'duplicates': 1, 'reused': 0}
+    assert db.get_batch_queue_counts() == {'pending': 3, 'linked': 1}
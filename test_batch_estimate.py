@@ -0,0 +1,85 @@
+"""
+测试批量预估：按去重 / 复用后实际需要生成的图片计算 API 调用数，耗时依据按尺寸的历史记录
+"""
+import pytest
+
+
+def _tasks(*prompts, num_images=1, resolution='2k'):
+    return [{'prompt': prompt, 'num_images': num_images, 'aspect_ratio': '1:1', 'resolution': resolution} for prompt in prompts]
+
+
+@pytest.fixture
+def sizes(web_app_module):
+    """1:1 各分辨率在方舟请求中的尺寸"""
+    def size(resolution):
+        width, height = web_app_module.ASPECT_RATIOS['1:1'][resolution]
+        return web_app_module.size_negotiation.negotiate(width, height)['size']
+    return size
+
+
+def test_estimate_without_history_uses_default_seconds(web_app_module, db, sizes):
+    estimate = web_app_module.estimate_batch(_tasks('猫', '狗', num_images=2), 1)
+    assert estimate['tasks'] == 2 and estimate['invalid_tasks'] == 0
+    assert estimate['images_to_generate'] == 4
+    [entry] = estimate['sizes']
+    assert entry['size'] == sizes('2k') and entry['basis'] == 'default' and entry['samples'] == 0
+    assert entry['api_seconds_per_image'] == web_app_module.BATCH_ESTIMATE_DEFAULT_SECONDS
+    assert estimate['work_seconds'] == 4 * web_app_module.BATCH_ESTIMATE_DEFAULT_SECONDS
+    assert 0 < estimate['estimated_seconds'] <= estimate['work_seconds']
+    assert estimate['estimated_total_seconds'] >= estimate['estimated_seconds']
+
+
+def test_estimate_uses_recorded_timings(web_app_module, db, sizes):
+    stats = web_app_module.latency_stats
+    for _ in range(3):
+        stats.record_api(web_app_module.IMAGE_MODEL, sizes('2k'), 6.0)
+        stats.record_download(web_app_module.IMAGE_MODEL, sizes('2k'), 1.0)
+    estimate = web_app_module.estimate_batch(_tasks('猫') + _tasks('狗', resolution='4k'), 1)
+    by_size = {entry['size']: entry for entry in estimate['sizes']}
+
+    recorded = by_size[sizes('2k')]
+    assert recorded['basis'] == 'history' and recorded['samples'] == 3
+    assert recorded['api_seconds_per_image'] == pytest.approx(6.0)
+    assert recorded['download_seconds_per_image'] == pytest.approx(1.0)
+    # 没有记录的尺寸按像素数从有记录的尺寸换算
+    scaled = by_size[sizes('4k')]
+    assert scaled['basis'] == 'scaled'
+    assert scaled['api_seconds_per_image'] > recorded['api_seconds_per_image']
+
+
+def test_estimate_counts_invalid_rows(web_app_module, db):
+    tasks = _tasks('猫', '  ') + ['not a task', {'num_images': 1}]
+    estimate = web_app_module.estimate_batch(tasks, 1)
+    assert estimate['tasks'] == 4 and estimate['invalid_tasks'] == 3
+    assert estimate['tasks_to_generate'] == 1 and estimate['api_calls'] == 1
+
+
+def test_estimate_excludes_duplicates_only_when_reusing(web_app_module, db):
+    tasks = _tasks('猫', '猫', '狗')
+    assert web_app_module.estimate_batch(tasks, 1)['api_calls'] == 3
+
+    db.save_generation_record({
+        'user_id': 1, 'prompt': '狗', 'image_path': '/output/1/dog.jpg', 'filename': 'dog.jpg',
+        'status': 'success', 'params_hash': web_app_module.batch_task_fingerprint(tasks[2]),
+    })
+    estimate = web_app_module.estimate_batch(tasks, 1, reuse_results=True)
+    assert estimate['dedupe'] == {'duplicates': 1, 'reused': 1}
+    assert estimate['tasks_to_generate'] == 1 and estimate['api_calls'] == 1
+    # 预估不修改传入的任务
+    assert tasks == _tasks('猫', '猫', '狗')
+
+
+def test_estimate_endpoint(client, db):
+    test_client, _ = client
+    assert test_client.post('/api/batch/estimate', json={'tasks': []}).status_code == 400
+    assert test_client.post('/api/batch/estimate', data='x').status_code == 400
+
+    tasks = _tasks('猫', '猫')
+    body = test_client.post('/api/batch/estimate', json={'tasks': tasks}).get_json()
+    assert body['success'] and body['api_calls'] == 2
+    body = test_client.post('/api/batch/estimate', json={'tasks': tasks, 'reuse_results': True}).get_json()
+    assert body['dedupe']['duplicates'] == 1 and body['api_calls'] == 1
+    body = test_client.post('/api/batch/estimate', json={'tasks': tasks, 'reuse_results': True, 'force_regenerate': True}).get_json()
+    assert body['api_calls'] == 2
+    # 预估不创建批次
+    assert db.get_batch_queue_counts() == {}
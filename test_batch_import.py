@@ -0,0 +1,132 @@
+"""
+测试批量导入表格的解析和逐行校验
+"""
+import datetime
+import io
+import time
+
+import pytest
+
+import batch_import
+
+ASPECT_RATIOS = {'1:1': {'1k': None, '2k': None}, '16:9': {'2k': None, '4k': None}}
+HEADER = '提示词,图片比例,分辨率,生成数量,文件名,参考图\n'
+
+
+def _rows(path):
+    return list(batch_import.iter_rows(str(path)))
+
+
+def test_check_format():
+    assert batch_import.check_format('tasks.CSV') == '.csv'
+    with pytest.raises(batch_import.BatchImportError):
+        batch_import.check_format('tasks.txt')
+
+
+def test_csv_utf8_with_bom_and_blank_rows(tmp_path):
+    path = tmp_path / 'tasks.csv'
+    path.write_text(HEADER + '一只猫,16:9,2k,2,cat,\n,,,,,\n一只狗,,,,,\n', encoding='utf-8-sig')
+    rows = _rows(path)
+    assert [number for number, _ in rows] == [2, 4]
+    assert rows[0][1]['提示词'] == '一只猫'
+
+
+def test_csv_gbk_encoding(tmp_path):
+    """Excel 在中文 Windows 上另存的 CSV 为 GBK 编码"""
+    path = tmp_path / 'tasks.csv'
+    path.write_bytes((HEADER + '一只猫,1:1,2k,1,cat,\n').encode('gbk'))
+    assert _rows(path)[0][1]['提示词'] == '一只猫'
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / 'tasks.csv'
+    path.write_text('', encoding='utf-8')
+    with pytest.raises(batch_import.BatchImportError):
+        _rows(path)
+
+
+def test_row_to_task_defaults():
+    task, error = batch_import.row_to_task({'提示词': '一只猫'}, [], ASPECT_RATIOS)
+    assert error is None
+    assert task['aspect_ratio'] == '1:1' and task['resolution'] == '2k'
+    assert task['num_images'] == 1 and task['filename'] == 'generated'
+
+
+@pytest.mark.parametrize('values, message', [
+    ({'提示词': ''}, '缺少提示词'),
+    ({'提示词': '猫', '图片比例': '5:4'}, '不支持的图片比例'),
+    ({'提示词': '猫', '分辨率': '8k'}, '不支持的分辨率'),
+    ({'提示词': '猫', '生成数量': 'abc'}, '不是数字'),
+    ({'提示词': '猫', '生成数量': 11}, '1~10'),
+])
+def test_row_to_task_errors(values, message):
+    task, error = batch_import.row_to_task(values, [], ASPECT_RATIOS)
+    assert task is None and message in error
+
+
+def test_excel_ratio_cells():
+    """Excel 可能把 16:9 识别成时间或小数"""
+    for value in (datetime.time(16, 9), 16 / 9, '16:9'):
+        task, error = batch_import.row_to_task({'提示词': '猫', '图片比例': value}, [], ASPECT_RATIOS)
+        assert error is None and task['aspect_ratio'] == '16:9'
+
+
+def test_numeric_cells_are_normalised():
+    task, _ = batch_import.row_to_task({'提示词': '猫', '生成数量': 3.0, '文件名': 20240101.0}, [], ASPECT_RATIOS)
+    assert task['num_images'] == 3
+    assert task['filename'] == '20240101'
+
+
+def test_reference_images_match_sample_filenames():
+    samples = [
+        {'filename': 'girl.jpg', 'url': 'https://oss/girl.jpg'},
+        {'filename': 'street_night.png', 'url': 'https://oss/street.png'},
+    ]
+    task, _ = batch_import.row_to_task({'提示词': '猫', '示例图文件名': 'girl，street_night'}, samples, ASPECT_RATIOS)
+    assert [image['url'] for image in task['sample_images']] == ['https://oss/girl.jpg', 'https://oss/street.png']
+    assert task['ref_images_text'] == 'girl，street_night'
+
+
+def test_xlsx(tmp_path):
+    openpyxl = pytest.importorskip('openpyxl')
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['提示词', '图片比例', '生成数量'])
+    sheet.append(['一只猫', datetime.time(16, 9), 2])
+    sheet.append([None, None, None])
+    path = tmp_path / 'tasks.xlsx'
+    workbook.save(path)
+    rows = _rows(path)
+    assert len(rows) == 1
+    task, error = batch_import.row_to_task(rows[0][1], [], ASPECT_RATIOS)
+    assert error is None and task['aspect_ratio'] == '16:9' and task['num_images'] == 2
+
+
+def test_import_endpoint_queues_valid_rows(web_app_module, client, db, tmp_path, monkeypatch):
+    """接口立即返回 202，后台逐行校验并分块写入队列，被跳过的行记入批次日志"""
+    test_client, _ = client
+    monkeypatch.setitem(web_app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(web_app_module, 'BATCH_IMPORT_CHUNK_SIZE', 2)
+    content = HEADER + '一只猫,1:1,2k,1,cat,\n一只狗,5:4,2k,1,dog,\n一只鸟,16:9,4k,2,bird,\n一条鱼,,,,,\n'
+    response = test_client.post('/api/batch-import', data={'file': (io.BytesIO(content.encode('utf-8')), 'tasks.csv')},
+                                content_type='multipart/form-data')
+    assert response.status_code == 202
+    batch_id = response.get_json()['batch_id']
+
+    deadline = time.time() + 5
+    while db.get_batch_job(batch_id)['importing'] and time.time() < deadline:
+        time.sleep(0.02)
+    job = db.get_batch_job(batch_id)
+    assert job['importing'] == 0 and job['total'] == 3
+    messages = [log['message'] for log in job['logs']]
+    assert any('第 3 行已跳过' in message for message in messages)
+    assert any('导入完成：3 个任务，跳过 1 行' in message for message in messages)
+    assert db.get_batch_queue_counts() == {'pending': 3}
+
+
+def test_import_endpoint_rejects_unsupported_files(client):
+    test_client, _ = client
+    assert test_client.post('/api/batch-import', data={}, content_type='multipart/form-data').status_code == 400
+    response = test_client.post('/api/batch-import', data={'file': (io.BytesIO(b'x'), 'tasks.txt')},
+                                content_type='multipart/form-data')
+    assert response.status_code == 400
@@ -0,0 +1,126 @@
+"""
+测试持久化批量任务队列：租约领取、完成、续约和中断恢复
+"""
+import time
+
+import job_queue
+
+
+def _create(db, batch_id='b1', tasks=2, user_id=1, costs=None):
+    db.create_batch_job(batch_id, user_id, 'tester', [{'prompt': f'p{i}'} for i in range(tasks)], costs)
+
+
+def test_claim_sets_lease_and_attempts(db):
+    _create(db)
+    claim = db.claim_batch_task('w1', 60)
+    assert claim['task_index'] == 0
+    assert claim['lease_owner'] == 'w1'
+    assert claim['attempts'] == 1
+    assert claim['task'] == {'prompt': 'p0'}
+    # 同一任务在租约期内不会被再次领取
+    assert db.claim_batch_task('w2', 60)['task_index'] == 1
+    assert db.claim_batch_task('w3', 60) is None
+
+
+def test_complete_counts_and_finishes_batch(db):
+    _create(db)
+    first = db.claim_batch_task('w1', 60)
+    second = db.claim_batch_task('w1', 60)
+    progress = db.complete_batch_task(first['id'], 'w1', True)
+    assert progress['completed'] == 1 and not progress['finished']
+    progress = db.complete_batch_task(second['id'], 'w1', False, 'boom')
+    assert progress['failed'] == 1 and progress['finished']
+    assert db.get_batch_job_status('b1') == 'completed'
+
+
+def test_complete_requires_lease(db):
+    _create(db, tasks=1)
+    claim = db.claim_batch_task('w1', 60)
+    assert db.complete_batch_task(claim['id'], 'other', True) is None
+    assert db.complete_batch_task(claim['id'], 'w1', True) is not None
+
+
+def test_expired_lease_is_reclaimed(db):
+    """工作进程异常退出后，租约过期的任务被其他工作线程重新领取，已完成的图片被跳过"""
+    _create(db, tasks=1)
+    claim = db.claim_batch_task('w1', 0.05)
+    db.mark_batch_image_done(claim['id'], 0)
+    time.sleep(0.1)
+    again = db.claim_batch_task('w2', 60)
+    assert again['id'] == claim['id']
+    assert again['attempts'] == 2
+    assert db.get_batch_task_done_images(again['id']) == {0}
+    # 原持有者的租约已失效，结果不再写入
+    assert db.complete_batch_task(claim['id'], 'w1', True) is None
+
+
+def test_renew_keeps_lease(db):
+    _create(db, tasks=1)
+    claim = db.claim_batch_task('w1', 0.05)
+    assert db.renew_batch_leases('w1', [claim['id']], 60) == 1
+    time.sleep(0.1)
+    assert db.claim_batch_task('w2', 60) is None
+
+
+def test_release_returns_tasks_to_queue(db):
+    _create(db, tasks=1)
+    db.claim_batch_task('w1', 60)
+    assert db.release_batch_leases('w1') == 1
+    assert db.claim_batch_task('w2', 60) is not None
+
+
+def _queue(runner, results):
+    return job_queue.JobQueue(runner, lambda claim, result: results.append((claim['task_index'], result)), workers=1)
+
+
+def test_run_passes_done_images_and_reports_result(db):
+    _create(db, tasks=1)
+    claim = db.claim_batch_task('w1', 60)
+    db.mark_batch_image_done(claim['id'], 1)
+    results = []
+    seen = []
+    queue = _queue(lambda c: seen.append(c['done_images']) or {'success': True}, results)
+    queue._run(claim)
+    assert seen == [{1}]
+    assert results == [(0, {'success': True})]
+    assert queue.stats['succeeded'] == 1
+
+
+def test_run_abandons_task_after_max_attempts(db, monkeypatch):
+    """反复中断（如导致进程崩溃）的任务超过次数后直接失败，不再执行"""
+    monkeypatch.setenv('BATCH_TASK_MAX_ATTEMPTS', '1')
+    _create(db, tasks=1)
+    db.claim_batch_task('w1', 0.01)
+    time.sleep(0.05)
+    claim = db.claim_batch_task('w2', 60)
+    results = []
+    queue = _queue(lambda c: {'success': True}, results)
+    queue._run(claim)
+    assert results[0][1]['success'] is False
+    assert queue.stats['abandoned'] == 1
+
+
+def test_runner_exception_fails_task(db):
+    _create(db, tasks=1)
+    claim = db.claim_batch_task('w1', 60)
+    results = []
+
+    def boom(claim):
+        raise RuntimeError('boom')
+
+    _queue(boom, results)._run(claim)
+    assert results == [(0, {'success': False, 'error': 'boom'})]
+
+
+def test_import_does_not_start_queue(web_app_module):
+    """导入 web_app 不启动队列工作线程，由 init_app() 启动"""
+    assert job_queue.get_stats() is None
+
+
+def test_submitted_batch_is_queued(client, db):
+    test_client, user_id = client
+    response = test_client.post('/api/batch-generate-all', json={'tasks': [{'prompt': '猫'}, {'prompt': '狗'}]})
+    batch_id = response.get_json()['batch_id']
+    job = db.get_batch_job(batch_id, log_limit=0)
+    assert job['user_id'] == user_id and job['total'] == 2
+    assert db.get_batch_queue_counts()['pending'] == 2
@@ -0,0 +1,216 @@
+"""
+测试进度推送（SSE）：写入方直接唤醒订阅者，只推送带事件ID 的增量，批次的结束日志读到后立即结束
+"""
+import json
+import threading
+import time
+
+import pytest
+
+import event_stream
+
+
+def _parse(body):
+    """把 SSE 响应内容解析为 (事件名, 数据, 事件ID) 列表（忽略 retry 和保活注释）"""
+    events = []
+    for block in body.split('\n\n'):
+        fields = {}
+        for line in block.split('\n'):
+            if line.startswith(('id: ', 'event: ', 'data: ')):
+                name, value = line.split(': ', 1)
+                fields[name] = value
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data']), fields.get('id')))
+    return events
+
+
+class _Reader:
+    """在后台线程中读取推送响应，直到连接结束"""
+
+    def __init__(self, response):
+        self.chunks = []
+        self.thread = threading.Thread(target=self._read, args=(response,), daemon=True)
+        self.thread.start()
+
+    def _read(self, response):
+        for chunk in response.response:
+            self.chunks.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+
+    def events(self):
+        return _parse(''.join(self.chunks))
+
+    def wait_for(self, predicate, timeout=2):
+        deadline = time.time() + timeout
+        while not predicate(self.events()) and time.time() < deadline:
+            time.sleep(0.01)
+        return self.events()
+
+    def join(self, timeout=2):
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+@pytest.fixture(autouse=True)
+def long_keepalive(monkeypatch):
+    # 保活间隔远大于测试时长：事件只能由发布唤醒送达
+    monkeypatch.setenv('SSE_KEEPALIVE_INTERVAL', '60')
+
+
+def test_publish_wakes_only_subscribers_of_the_channel():
+    polls = {'a': 0, 'b': 0}
+
+    def make_poll(name):
+        def poll(cursor):
+            polls[name] += 1
+            return [], cursor, polls[name] >= 2
+        return poll
+
+    streams = {name: event_stream.stream(f'test:{name}', make_poll(name)) for name in polls}
+    threads = [threading.Thread(target=list, args=(stream,), daemon=True) for stream in streams.values()]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 2
+    while event_stream.get_stats()['subscribers'] < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    event_stream.publish('test:a')
+    threads[0].join(1)
+    assert not threads[0].is_alive() and polls == {'a': 2, 'b': 1}
+    event_stream.publish('test:b')
+    threads[1].join(1)
+    assert not threads[1].is_alive()
+    assert event_stream.get_stats()['channels'] == 0
+
+
+def test_max_streams_rejects_connections(monkeypatch):
+    monkeypatch.setenv('SSE_MAX_STREAMS', '1')
+    assert event_stream.acquire_stream()
+    try:
+        assert not event_stream.acquire_stream()
+    finally:
+        event_stream.release_stream()
+    assert event_stream.acquire_stream()
+    event_stream.release_stream()
+
+
+def _finish_batch(web_app_module, db, batch_id):
+    """按工作线程的顺序结束批次的唯一任务：更新状态、写任务日志、写结束日志"""
+    claim = db.claim_batch_task('w1', 60)
+    claim['username'] = 'tester'
+    web_app_module.record_batch_task_result(claim, {'success': True})
+
+
+def test_finished_batch_stream_ends_without_waiting(web_app_module, client, db):
+    test_client, user_id = client
+    db.create_batch_job('b1', user_id, 'tester', [{'prompt': 'p0'}])
+    _finish_batch(web_app_module, db, 'b1')
+    assert db.get_batch_job('b1', log_limit=0)['closed'] == 1
+
+    start = time.time()
+    events = _parse(test_client.get('/api/batch-progress/b1/stream').get_data(as_text=True))
+    assert time.time() - start < 0.3
+    names = [name for name, _, _ in events]
+    assert names[0] == 'log' and names[-2:] == ['progress', 'end']
+    assert events[-1][1]['completed'] == 1
+    assert '批量生成完成' in [data for name, data, _ in events if name == 'log'][-1]['message']
+
+
+def test_batch_stream_pushes_increments_until_closing_log(web_app_module, client, db):
+    """状态已完成但结束日志尚未写入时不结束，结束日志写入时被唤醒，推送后结束"""
+    test_client, user_id = client
+    db.create_batch_job('b1', user_id, 'tester', [{'prompt': 'p0'}])
+    reader = _Reader(test_client.get('/api/batch-progress/b1/stream', buffered=False))
+    reader.wait_for(lambda events: events)
+
+    web_app_module.append_batch_log('b1', '开始任务 1/1')
+    events = reader.wait_for(lambda events: any(name == 'log' for name, _, _ in events))
+    log_events = [event for event in events if event[0] == 'log']
+    assert [data['message'] for _, data, _ in log_events] == ['开始任务 1/1']
+    assert log_events[0][2] == f"{log_events[0][1]['id']}.0"
+
+    claim = db.claim_batch_task('w1', 60)
+    db.complete_batch_task(claim['id'], 'w1', True)
+    web_app_module.append_batch_log('b1', '✓ 任务 1 完成', 'success')
+    time.sleep(0.2)
+    assert not reader.join(0)
+    web_app_module.finish_batch(dict(db.get_batch_job('b1', log_limit=0), finished=True))
+    assert reader.join()
+    events = reader.events()
+    assert [name for name, _, _ in events][-1] == 'end'
+    assert len([event for event in events if event[0] == 'log']) == 3
+
+
+def test_batch_stream_resumes_after_last_event_id(web_app_module, client, db):
+    test_client, user_id = client
+    db.create_batch_job('b1', user_id, 'tester', [{'prompt': 'p0'}])
+    web_app_module.append_batch_log('b1', 'first')
+    first_id = db.get_batch_logs_after('b1')[0]['id']
+    _finish_batch(web_app_module, db, 'b1')
+
+    body = test_client.get('/api/batch-progress/b1/stream', headers={'Last-Event-ID': f'{first_id}.0'}).get_data(as_text=True)
+    messages = [data['message'] for name, data, _ in _parse(body) if name == 'log']
+    assert 'first' not in messages and len(messages) == 2
+
+
+def test_cancelled_batch_stream_ends_after_running_task_stops(web_app_module, client, db):
+    test_client, user_id = client
+    db.create_batch_job('b1', user_id, 'tester', [{'prompt': 'p0'}, {'prompt': 'p1'}])
+    claim = db.claim_batch_task('w1', 60)
+    claim['username'] = 'tester'
+    assert test_client.post('/api/batch/b1/cancel').status_code == 200
+    # 执行中的任务还没有停下来，批次未关闭
+    assert db.get_batch_job('b1', log_limit=0)['closed'] == 0
+
+    reader = _Reader(test_client.get('/api/batch-progress/b1/stream', buffered=False))
+    reader.wait_for(lambda events: events)
+    assert not reader.join(0.2)
+    web_app_module.record_batch_task_stopped(claim)
+    assert reader.join()
+    assert reader.events()[-1][0] == 'end'
+
+
+def test_unclosed_batch_stream_ends_after_keepalive(client, db, monkeypatch):
+    """写入结束日志的进程异常退出时，推送最迟在一个保活间隔之后结束"""
+    monkeypatch.setenv('SSE_KEEPALIVE_INTERVAL', '1')
+    test_client, user_id = client
+    db.create_batch_job('b1', user_id, 'tester', [{'prompt': 'p0'}])
+    claim = db.claim_batch_task('w1', 60)
+    db.complete_batch_task(claim['id'], 'w1', True)
+    reader = _Reader(test_client.get('/api/batch-progress/b1/stream', buffered=False))
+    assert not reader.join(0.5)
+    assert reader.join(3)
+    assert reader.events()[-1][0] == 'end'
+
+
+def test_single_task_stream_sends_deltas(web_app_module, client):
+    test_client, user_id = client
+    tasks = web_app_module.single_generation_tasks
+    tasks.set('t1', {'user_id': user_id, 'status': 'queued', 'progress': 0, 'total': 2, 'revision': 0})
+    reader = _Reader(test_client.get('/api/single-generation-status/t1/stream', buffered=False))
+    events = reader.wait_for(lambda events: events)
+    assert events[0] == ('task', {'user_id': user_id, 'status': 'queued', 'progress': 0, 'total': 2, 'revision': 0}, '0')
+
+    web_app_module.update_single_task('t1', status='generating')
+    reader.wait_for(lambda events: len(events) >= 2)
+    web_app_module.update_single_task('t1', progress=1)
+    reader.wait_for(lambda events: len(events) >= 3)
+    web_app_module.update_single_task('t1', status='completed', progress=2, images=['a.jpg'])
+    assert reader.join()
+    events = reader.events()
+    updates = [(data, event_id) for name, data, event_id in events if name == 'update']
+    assert updates[0] == ({'status': 'generating', 'revision': 1}, '1')
+    assert updates[1] == ({'progress': 1, 'revision': 2}, '2')
+    assert updates[-1] == ({'status': 'completed', 'progress': 2, 'images': ['a.jpg'], 'revision': 3}, '3')
+    assert events[-1] == ('end', {'status': 'completed'}, '3')
+    tasks.delete('t1')
+
+
+def test_single_task_stream_skips_snapshot_on_reconnect(web_app_module, client):
+    test_client, user_id = client
+    tasks = web_app_module.single_generation_tasks
+    tasks.set('t1', {'user_id': user_id, 'status': 'completed', 'revision': 5})
+    body = test_client.get('/api/single-generation-status/t1/stream', headers={'Last-Event-ID': '5'}).get_data(as_text=True)
+    assert _parse(body) == [('end', {'status': 'completed'}, '5')]
+    body = test_client.get('/api/single-generation-status/t1/stream', headers={'Last-Event-ID': '4'}).get_data(as_text=True)
+    assert [name for name, _, _ in _parse(body)] == ['task', 'end']
+    tasks.delete('t1')
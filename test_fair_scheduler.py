@@ -0,0 +1,108 @@
+"""
+测试批量任务的加权公平调度：按成本 / 权重分配工作线程、每个用户的并发上限和 backfill 优先级
+"""
+
+
+def _create(db, batch_id, user_id, tasks, costs=None, priority='batch'):
+    db.create_batch_job(batch_id, user_id, f'user{user_id}', [{'prompt': f'p{i}'} for i in range(tasks)],
+                        costs, priority)
+
+
+def _claim_users(db, count, default_max_concurrency=0):
+    claims = [db.claim_batch_task('w1', 60, default_max_concurrency) for _ in range(count)]
+    return [claim['user_id'] if claim else None for claim in claims]
+
+
+def test_users_alternate_regardless_of_batch_size(db):
+    """先提交的大批次不会占满工作线程，后提交的小批次与它轮流执行"""
+    _create(db, 'big', 1, tasks=4)
+    _create(db, 'small', 2, tasks=2)
+    assert _claim_users(db, 7) == [1, 2, 1, 2, 1, 1, None]
+
+
+def test_cost_decides_share(db):
+    """一个 4k 任务的份额约为 4 个 2k 任务"""
+    _create(db, 'large', 1, tasks=2, costs=[4.0, 4.0])
+    _create(db, 'normal', 2, tasks=4, costs=[1.0] * 4)
+    assert _claim_users(db, 6) == [1, 2, 2, 2, 2, 1]
+
+
+def test_weight_decides_share(db):
+    db.set_scheduler_user(1, weight=2)
+    _create(db, 'b1', 1, tasks=4)
+    _create(db, 'b2', 2, tasks=4)
+    users = _claim_users(db, 6)
+    assert users.count(1) == 4 and users.count(2) == 2
+
+
+def test_zero_cost_task_does_not_use_share(db):
+    """复用已有结果的任务成本为 0，不增加用户的虚拟时间"""
+    _create(db, 'b1', 1, tasks=1, costs=[0.0])
+    db.claim_batch_task('w1', 60)
+    state = {entry['user_id']: entry for entry in db.get_scheduler_state()}
+    assert state[1]['virtual_time'] == 0
+
+
+def test_idle_user_does_not_bank_share(db):
+    """长时间没有任务的用户回来时从系统虚拟时钟开始，不会连续占用所有工作线程"""
+    _create(db, 'b1', 1, tasks=6)
+    assert _claim_users(db, 3) == [1, 1, 1]
+    _create(db, 'b2', 2, tasks=3)
+    assert _claim_users(db, 3) == [2, 1, 2]
+
+
+def test_user_max_concurrency(db):
+    _create(db, 'b1', 1, tasks=3)
+    db.set_scheduler_user(1, max_concurrency=1)
+    first = db.claim_batch_task('w1', 60)
+    assert db.claim_batch_task('w1', 60) is None
+    db.complete_batch_task(first['id'], 'w1', True)
+    assert db.claim_batch_task('w1', 60)['user_id'] == 1
+
+
+def test_default_max_concurrency_and_user_override(db):
+    _create(db, 'b1', 1, tasks=4)
+    _create(db, 'b2', 2, tasks=4)
+    assert _claim_users(db, 5, default_max_concurrency=2) == [1, 2, 1, 2, None]
+    # 单独设置为 0 的用户不受全局默认值限制
+    db.set_scheduler_user(2, max_concurrency=0)
+    assert _claim_users(db, 2, default_max_concurrency=2) == [2, 2]
+    state = {entry['user_id']: entry for entry in db.get_scheduler_state()}
+    assert state[1]['running'] == 2 and state[2]['running'] == 4
+
+
+def test_backfill_runs_after_batch(db):
+    _create(db, 'fill', 1, tasks=2, priority='backfill')
+    _create(db, 'b1', 2, tasks=2)
+    assert _claim_users(db, 4) == [2, 2, 1, 1]
+
+
+def test_paused_batch_is_not_scheduled(db):
+    _create(db, 'b1', 1, tasks=2)
+    _create(db, 'b2', 2, tasks=2)
+    db.set_batch_job_paused('b1', True)
+    assert _claim_users(db, 3) == [2, 2, None]
+
+
+def test_batch_task_cost(web_app_module):
+    cost = web_app_module.batch_task_cost
+    assert cost({'aspect_ratio': '1:1', 'resolution': '2k'}) == 1.0
+    assert cost({'aspect_ratio': '1:1', 'resolution': '4k', 'num_images': 2}) > 2 * cost({'aspect_ratio': '1:1', 'resolution': '2k'})
+    assert cost({'aspect_ratio': '1:1', 'resolution': '2k', 'reuse': {'image_path': 'a.jpg'}}) == 0.0
+    assert cost({'aspect_ratio': '1:1', 'resolution': '2k', 'linked_to': 0}) == 0.0
+
+
+def test_admin_scheduler_endpoint(web_app_module, client, db):
+    test_client, user_id = client
+    assert test_client.post('/api/admin/scheduler', json={'user_id': user_id, 'weight': 3}).status_code == 403
+
+    db.create_user('system_admin', 'pw')
+    admin = db.verify_user('system_admin', 'pw')
+    with test_client.session_transaction() as session:
+        session['user_id'] = admin['id']
+        session['username'] = admin['username']
+    assert test_client.post('/api/admin/scheduler', json={'weight': 3}).status_code == 400
+    response = test_client.post('/api/admin/scheduler', json={'user_id': user_id, 'weight': 3, 'max_concurrency': 2})
+    assert response.get_json()['success']
+    state = {entry['user_id']: entry for entry in db.get_scheduler_state()}
+    assert state[user_id]['weight'] == 3 and state[user_id]['max_concurrency'] == 2
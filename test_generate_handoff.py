@@ -0,0 +1,70 @@
+"""
+测试 /generate 的异步交接：请求校验后立即返回 202 和 task_id，生成在后台进行，结果通过状态接口查询
+"""
+import io
+import time
+
+from PIL import Image
+
+
+def test_generate_returns_202_before_generation_finishes(client, fake_ark, wait_for_task):
+    test_client, _ = client
+    fake_ark.delay = 0.5
+    start = time.time()
+    response = test_client.post('/generate', data={'prompt': '一只猫', 'output_filename': 'cat'})
+    assert time.time() - start < 0.3
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body['success'] and body['status'] == 'queued'
+
+    status = test_client.get(f"/api/single-generation-status/{body['task_id']}").get_json()['task']
+    assert status['status'] in ('queued', 'generating') and status['total'] == 1
+
+    task = wait_for_task(test_client, body['task_id'])
+    assert task['status'] == 'completed'
+    assert task['result']['filenames'] == ['cat.jpg']
+    assert len(fake_ark.calls) == 1
+
+
+def test_generate_validates_before_handoff(web_app_module, client, fake_ark, monkeypatch):
+    test_client, _ = client
+    response = test_client.post('/generate', data={'prompt': '  '})
+    assert response.status_code == 400
+    monkeypatch.delenv('ARK_API_KEY')
+    assert test_client.post('/generate', data={'prompt': '一只猫'}).status_code == 500
+    # 校验失败的请求不登记任务，也不调用 API
+    assert web_app_module.generate_inflight == {}
+    assert fake_ark.calls == []
+
+
+def test_generate_failure_is_reported_in_status(client, fake_ark, wait_for_task):
+    test_client, _ = client
+
+    def fail(**kwargs):
+        raise RuntimeError('upstream error')
+
+    fake_ark.generate = fail
+    task_id = test_client.post('/generate', data={'prompt': '一只猫'}).get_json()['task_id']
+    task = wait_for_task(test_client, task_id)
+    assert task['status'] == 'failed' and task.get('error')
+
+
+def test_uploaded_reference_is_saved_before_handoff(web_app_module, client, fake_ark, wait_for_task, tmp_path, monkeypatch):
+    """上传的参考图在请求内保存，请求结束后后台任务从本地文件上传和读取"""
+    test_client, user_id = client
+    uploaded = []
+    monkeypatch.setenv('OSS_ENABLED', 'true')
+    monkeypatch.setenv('REFERENCE_CACHE_DIR', str(tmp_path / 'reference_cache'))
+    monkeypatch.setattr(web_app_module, 'upload_to_aliyun_oss',
+                        lambda filepath: uploaded.append(filepath) or 'https://oss.test/ref.png')
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (10, 20, 30)).save(buffer, 'PNG')
+    buffer.seek(0)
+    response = test_client.post('/generate', data={'prompt': '一只猫', 'images': (buffer, 'ref.png')},
+                                content_type='multipart/form-data')
+    assert response.status_code == 202
+    assert (tmp_path / 'uploads' / str(user_id) / 'ref.png').exists()
+    assert wait_for_task(test_client, response.get_json()['task_id'])['status'] == 'completed'
+    # 先上传原图，预处理后的参考图再上传一次
+    assert uploaded[0] == str(tmp_path / 'uploads' / str(user_id) / 'ref.png')
+    assert len(fake_ark.calls[0]['extra_body']['image']) == 1
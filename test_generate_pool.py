@@ -0,0 +1,49 @@
+"""
+测试 /generate 的并发生成：单个请求内按上限并发，结果按序号排列
+"""
+import threading
+import time
+
+
+def test_run_bounded_limits_concurrency_and_keeps_order(web_app_module):
+    lock = threading.Lock()
+    state = {'active': 0, 'max': 0}
+
+    def work(i):
+        with lock:
+            state['active'] += 1
+            state['max'] = max(state['max'], state['active'])
+        time.sleep(0.02)
+        with lock:
+            state['active'] -= 1
+        return i * 10
+
+    assert web_app_module.run_bounded(work, range(8), 2) == [i * 10 for i in range(8)]
+    assert state['max'] == 2
+
+
+def test_run_bounded_propagates_errors(web_app_module):
+    def work(i):
+        if i == 1:
+            raise ValueError('boom')
+        return i
+
+    try:
+        web_app_module.run_bounded(work, range(3), 2)
+    except ValueError as e:
+        assert str(e) == 'boom'
+    else:
+        raise AssertionError('应抛出 ValueError')
+
+
+def test_generate_images_concurrently_within_request_limit(web_app_module, client, fake_ark, wait_for_task, monkeypatch):
+    test_client, _ = client
+    fake_ark.delay = 0.05
+    monkeypatch.setattr(web_app_module, 'GENERATE_PER_REQUEST_CONCURRENCY', 2)
+    response = test_client.post('/generate', data={'prompt': '一只猫', 'num_images': '4', 'output_filename': 'cat'})
+    task = wait_for_task(test_client, response.get_json()['task_id'])
+
+    assert task['status'] == 'completed'
+    assert task['result']['filenames'] == [f'cat_{i}.jpg' for i in range(1, 5)]
+    assert len(fake_ark.calls) == 4
+    assert fake_ark.max_active == 2
@@ -0,0 +1,68 @@
+"""
+测试幂等键：重复提交返回原来的批次，内容不同时拒绝
+"""
+import time
+
+
+def test_claim_returns_original_resource(db):
+    first = db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-a', 60)
+    assert first['resource_id'] == 'batch-a'
+    replay = db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-b', 60)
+    assert replay['resource_id'] == 'batch-a'
+
+
+def test_keys_are_scoped_per_user_and_endpoint(db):
+    db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-a', 60)
+    assert db.claim_idempotency_key(2, 'batch', 'k1', 'fp', 'batch-b', 60)['resource_id'] == 'batch-b'
+    assert db.claim_idempotency_key(1, 'generate', 'k1', 'fp', 'task-c', 60)['resource_id'] == 'task-c'
+
+
+def test_release_and_expiry_free_the_key(db):
+    db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-a', 60)
+    db.release_idempotency_key(1, 'batch', 'k1', 'batch-a')
+    assert db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-b', 0.01)['resource_id'] == 'batch-b'
+    time.sleep(0.05)
+    assert db.claim_idempotency_key(1, 'batch', 'k1', 'fp', 'batch-c', 60)['resource_id'] == 'batch-c'
+
+
+def test_batch_submit_replay(client):
+    test_client, _ = client
+    tasks = [{'prompt': '一只猫', 'num_images': 1}]
+    headers = {'Idempotency-Key': 'submit-1'}
+    first = test_client.post('/api/batch-generate-all', json={'tasks': tasks}, headers=headers)
+    assert first.status_code == 200
+    batch_id = first.get_json()['batch_id']
+
+    replay = test_client.post('/api/batch-generate-all', json={'tasks': tasks}, headers=headers)
+    assert replay.status_code == 200
+    assert replay.get_json()['batch_id'] == batch_id
+
+    changed = test_client.post('/api/batch-generate-all', json={'tasks': [{'prompt': '一只狗'}]}, headers=headers)
+    assert changed.status_code == 422
+
+
+def test_generate_replay_returns_original_task(client, fake_ark, wait_for_task):
+    test_client, _ = client
+    headers = {'Idempotency-Key': 'gen-1'}
+    data = {'prompt': '一只猫', 'output_filename': 'cat'}
+    first = test_client.post('/generate', data=data, headers=headers).get_json()
+    wait_for_task(test_client, first['task_id'])
+
+    replay = test_client.post('/generate', data=data, headers=headers)
+    body = replay.get_json()
+    assert replay.status_code == 200 and body['replayed']
+    assert body['task_id'] == first['task_id'] and body['result']['filenames'] == ['cat.jpg']
+    assert len(fake_ark.calls) == 1
+
+    conflict = test_client.post('/generate', data=dict(data, prompt='一只狗'), headers=headers)
+    assert conflict.status_code == 422
+
+
+def test_generate_rejected_request_releases_key(client, fake_ark, wait_for_task):
+    """参数错误的请求不占用幂等键，修正后可以用同一个键重新提交"""
+    test_client, _ = client
+    headers = {'Idempotency-Key': 'gen-2'}
+    assert test_client.post('/generate', data={'prompt': ''}, headers=headers).status_code == 400
+    response = test_client.post('/generate', data={'prompt': '一只猫'}, headers=headers)
+    assert response.status_code == 202 and not response.get_json().get('replayed')
+    wait_for_task(test_client, response.get_json()['task_id'])
@@ -0,0 +1,115 @@
+"""
+测试分阶段流水线和 OSS 上传的背压：慢阶段不会让上游无限堆积任务
+"""
+import queue
+import threading
+import time
+
+import pytest
+
+import pipeline
+
+
+def _run(pipe, job, timeout=5):
+    done = threading.Event()
+    result = {}
+
+    def on_done(finished, error):
+        result.setdefault('jobs', []).append((finished, error))
+        done.set()
+
+    pipe.submit(dict(job, on_done=on_done))
+    assert done.wait(timeout)
+    return result['jobs']
+
+
+def test_job_passes_through_all_stages():
+    pipe = pipeline.StagedPipeline([
+        pipeline.PipelineStage('a', lambda job: dict(job, steps=job['steps'] + ['a'])),
+        pipeline.PipelineStage('b', lambda job: dict(job, steps=job['steps'] + ['b'])),
+    ], name='test-pass')
+    [(job, error)] = _run(pipe, {'steps': []})
+    assert error is None and job['steps'] == ['a', 'b']
+    assert [stage['processed'] for stage in pipe.get_stats()] == [1, 1]
+
+
+def test_failure_skips_later_stages():
+    later = []
+
+    def fail(job):
+        raise RuntimeError('boom')
+
+    pipe = pipeline.StagedPipeline([
+        pipeline.PipelineStage('a', fail),
+        pipeline.PipelineStage('b', lambda job: later.append(job) or job),
+    ], name='test-fail')
+    [(_, error)] = _run(pipe, {})
+    assert isinstance(error, RuntimeError)
+    assert later == []
+    assert pipe.get_stats()[0]['failed'] == 1
+
+
+def test_list_result_splits_job():
+    finished = []
+    all_done = threading.Event()
+
+    def on_done(job, error):
+        finished.append(job['index'])
+        if len(finished) == 3:
+            all_done.set()
+
+    pipe = pipeline.StagedPipeline([
+        pipeline.PipelineStage('split', lambda job: [dict(job, index=i) for i in range(3)]),
+        pipeline.PipelineStage('each', lambda job: job, workers=2),
+    ], name='test-split')
+    pipe.submit({'on_done': on_done})
+    assert all_done.wait(5)
+    assert sorted(finished) == [0, 1, 2]
+
+
+def test_slow_stage_blocks_submit():
+    """下游阶段卡住时，上游队列排满后提交方阻塞（背压）"""
+    release = threading.Event()
+    pipe = pipeline.StagedPipeline([
+        pipeline.PipelineStage('fast', lambda job: job, queue_size=1),
+        pipeline.PipelineStage('slow', lambda job: release.wait(5) and job, queue_size=1),
+    ], name='test-backpressure')
+    try:
+        with pytest.raises(queue.Full):
+            for _ in range(10):
+                pipe.submit({}, timeout=0.2)
+    finally:
+        release.set()
+
+
+def test_oss_upload_submit_waits_for_a_slot(web_app_module, monkeypatch):
+    """上传名额用完时 submit_oss_upload 等待前面的上传结束，不在内存中堆积"""
+    release = threading.Event()
+    uploaded = []
+
+    def slow_upload(record_id, filepath):
+        release.wait(5)
+        uploaded.append(record_id)
+
+    monkeypatch.setattr(web_app_module, 'attach_oss_url', slow_upload)
+    monkeypatch.setattr(web_app_module, 'oss_upload_slots', threading.BoundedSemaphore(1))
+    first = web_app_module.submit_oss_upload(1, 'a.jpg')
+
+    second_submitted = threading.Event()
+
+    def submit_second():
+        web_app_module.submit_oss_upload(2, 'b.jpg').result(5)
+        second_submitted.set()
+
+    thread = threading.Thread(target=submit_second)
+    thread.start()
+    assert not second_submitted.wait(0.2)
+    release.set()
+    first.result(5)
+    thread.join(5)
+    assert uploaded == [1, 2]
+    # 名额在 future 的完成回调中归还，可能晚于 result() 返回
+    deadline = time.time() + 5
+    while web_app_module.oss_upload_stats['pending'] and time.time() < deadline:
+        time.sleep(0.01)
+    assert web_app_module.oss_upload_stats['pending'] == 0
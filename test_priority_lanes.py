@@ -0,0 +1,48 @@
+"""
+测试优先级通道：/generate 的 API 调用走 interactive 通道，批量任务按批次的优先级（batch / backfill）调用
+"""
+import pytest
+
+import rate_limiter
+
+
+@pytest.fixture
+def lanes(fake_ark):
+    """记录每次 API 调用时所在的优先级通道"""
+    recorded = []
+    generate = fake_ark.generate
+
+    def recording_generate(**kwargs):
+        recorded.append(rate_limiter.current_priority())
+        return generate(**kwargs)
+
+    fake_ark.generate = recording_generate
+    return recorded
+
+
+def _lane_acquired(lane):
+    return rate_limiter.get_limiter().get_stats()['lanes'][lane]['acquired']
+
+
+def test_generate_uses_interactive_lane(client, lanes, wait_for_task):
+    test_client, _ = client
+    before = _lane_acquired('interactive')
+    task_id = test_client.post('/generate', data={'prompt': '一只猫', 'num_images': 2}).get_json()['task_id']
+    assert wait_for_task(test_client, task_id)['status'] == 'completed'
+    assert lanes == ['interactive', 'interactive']
+    assert _lane_acquired('interactive') - before == 2
+
+
+@pytest.mark.parametrize('priority', ['batch', 'backfill'])
+def test_batch_task_uses_batch_priority(web_app_module, db, client, lanes, priority, tmp_path, monkeypatch):
+    # 批量任务的图片保存在当前目录下的 output 中
+    monkeypatch.chdir(tmp_path)
+    _, user_id = client
+    task = {'prompt': '一只猫', 'num_images': 2, 'aspect_ratio': '1:1', 'resolution': '2k'}
+    db.create_batch_job('b1', user_id, 'tester', [task], priority=priority)
+    claim = db.claim_batch_task('w1', 60)
+    assert claim['priority'] == priority
+
+    result = web_app_module.run_batch_task(claim)
+    assert result['success']
+    assert lanes == [priority, priority]
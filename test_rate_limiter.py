@@ -0,0 +1,168 @@
+"""
+测试全局限流器：并发上限、AIMD 调整、Retry-After 暂停、异步等待的唤醒，以及优先级通道
+"""
+import asyncio
+import threading
+import time
+
+import pytest
+
+import rate_limiter
+
+
+def _limiter(limit=2, reserved=0, rate=0):
+    return rate_limiter.AdaptiveLimiter(rate=rate, burst=16, initial=limit, minimum=1, maximum=limit * 4, reserved=reserved)
+
+
+def _acquire_in_thread(limiter, lane, order=None):
+    acquired = threading.Event()
+
+    def run():
+        limiter.acquire(lane)
+        if order is not None:
+            order.append(lane)
+        acquired.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return acquired
+
+
+def _wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    assert predicate()
+
+
+def test_concurrency_limit_blocks_until_release():
+    limiter = _limiter(limit=1)
+    limiter.acquire('batch')
+    acquired = _acquire_in_thread(limiter, 'batch')
+    assert not acquired.wait(0.1)
+    limiter.release('success')
+    assert acquired.wait(1)
+    assert limiter.get_stats()['in_flight'] == 1
+
+
+def test_aimd_adjusts_limit():
+    limiter = _limiter(limit=8)
+    limiter.acquire('batch')
+    limiter.release('throttled')
+    assert limiter.limit == 4
+    # 冷却期内的第二个 429 不再减半
+    limiter.acquire('batch')
+    limiter.release('throttled')
+    assert limiter.limit == 4
+    limiter.acquire('batch')
+    limiter.release('success')
+    assert limiter.limit == pytest.approx(4.25)
+    assert limiter.get_stats()['throttled_429'] == 2
+
+
+def test_retry_after_pauses_new_requests():
+    limiter = _limiter()
+    limiter.acquire('batch')
+    limiter.release('throttled', retry_after=0.2)
+    assert limiter.acquire('batch') >= 0.15
+
+
+def test_token_bucket_limits_rate():
+    limiter = rate_limiter.AdaptiveLimiter(rate=20, burst=1, initial=8, minimum=1, maximum=8)
+    limiter.acquire('batch')
+    limiter.release('success')
+    assert limiter.acquire('batch') >= 0.03
+
+
+def test_retry_after_header():
+    class Error(Exception):
+        pass
+
+    error = Error()
+    error.response = type('Response', (), {'headers': {'retry-after': '2'}})()
+    assert rate_limiter.retry_after(error) == 2
+    error.response.headers = {'retry-after-ms': '1500'}
+    assert rate_limiter.retry_after(error) == 1.5
+    assert rate_limiter.retry_after(Error()) is None
+
+
+def test_async_acquire_is_woken_by_release_without_polling(monkeypatch):
+    """协程等待名额时不轮询：名额归还后立即被唤醒"""
+    limiter = _limiter(limit=1)
+    limiter.acquire('batch')
+    attempts = []
+    original = limiter._try_acquire_locked
+
+    def counting(now, lane):
+        attempts.append(now)
+        return original(now, lane)
+
+    monkeypatch.setattr(limiter, '_try_acquire_locked', counting)
+
+    async def main():
+        task = asyncio.create_task(limiter.acquire_async('batch'))
+        await asyncio.sleep(0.3)
+        assert not task.done()
+        threading.Thread(target=limiter.release, args=('success',)).start()
+        return await asyncio.wait_for(task, 1)
+
+    waited = asyncio.run(main())
+    assert 0.25 <= waited < 0.45
+    assert len(attempts) == 2
+    assert limiter.get_stats()['waiting'] == 0
+
+
+def test_cancelled_async_acquire_leaves_wait_queue():
+    limiter = _limiter(limit=1)
+    limiter.acquire('batch')
+
+    async def main():
+        task = asyncio.create_task(limiter.acquire_async('batch'))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    stats = limiter.get_stats()
+    assert stats['waiting'] == 0 and stats['in_flight'] == 1
+    assert limiter._async_waiters == []
+
+
+def test_priority_context():
+    assert rate_limiter.current_priority() == 'batch'
+    with rate_limiter.priority('interactive'):
+        assert rate_limiter.current_priority() == 'interactive'
+        with rate_limiter.priority('unknown'):
+            assert rate_limiter.current_priority() == 'batch'
+    assert rate_limiter.current_priority() == 'batch'
+
+
+def test_reserved_slot_is_only_for_interactive():
+    limiter = _limiter(limit=2, reserved=1)
+    limiter.acquire('batch')
+    batch = _acquire_in_thread(limiter, 'batch')
+    assert not batch.wait(0.1)
+    # 预留名额给 interactive，批量请求仍在等待
+    limiter.acquire('interactive')
+    assert limiter.get_stats()['in_flight'] == 2
+    limiter.release('success')
+    limiter.release('success')
+    assert batch.wait(1)
+
+
+def test_waiting_interactive_goes_before_batch():
+    limiter = _limiter(limit=1)
+    limiter.acquire('batch')
+    order = []
+    backfill = _acquire_in_thread(limiter, 'backfill', order)
+    batch = _acquire_in_thread(limiter, 'batch', order)
+    _wait_until(lambda: limiter.get_stats()['waiting'] == 2)
+    interactive = _acquire_in_thread(limiter, 'interactive', order)
+    _wait_until(lambda: limiter.get_stats()['waiting'] == 3)
+
+    for event in (interactive, batch, backfill):
+        limiter.release('success')
+        assert event.wait(1)
+    assert order == ['interactive', 'batch', 'backfill']
+    lanes = limiter.get_stats()['lanes']
+    assert lanes['interactive']['acquired'] == 1 and lanes['backfill']['acquired'] == 1
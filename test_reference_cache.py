@@ -0,0 +1,112 @@
+"""
+测试参考图预处理：只下载允许列表中的地址，按内容复用，按体积选择内联或传原 URL
+"""
+import io
+import os
+import types
+
+import pytest
+from PIL import Image
+
+import ark_clients
+import reference_cache
+
+
+def _png_noise(size):
+    """难以压缩的大 PNG：预处理（缩小 + JPEG）后明显变小"""
+    img = Image.frombytes('RGB', size, os.urandom(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _small_jpeg():
+    """已经很小的 JPEG：重新编码后的 base64 不比原图小"""
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (64, 64), os.urandom(64 * 64 * 3)).save(buffer, 'JPEG', quality=20)
+    return buffer.getvalue()
+
+
+class FakeSession:
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(url)
+        return types.SimpleNamespace(status_code=200, content=self.files[url], headers={})
+
+
+@pytest.fixture
+def session(db, tmp_path, monkeypatch):
+    monkeypatch.setenv('REFERENCE_ALLOWED_HOSTS', 'img.test')
+    monkeypatch.setenv('REFERENCE_CACHE_DIR', str(tmp_path / 'refs'))
+    monkeypatch.setenv('REFERENCE_MAX_SIDE', '256')
+    for name in ('REFERENCE_DELIVERY', 'REFERENCE_PREPROCESS'):
+        monkeypatch.delenv(name, raising=False)
+    fake = FakeSession({
+        'https://img.test/big.png': _png_noise((600, 600)),
+        'https://img.test/copy.png': None,
+        'https://img.test/small.jpg': _small_jpeg(),
+    })
+    fake.files['https://img.test/copy.png'] = fake.files['https://img.test/big.png']
+    monkeypatch.setattr(ark_clients, 'get_http_session', lambda: fake)
+    return fake
+
+
+def test_large_original_is_inlined_without_oss(session):
+    [image], [key] = reference_cache.prepare(['https://img.test/big.png'], with_keys=True)
+    assert image.startswith('data:image/jpeg;base64,')
+    assert key.endswith(':256-jpeg-90')
+
+
+def test_small_original_url_is_passed_through(session):
+    """base64 不比原图小时传原 URL，仍然返回内容键"""
+    [image], [key] = reference_cache.prepare(['https://img.test/small.jpg'], with_keys=True)
+    assert image == 'https://img.test/small.jpg'
+    assert key is not None
+    assert reference_cache.get_stats()['passed_through'] >= 1
+
+
+def test_base64_delivery_always_inlines(session, monkeypatch):
+    monkeypatch.setenv('REFERENCE_DELIVERY', 'base64')
+    [image] = reference_cache.prepare(['https://img.test/small.jpg'])
+    assert image.startswith('data:image/jpeg;base64,')
+
+
+def test_uploader_url_is_used(session):
+    uploaded = []
+
+    def uploader(path):
+        uploaded.append(path)
+        return 'https://oss.test/' + os.path.basename(path)
+
+    [image] = reference_cache.prepare(['https://img.test/small.jpg'], uploader=uploader)
+    assert image == 'https://oss.test/' + os.path.basename(uploaded[0])
+
+
+def test_same_content_shares_key_and_url_is_cached(session):
+    _, keys = reference_cache.prepare(['https://img.test/big.png', 'https://img.test/copy.png'], with_keys=True)
+    assert keys[0] == keys[1]
+    # URL 在有效期内再次使用时不重新下载
+    reference_cache.prepare(['https://img.test/big.png'])
+    assert session.requests == ['https://img.test/big.png', 'https://img.test/copy.png']
+
+
+@pytest.mark.parametrize('source', [
+    'data:image/png;base64,iVBORw0KGgo=',
+    '/etc/passwd',
+    'https://other.test/a.jpg',
+])
+def test_sources_outside_allow_list_are_passed_through_unread(session, source):
+    """不在允许列表中的来源不在服务端读取，原样传给模型，不会被丢弃"""
+    images, keys = reference_cache.prepare(['https://img.test/small.jpg', source], with_keys=True)
+    assert images[1] == source and keys[1] is None
+    assert len(images) == 2
+    assert session.requests == ['https://img.test/small.jpg']
+
+
+def test_preprocess_disabled_returns_sources(session, monkeypatch):
+    monkeypatch.setenv('REFERENCE_PREPROCESS', 'false')
+    assert reference_cache.prepare(['https://img.test/big.png'], with_keys=True) == (['https://img.test/big.png'], [None])
+    assert session.requests == []
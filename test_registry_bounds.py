@@ -0,0 +1,86 @@
+"""
+测试长时间运行时的注册表上限：内存中的任务状态转存到 SQLite、批次日志条数上限、幂等键过期
+"""
+import time
+
+import pytest
+
+import state_store
+
+
+@pytest.fixture
+def spill(tmp_path):
+    return state_store.SqliteStateStore('tasks', str(tmp_path / 'state.db'))
+
+
+def test_memory_store_spills_oldest_over_max_entries(spill):
+    store = state_store.MemoryStateStore('tasks', max_entries=2, spill=spill)
+    for n in range(3):
+        store.set(f't{n}', {'n': n})
+    assert len(store) == 2
+    assert spill.get('t0') == {'n': 0} and spill.get('t2') is None
+
+    # 已转存的状态照常读取和修改
+    assert store.get('t0') == {'n': 0}
+    assert store.update('t0', lambda state: state.update(n=10)) == {'n': 10}
+    assert spill.get('t0') == {'n': 10}
+    stats = store.get_stats()
+    assert stats['evicted'] == 1 and stats['spill_reads'] == 1 and stats['spilled']['entries'] == 1
+
+    store.delete('t0')
+    assert store.get('t0') is None
+
+
+def test_memory_store_spills_expired_states(spill):
+    store = state_store.MemoryStateStore('tasks', ttl=0.05, spill=spill)
+    store.set('old', {'status': 'completed'})
+    time.sleep(0.1)
+    assert store.get_stats()['entries'] == 0
+    assert store.get('old') == {'status': 'completed'}
+
+
+def test_updates_keep_active_states_in_memory(spill):
+    """最近更新的状态排在最后，上限只转存最久没有更新的状态"""
+    store = state_store.MemoryStateStore('tasks', max_entries=2, spill=spill)
+    store.set('a', {'n': 0})
+    store.set('b', {'n': 0})
+    store.update('a', lambda state: state.update(n=1))
+    store.set('c', {'n': 0})
+    assert spill.get('b') == {'n': 0} and spill.get('a') is None
+
+
+def test_memory_store_without_spill_drops_states():
+    store = state_store.MemoryStateStore('tasks', max_entries=1)
+    store.set('a', {})
+    store.set('b', {})
+    assert store.get('a') is None and store.update('a', lambda state: None) is None
+
+
+def test_batch_logs_are_capped(db):
+    db.create_batch_job('b1', 1, 'tester', [{'prompt': 'p0'}])
+    for n in range(5):
+        db.add_batch_log('b1', f'log {n}', max_entries=3)
+    assert [log['message'] for log in db.get_batch_job('b1')['logs']] == ['log 2', 'log 3', 'log 4']
+    assert db.get_batch_log_stats() == {'entries': 3, 'batches': 1, 'largest_batch': 3}
+
+
+def test_expired_idempotency_keys_are_removed(db):
+    db.claim_idempotency_key(1, 'generate', 'old', 'f', 'task-1', ttl=0.05)
+    db.claim_idempotency_key(1, 'batch', 'kept', 'f', 'batch-1', ttl=60)
+    time.sleep(0.1)
+    assert db.get_idempotency_stats() == {'entries': 1, 'scopes': {'batch': 1}}
+    # 过期的键在下一次登记时删除，同一个键可以重新登记
+    assert db.claim_idempotency_key(1, 'generate', 'old', 'f', 'task-2', ttl=60)['resource_id'] == 'task-2'
+
+
+def test_client_pool_stats_reports_registries(client, db):
+    test_client, _ = client
+    assert test_client.get('/api/client-pool-stats').status_code == 403
+    db.create_user('system_admin', 'pw')
+    admin = db.verify_user('system_admin', 'pw')
+    with test_client.session_transaction() as session:
+        session['user_id'] = admin['id']
+        session['username'] = admin['username']
+    registries = test_client.get('/api/client-pool-stats').get_json()['registries']
+    assert set(registries) == {'task_state', 'batch_logs', 'idempotency_keys'}
+    assert 'single_generation' in registries['task_state']
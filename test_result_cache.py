@@ -0,0 +1,73 @@
+"""
+测试生成结果缓存：缓存键和命中规则
+"""
+import pytest
+
+import result_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('RESULT_CACHE_ENABLED', 'true')
+    monkeypatch.setenv('RESULT_CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+def test_make_key_ignores_dict_order():
+    a = result_cache.make_key({'prompt': '猫', 'size': '2048x2048', 'index': 0})
+    b = result_cache.make_key({'index': 0, 'size': '2048x2048', 'prompt': '猫'})
+    assert a == b
+
+
+def test_generate_cache_key_depends_on_index_references_and_seed(web_app_module):
+    key = web_app_module.generate_cache_key
+    base = key('猫', '2560x1440', 1024, 576, 0, ['sha256:a'], 42)
+    assert base == key('猫', '2560x1440', 1024, 576, 0, ['sha256:a'], 42)
+    assert base != key('猫', '2560x1440', 1024, 576, 1, ['sha256:a'], 42)
+    assert base != key('猫', '2560x1440', 1024, 576, 0, ['sha256:b'], 42)
+    assert base != key('猫', '2560x1440', 1024, 576, 0, ['sha256:a'], 43)
+
+
+def test_cache_store_and_lookup(db, tmp_path, cache_dir):
+    src = tmp_path / 'image.jpg'
+    src.write_bytes(b'jpeg-bytes')
+    cache_key = result_cache.make_key({'prompt': '猫'})
+
+    assert result_cache.lookup(cache_key, str(tmp_path / 'miss.jpg')) is None
+    result_cache.store(cache_key, str(src), src.stat().st_size, 'sha')
+    dest = tmp_path / 'out' / 'hit.jpg'
+    assert result_cache.lookup(cache_key, str(dest)) is not None
+    assert dest.read_bytes() == b'jpeg-bytes'
+
+
+def test_cache_lookup_drops_entry_with_missing_file(db, tmp_path, cache_dir):
+    src = tmp_path / 'image.jpg'
+    src.write_bytes(b'jpeg-bytes')
+    cache_key = result_cache.make_key({'prompt': '狗'})
+    result_cache.store(cache_key, str(src), src.stat().st_size, 'sha')
+    (cache_dir / cache_key[:2] / (cache_key + '.jpg')).unlink()
+
+    assert result_cache.lookup(cache_key, str(tmp_path / 'out.jpg')) is None
+    assert db.get_cache_entry(cache_key) is None
+
+
+def _generate(test_client, wait_for_task, **fields):
+    data = dict({'prompt': '一只猫', 'output_filename': 'cat'}, **fields)
+    response = test_client.post('/generate', data=data)
+    return wait_for_task(test_client, response.get_json()['task_id'])
+
+
+def test_generate_reuses_result_for_same_seed_only(client, fake_ark, wait_for_task, cache_dir):
+    test_client, _ = client
+    assert _generate(test_client, wait_for_task, seed='42')['status'] == 'completed'
+    assert len(fake_ark.calls) == 1
+
+    # 相同种子命中缓存，不再调用 API
+    assert _generate(test_client, wait_for_task, seed='42')['status'] == 'completed'
+    assert len(fake_ark.calls) == 1
+
+    # 换一个种子、不指定种子或跳过缓存时重新生成
+    _generate(test_client, wait_for_task, seed='43')
+    _generate(test_client, wait_for_task)
+    _generate(test_client, wait_for_task, seed='42', bypass_cache='true')
+    assert len(fake_ark.calls) == 4
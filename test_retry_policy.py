@@ -0,0 +1,166 @@
+"""
+测试重试策略：退避重试、重试预算记账、对冲，以及与限流器之间只有一层重试
+"""
+import asyncio
+import collections
+import types
+
+import openai
+import pytest
+
+import rate_limiter
+import retry_policy
+
+
+def _status_error(status, headers=None):
+    response = types.SimpleNamespace(status_code=status, headers=headers or {}, request=None)
+    if status == 429:
+        return openai.RateLimitError('rate limited', response=response, body=None)
+    return openai.APIStatusError(f'status {status}', response=response, body=None)
+
+
+@pytest.fixture(autouse=True)
+def fresh_policy(monkeypatch):
+    monkeypatch.setattr(retry_policy, '_budget', {'balance': None})
+    monkeypatch.setattr(retry_policy, '_stats', dict.fromkeys(retry_policy._stats, 0))
+    monkeypatch.setattr(rate_limiter, '_limiter', None)
+    monkeypatch.setenv('ARK_RETRY_ATTEMPTS', '3')
+    monkeypatch.setenv('ARK_RETRY_BASE_DELAY', '0')
+    monkeypatch.setenv('ARK_RETRY_MAX_DELAY', '0')
+    monkeypatch.setenv('ARK_RETRY_BUDGET_RATIO', '0.2')
+    monkeypatch.setenv('ARK_RETRY_BUDGET_RESERVE', '10')
+    monkeypatch.setenv('ARK_HEDGE_ENABLED', 'false')
+    monkeypatch.setenv('ARK_THROTTLE_RETRIES', '3')
+    monkeypatch.setattr(rate_limiter, '_backoff', lambda attempt, delay: 0)
+
+
+def _flaky(failures, error):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise error
+        return 'ok'
+    return func, calls
+
+
+def test_retries_until_success():
+    func, calls = _flaky(2, _status_error(503))
+    assert retry_policy.call(func) == 'ok'
+    stats = retry_policy.get_stats()
+    assert len(calls) == 3
+    assert stats['retries'] == 2 and stats['retry_successes'] == 1
+
+
+def test_gives_up_after_max_attempts():
+    func, calls = _flaky(10, _status_error(503))
+    with pytest.raises(openai.APIStatusError):
+        retry_policy.call(func)
+    assert len(calls) == 3
+    assert retry_policy.get_stats()['failures'] == 1
+
+
+def test_client_errors_are_not_retried():
+    func, calls = _flaky(10, _status_error(400))
+    with pytest.raises(openai.APIStatusError):
+        retry_policy.call(func)
+    assert len(calls) == 1
+
+
+def test_budget_limits_retries(monkeypatch):
+    """每次调用存入 ratio 个额度，每次重试取出 1 个；额度不足时直接失败"""
+    monkeypatch.setenv('ARK_RETRY_BUDGET_RATIO', '0')
+    monkeypatch.setenv('ARK_RETRY_BUDGET_RESERVE', '2')
+    func, calls = _flaky(100, _status_error(503))
+    with pytest.raises(openai.APIStatusError):
+        retry_policy.call(func)
+    assert len(calls) == 3
+    assert retry_policy.get_stats()['budget_balance'] == 0
+
+    with pytest.raises(openai.APIStatusError):
+        retry_policy.call(func)
+    assert len(calls) == 4
+    assert retry_policy.get_stats()['budget_denied'] == 1
+
+
+def test_limiter_does_not_retry_under_policy():
+    """经过重试策略的调用只在策略这一层重试：一张图片最多 ARK_RETRY_ATTEMPTS 次请求，且全部计入预算"""
+    func, calls = _flaky(100, _status_error(429))
+    with pytest.raises(openai.RateLimitError):
+        retry_policy.call(lambda: rate_limiter.call(func))
+    assert len(calls) == 3
+    assert retry_policy.get_stats()['retries'] == 2
+    assert rate_limiter.get_limiter().get_stats()['retries'] == 0
+
+
+def test_limiter_retries_on_its_own_outside_policy():
+    func, calls = _flaky(100, _status_error(503))
+    with pytest.raises(openai.APIStatusError):
+        rate_limiter.call(func)
+    assert len(calls) == 4
+
+
+def test_async_limiter_does_not_retry_under_policy():
+    calls = []
+
+    async def func():
+        calls.append(1)
+        raise _status_error(503)
+
+    with pytest.raises(openai.APIStatusError):
+        asyncio.run(retry_policy.call_async(lambda: rate_limiter.call_async(func)))
+    assert len(calls) == 3
+
+
+def test_backoff_honours_retry_after():
+    settings = retry_policy.get_settings()
+    assert retry_policy._backoff(settings, 0, _status_error(429, {'retry-after': '1.5'})) == 1.5
+    assert retry_policy._backoff(settings, 0, _status_error(503)) == 0
+
+
+def test_cancelled_async_call_releases_limiter_slot():
+    """调用进行中被取消时归还名额，in_flight 回到 0"""
+    async def main():
+        running = asyncio.Event()
+
+        async def slow():
+            running.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(rate_limiter.call_async(slow))
+        await running.wait()
+        assert rate_limiter.get_limiter().get_stats()['in_flight'] == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    stats = rate_limiter.get_limiter().get_stats()
+    assert stats['in_flight'] == 0 and stats['cancelled'] == 1
+
+
+def test_hedge_loser_releases_limiter_slot(monkeypatch):
+    """对冲请求先完成时，被取消的原请求也归还限流器名额"""
+    monkeypatch.setenv('ARK_HEDGE_ENABLED', 'true')
+    monkeypatch.setenv('ARK_HEDGE_MIN_DELAY', '0.05')
+    monkeypatch.setenv('ARK_HEDGE_MIN_SAMPLES', '1')
+    monkeypatch.setattr(retry_policy, '_latencies', collections.deque([0.01], maxlen=500))
+    calls = []
+
+    async def func():
+        calls.append(1)
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return 'hedged'
+
+    async def main():
+        result = await retry_policy.call_async(lambda: rate_limiter.call_async(func))
+        # 让被取消的原请求执行完 finally
+        await asyncio.sleep(0.01)
+        return result
+
+    assert asyncio.run(main()) == 'hedged'
+    assert retry_policy.get_stats()['hedge_wins'] == 1
+    stats = rate_limiter.get_limiter().get_stats()
+    assert stats['in_flight'] == 0 and stats['cancelled'] == 1
@@ -0,0 +1,119 @@
+"""
+测试进行中请求合并：相同的请求同时到达时只执行一次
+"""
+import threading
+
+import singleflight
+
+
+def test_make_key_is_canonical():
+    assert singleflight.make_key('g', {'a': 1, 'b': [1, 2]}) == singleflight.make_key('g', {'b': [1, 2], 'a': 1})
+    assert singleflight.make_key('g', {'a': 1}) != singleflight.make_key('g', {'a': 2})
+
+
+def _run_concurrently(group, key, func, count):
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def worker(n):
+        barrier.wait()
+        try:
+            results[n] = group.do(key, func, weight=2)
+        except Exception as e:
+            results[n] = e
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def test_identical_calls_execute_once():
+    group = singleflight.SingleFlight('test')
+    calls = []
+    release = threading.Event()
+
+    def func():
+        calls.append(1)
+        release.wait(5)
+        return 'image'
+
+    timer = threading.Timer(0.2, release.set)
+    timer.start()
+    results = _run_concurrently(group, 'k', func, 4)
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ['image'] * 4
+    assert sorted(shared for _, shared in results) == [False, True, True, True]
+    stats = group.get_stats()
+    assert stats == {'executed': 1, 'coalesced': 3, 'saved_calls': 6, 'in_flight': 0}
+
+
+def test_error_is_shared_and_key_is_released():
+    group = singleflight.SingleFlight('test')
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError('upstream')
+
+    threading.Timer(0.2, release.set).start()
+    results = _run_concurrently(group, 'k', fail, 3)
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+    # 结束后同一个键重新执行
+    assert group.do('k', lambda: 'ok') == ('ok', False)
+
+
+def test_get_group_returns_same_instance():
+    assert singleflight.get_group('test-group') is singleflight.get_group('test-group')
+    assert 'test-group' in singleflight.get_stats()
+
+
+def test_duplicate_generate_returns_running_task(client, fake_ark, wait_for_task):
+    """任务进行中重复提交同样的 /generate 返回同一个 task_id，只调用一次 API"""
+    test_client, _ = client
+    fake_ark.delay = 0.3
+    data = {'prompt': '一只猫', 'output_filename': 'cat'}
+    first = test_client.post('/generate', data=data).get_json()
+    second = test_client.post('/generate', data=data).get_json()
+    assert second['task_id'] == first['task_id'] and second['coalesced']
+
+    different = test_client.post('/generate', data=dict(data, prompt='一只狗')).get_json()
+    assert different['task_id'] != first['task_id']
+    for task_id in (first['task_id'], different['task_id']):
+        assert wait_for_task(test_client, task_id)['status'] == 'completed'
+    assert len(fake_ark.calls) == 2
+
+
+def test_batch_generate_is_coalesced(web_app_module, client, monkeypatch):
+    """/api/batch-generate 的相同请求同时到达时只生成一次，所有请求拿到同一个结果"""
+    test_client, _ = client
+    calls = []
+    release = threading.Event()
+
+    def fake_batch_generate(batch_id):
+        calls.append(batch_id)
+        release.wait(5)
+        return web_app_module.jsonify({'success': True, 'batch_id': batch_id})
+
+    monkeypatch.setattr(web_app_module, '_batch_generate', fake_batch_generate)
+    with test_client.session_transaction() as session:
+        user_session = dict(session)
+    responses = []
+
+    def post():
+        other = web_app_module.app.test_client()
+        with other.session_transaction() as session:
+            session.update(user_session)
+        responses.append(other.post('/api/batch-generate', json={'prompt': '一只猫', 'num_images': 1}))
+
+    threads = [threading.Thread(target=post) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    threading.Timer(0.3, release.set).start()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert {response.get_json()['batch_id'] for response in responses} == {calls[0]}
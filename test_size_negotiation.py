@@ -0,0 +1,80 @@
+"""
+测试分辨率协商：请求尺寸映射到模型支持的最小尺寸，生成后本地缩放回请求尺寸
+"""
+import pytest
+from PIL import Image
+
+import size_negotiation
+
+
+@pytest.fixture(autouse=True)
+def default_constraints(monkeypatch):
+    for name in ('ARK_MIN_PIXELS', 'ARK_MAX_PIXELS', 'ARK_SIZE_MULTIPLE', 'ARK_LOCAL_RESIZE'):
+        monkeypatch.delenv(name, raising=False)
+
+
+def test_negotiate_scales_up_small_sizes():
+    """请求尺寸低于模型最小像素时按比例放大，取整到倍数后仍能覆盖请求尺寸"""
+    result = size_negotiation.negotiate(1024, 576)
+    c = size_negotiation.get_constraints()
+    assert result['actual_width'] * result['actual_height'] >= c['min_pixels']
+    assert result['actual_width'] % c['multiple'] == 0 and result['actual_height'] % c['multiple'] == 0
+    assert result['actual_width'] >= 1024 and result['actual_height'] >= 576
+    assert result['size'] == f"{result['actual_width']}x{result['actual_height']}"
+    assert result['needs_resize']
+
+
+def test_negotiate_keeps_supported_sizes():
+    result = size_negotiation.negotiate(2048, 2048)
+    assert (result['actual_width'], result['actual_height']) == (2048, 2048)
+    assert not result['needs_resize']
+
+
+def test_negotiate_never_exceeds_max_pixels():
+    result = size_negotiation.negotiate(8192, 8192)
+    assert result['actual_width'] * result['actual_height'] <= size_negotiation.get_constraints()['max_pixels']
+
+
+def test_negotiate_reads_constraints_from_env(monkeypatch):
+    monkeypatch.setenv('ARK_MIN_PIXELS', str(1024 * 1024))
+    monkeypatch.setenv('ARK_SIZE_MULTIPLE', '64')
+    result = size_negotiation.negotiate(1000, 1000)
+    assert (result['actual_width'], result['actual_height']) == (1024, 1024)
+
+
+def test_fit_image_crops_and_resizes_to_requested_size(tmp_path):
+    path = tmp_path / 'image.jpg'
+    Image.new('RGB', (320, 200)).save(path, 'JPEG')
+    negotiation = dict(size_negotiation.negotiate(160, 90), actual_width=320, actual_height=200, needs_resize=True)
+    assert size_negotiation.fit_image(str(path), negotiation) == (320, 200)
+    with Image.open(path) as img:
+        assert img.size == (160, 90)
+    assert [p.name for p in tmp_path.iterdir()] == ['image.jpg']
+
+
+def test_fit_image_can_be_disabled(tmp_path, monkeypatch):
+    monkeypatch.setenv('ARK_LOCAL_RESIZE', 'false')
+    path = tmp_path / 'image.jpg'
+    Image.new('RGB', (320, 200)).save(path, 'JPEG')
+    negotiation = dict(size_negotiation.negotiate(160, 90), actual_width=320, actual_height=200, needs_resize=True)
+    assert size_negotiation.fit_image(str(path), negotiation) == (320, 200)
+    with Image.open(path) as img:
+        assert img.size == (320, 200)
+
+
+def test_generate_cache_key_includes_requested_size(web_app_module):
+    """1k 和 2k 请求可能协商到同一个 Ark 尺寸，缓存的是缩放后的图片，键必须不同"""
+    small = size_negotiation.negotiate(1024, 576)
+    large = size_negotiation.negotiate(2048, 1152)
+    key = web_app_module.generate_cache_key
+    assert key('猫', small['size'], 1024, 576, 0, [], 1) != key('猫', small['size'], 2048, 1152, 0, [], 1)
+    assert key('猫', small['size'], 1024, 576, 0, [], 1) != key('猫', large['size'], 2048, 1152, 0, [], 1)
+    assert key('猫', small['size'], 1024, 576, 0, [], 1) == key('猫', small['size'], 1024, 576, 0, [], 1)
+
+
+def test_generate_requests_negotiated_size(client, fake_ark, wait_for_task):
+    """1k 请求按协商尺寸调用 API，结果记录实际生成尺寸"""
+    test_client, _ = client
+    response = test_client.post('/generate', data={'prompt': '一只猫', 'aspect_ratio': '16:9', 'resolution': '1k'})
+    assert wait_for_task(test_client, response.get_json()['task_id'])['status'] == 'completed'
+    assert fake_ark.calls[0]['size'] == size_negotiation.negotiate(1024, 576)['size']
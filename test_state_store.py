@@ -0,0 +1,98 @@
+"""
+测试任务状态存储：多个工作进程共享 SQLite 中的状态，会话密钥在进程之间一致
+"""
+import threading
+import time
+
+import pytest
+
+import state_store
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'state.db')
+
+
+def test_sqlite_state_is_shared_between_stores(path):
+    """两个存储实例模拟两个工作进程：一个写入，另一个能读到"""
+    writer = state_store.SqliteStateStore('tasks', path)
+    reader = state_store.SqliteStateStore('tasks', path)
+    writer.set('t1', {'status': 'queued', 'progress': 0})
+    assert reader.get('t1') == {'status': 'queued', 'progress': 0}
+    assert state_store.SqliteStateStore('other', path).get('t1') is None
+
+    reader.delete('t1')
+    assert writer.get('t1') is None
+
+
+def test_sqlite_update_is_atomic_across_stores(path):
+    stores = [state_store.SqliteStateStore('tasks', path) for _ in range(4)]
+    stores[0].set('t1', {'progress': 0})
+
+    def increment(state):
+        state['progress'] += 1
+
+    def worker(store):
+        for _ in range(10):
+            store.update('t1', increment)
+
+    threads = [threading.Thread(target=worker, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert stores[0].get('t1') == {'progress': 40}
+    assert stores[0].update('missing', increment) is None
+
+
+def test_sqlite_prunes_old_states(path):
+    store = state_store.SqliteStateStore('tasks', path, retention=0.05)
+    store.set('old', {'status': 'completed'})
+    time.sleep(0.1)
+    # 清理每个进程最多每分钟一次
+    store._last_prune = 0.0
+    store.set('new', {'status': 'queued'})
+    assert store.get('old') is None and store.get('new') is not None
+    assert store.get_stats()['pruned'] == 1
+
+
+def test_get_store_uses_configured_backend(path, monkeypatch):
+    monkeypatch.setattr(state_store, '_stores', {})
+    monkeypatch.setenv('STATE_DB_PATH', path)
+    monkeypatch.setenv('STATE_BACKEND', 'sqlite')
+    store = state_store.get_store('tasks')
+    assert store.backend == 'sqlite' and state_store.get_store('tasks') is store
+    monkeypatch.setenv('STATE_BACKEND', 'memory')
+    assert state_store.get_store('other').backend == 'memory'
+
+
+def test_secret_key_prefers_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv('SECRET_KEY', 'from-env')
+    assert state_store.load_secret_key(str(tmp_path / 'key')) == 'from-env'
+    assert not (tmp_path / 'key').exists()
+
+
+def test_secret_key_file_is_shared(tmp_path, monkeypatch):
+    """未配置 SECRET_KEY 时多个进程读取同一个密钥文件，会话在进程之间通用"""
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    key_path = str(tmp_path / 'key')
+    keys = []
+    threads = [threading.Thread(target=lambda: keys.append(state_store.load_secret_key(key_path))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(keys)) == 1 and len(keys[0]) == 64
+
+
+def test_generate_status_is_read_from_store(web_app_module, client, path, monkeypatch):
+    """其他工作进程写入的任务状态也能通过状态接口查到"""
+    test_client, user_id = client
+    shared = state_store.SqliteStateStore('single_generation', path)
+    monkeypatch.setattr(web_app_module, 'single_generation_tasks', shared)
+    state_store.SqliteStateStore('single_generation', path).set('t1', {'user_id': user_id, 'status': 'generating'})
+    body = test_client.get('/api/single-generation-status/t1').get_json()
+    assert body['task']['status'] == 'generating'
+    state_store.SqliteStateStore('single_generation', path).set('t2', {'user_id': user_id + 1, 'status': 'generating'})
+    assert test_client.get('/api/single-generation-status/t2').status_code == 403
@@ -1,18 +1,37 @@
 import os
 import json
 import base64
+import hashlib
 import random
 import uuid
 import threading
 import logging
 import time
-from datetime import datetime
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, send_from_directory, session, redirect, url_for, flash
+from flask import Flask, Request, Response, render_template, request, jsonify, send_from_directory, session, redirect, url_for, flash
 from werkzeug.utils import secure_filename
-from openai import OpenAI
+import openai
 import database
+import ark_clients
+import batch_async
+import image_download
+import pipeline
+import result_cache
+import rate_limiter
+import retry_policy
+import singleflight
+import size_negotiation
+import job_queue
+import state_store
+import reference_cache
+import event_stream
+import batch_import
+import latency_stats
 
 # 配置日志
 log_dir = Path('logs')
@@ -47,14 +66,6 @@ logger.addHandler(console_handler)
 app_logger = logging.getLogger('app')
 app_logger.setLevel(logging.INFO)
 
-# 全局变量：存储批量任务进度
-batch_progress = {}
-batch_progress_lock = threading.Lock()
-
-# 全局变量：存储单图生成任务状态
-single_generation_tasks = {}
-single_generation_lock = threading.Lock()
-
 # 阿里云 OSS 上传支持
 def upload_to_aliyun_oss(file_path, user_id=None, is_sample=False):
     """
@@ -197,11 +208,21 @@ def list_sample_images_from_oss(user_id=None):
         traceback.print_exc()
         return []
 
+class AppRequest(Request):
+    """表格导入（/api/batch-import）的请求体上限为 BATCH_IMPORT_MAX_MB，其他接口仍为 MAX_CONTENT_LENGTH"""
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'batch_import_file':
+            # 上传的表格由 werkzeug 写入临时文件，不会整体读入内存
+            return max(1, int(os.environ.get('BATCH_IMPORT_MAX_MB', '200'))) * 1024 * 1024
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = AppRequest
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production-' + str(uuid.uuid4()))
 
 # 确保文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -250,6 +271,26 @@ if dotenv_path:
     print(f'Loading .env from: {dotenv_path}')
     load_dotenv_file(dotenv_path)
 
+# 会话密钥必须在所有工作进程之间一致（在加载 .env 之后读取，.env 中的 SECRET_KEY 才会生效）；
+# 未配置时由 init_app() 读取（首次生成）密钥文件，导入模块时不写文件
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+
+# 单图生成任务状态（STATE_BACKEND=sqlite 时多个工作进程共享，状态查询可以落到任意进程）
+single_generation_tasks = state_store.get_store('single_generation')
+
+def update_single_task(task_id, **fields):
+    """更新单图生成任务状态（任务不存在时忽略）"""
+    return modify_single_task(task_id, lambda state: state.update(fields))
+
+def modify_single_task(task_id, func):
+    """原子地修改单图生成任务状态（revision 加一，作为推送的事件ID），并通知状态推送（SSE）的订阅者"""
+    def apply(state):
+        func(state)
+        state['revision'] = state.get('revision', 0) + 1
+    state = single_generation_tasks.update(task_id, apply)
+    event_stream.publish(f'single:{task_id}')
+    return state
+
 # 尺寸比例到像素的映射
 ASPECT_RATIOS = {
     '1:1': {'1k': (1024, 1024), '2k': (2048, 2048), '4k': (4096, 4096)},
@@ -261,6 +302,232 @@ ASPECT_RATIOS = {
     '9:16': {'1k': (576, 1024), '2k': (1152, 2048), '4k': (2304, 4096)},
 }
 
+# ==================== 并发生成配置 ====================
+# GENERATE_CONCURRENT: /generate 多张图片时是否并发调用 API 和下载
+# GENERATE_PER_REQUEST_CONCURRENCY: 单个请求内同时进行的图片数
+# GENERATE_MAX_WORKERS: 进程级并发上限（所有请求共享同一个线程池）
+GENERATE_CONCURRENT = os.environ.get('GENERATE_CONCURRENT', 'true').lower() == 'true'
+GENERATE_PER_REQUEST_CONCURRENCY = max(1, int(os.environ.get('GENERATE_PER_REQUEST_CONCURRENCY', '4')))
+GENERATE_MAX_WORKERS = max(1, int(os.environ.get('GENERATE_MAX_WORKERS', '8')))
+# GENERATE_TASK_WORKERS: 同时在后台执行的 /generate 任务数（请求立即返回，超出的任务排队）
+GENERATE_TASK_WORKERS = max(1, int(os.environ.get('GENERATE_TASK_WORKERS', '4')))
+
+# BATCH_EXECUTOR: 批量任务中图片的生成方式，thread（队列工作线程内顺序执行）、async（asyncio 并发）
+# 或 pipeline（生成、下载、写记录、上传分阶段并行）；任务本身由持久化队列调度（见 job_queue）
+BATCH_EXECUTOR = os.environ.get('BATCH_EXECUTOR', 'thread').lower()
+
+generation_executor = ThreadPoolExecutor(max_workers=GENERATE_MAX_WORKERS, thread_name_prefix='generate')
+# /generate 任务单独一个线程池：任务内部还要通过 run_bounded 使用 generation_executor，共用会互相等待
+generate_task_executor = ThreadPoolExecutor(max_workers=GENERATE_TASK_WORKERS, thread_name_prefix='generate-task')
+# 批量任务图片的 OSS 上传：记录先以本地地址写入，上传完成后再改为 OSS URL，上传慢或失败不影响生成
+# OSS_UPLOAD_WORKERS: 同时上传的图片数；OSS_UPLOAD_QUEUE_SIZE: 等待上传的图片数上限，
+# 排满后写完记录的生成线程等待上传名额（背压），OSS 变慢时待上传的图片不会在内存中无限堆积
+OSS_UPLOAD_WORKERS = max(1, int(os.environ.get('OSS_UPLOAD_WORKERS', '4')))
+OSS_UPLOAD_QUEUE_SIZE = max(0, int(os.environ.get('OSS_UPLOAD_QUEUE_SIZE', '32')))
+oss_upload_executor = ThreadPoolExecutor(max_workers=OSS_UPLOAD_WORKERS, thread_name_prefix='oss-upload')
+oss_upload_slots = threading.BoundedSemaphore(OSS_UPLOAD_WORKERS + OSS_UPLOAD_QUEUE_SIZE)
+oss_upload_lock = threading.Lock()
+oss_upload_stats = {'pending': 0, 'waits': 0}
+# 进行中的 /generate 请求（去重键 -> task_id），重复提交时返回同一个任务
+generate_inflight = {}
+generate_inflight_lock = threading.Lock()
+
+def run_bounded(func, items, limit):
+    """
+    在共享线程池中执行 func(item)，同一次调用最多 limit 个任务同时运行
+    
+    返回结果按 items 的顺序排列。不要在 generation_executor 的工作线程内调用，
+    否则线程池占满时会互相等待。func 在调用方的上下文副本中执行（保留 API 调用的优先级）。
+    """
+    semaphore = threading.BoundedSemaphore(max(1, limit))
+    futures = []
+    for item in items:
+        semaphore.acquire()
+        try:
+            future = generation_executor.submit(contextvars.copy_context().run, func, item)
+        except Exception:
+            semaphore.release()
+            raise
+        future.add_done_callback(lambda _f: semaphore.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+# ==================== 图片响应方式 ====================
+# ARK_RESPONSE_FORMAT: url（返回图片链接，再下载一次）或 b64_json（图片内容随响应返回，直接解码写盘）
+ARK_RESPONSE_FORMAT = os.environ.get('ARK_RESPONSE_FORMAT', 'url').lower()
+if ARK_RESPONSE_FORMAT not in ('url', 'b64_json'):
+    print(f"⚠️  不支持的 ARK_RESPONSE_FORMAT: {ARK_RESPONSE_FORMAT}，使用 url")
+    ARK_RESPONSE_FORMAT = 'url'
+
+def _image_request_kwargs(model, full_prompt, ark_size, reference_images=None):
+    kwargs = {
+        'model': model,
+        'prompt': full_prompt,
+        'size': ark_size,
+        'response_format': ARK_RESPONSE_FORMAT,
+        'extra_body': {
+            "watermark": False,
+        }
+    }
+    if reference_images:
+        kwargs['extra_body']['image'] = list(reference_images)
+    return kwargs
+
+# ==================== 参考图预处理 ====================
+def prepare_reference_images(urls, local_paths=None, with_keys=False):
+    """
+    预处理参考图（缩小、去元数据、转码，按内容哈希缓存），返回发送给模型的图片列表
+    
+    启用 OSS 时预处理后的图片上传到 OSS 并传 URL，否则 base64 比原图小时内联，不比原图小时传原 URL；
+    local_paths 为 {URL: 本地路径}，刚上传的图片不用再下载一次。
+    with_keys 为 True 时同时返回每张参考图的内容键（未经预处理的为 None）。
+    """
+    if not urls:
+        return ([], []) if with_keys else []
+    oss_enabled = os.environ.get('OSS_ENABLED', 'false').lower() == 'true'
+    uploader = upload_to_aliyun_oss if oss_enabled else None
+    return reference_cache.prepare(urls, local_paths=local_paths, uploader=uploader, with_keys=with_keys)
+
+# 图片生成模型（耗时统计和批量预估按模型区分）
+IMAGE_MODEL = "doubao-seedream-4-5-251128"
+
+def _timed_generate(client, kwargs):
+    # 重试由全局限流器负责（需要看到每一次 429），关闭 SDK 自带的重试
+    api_start_time = time.time()
+    response = client.with_options(max_retries=0).images.generate(**kwargs)
+    return response, time.time() - api_start_time
+
+async def _timed_generate_async(client, kwargs):
+    api_start_time = time.time()
+    response = await client.with_options(max_retries=0).images.generate(**kwargs)
+    return response, time.time() - api_start_time
+
+def request_image(client, full_prompt, ark_size, model=IMAGE_MODEL, reference_images=None):
+    """
+    单张图片生成调用，返回 response.data 中的第一张图片（url 或 b64_json），没有图片时返回 None
+    
+    调用经过全局限流器（被限流时按 Retry-After 重试），连接错误、超时等失败按退避策略重试，
+    开启对冲时慢调用会额外发出一次请求；API 耗时按响应方式记入遥测，
+    用于比较 url / b64_json 两种方式的端到端耗时，并按模型和尺寸持久化（批量预估使用）。
+    reference_images 为 prepare_reference_images 返回的参考图列表。
+    """
+    kwargs = _image_request_kwargs(model, full_prompt, ark_size, reference_images)
+    response, api_duration = retry_policy.call(lambda: rate_limiter.call(_timed_generate, client, kwargs))
+    image_download.record_api_time(ARK_RESPONSE_FORMAT, api_duration)
+    latency_stats.record_api(model, ark_size, api_duration)
+    if response.data and len(response.data) > 0:
+        return response.data[0]
+    return None
+
+async def request_image_async(client, full_prompt, ark_size, model=IMAGE_MODEL, reference_images=None):
+    """request_image 的异步版本（client 为 AsyncOpenAI）"""
+    kwargs = _image_request_kwargs(model, full_prompt, ark_size, reference_images)
+    response, api_duration = await retry_policy.call_async(lambda: rate_limiter.call_async(_timed_generate_async, client, kwargs))
+    image_download.record_api_time(ARK_RESPONSE_FORMAT, api_duration)
+    latency_stats.record_api(model, ark_size, api_duration)
+    if response.data and len(response.data) > 0:
+        return response.data[0]
+    return None
+
+def save_generated_image(image, dest_path, ark_size, model=IMAGE_MODEL):
+    """下载（或解码 b64_json）生成的图片，下载耗时按模型和尺寸记入耗时统计"""
+    download = image_download.save_image(image, dest_path)
+    latency_stats.record_download(model, ark_size, download['duration'])
+    return download
+
+async def save_generated_image_async(image, dest_path, ark_size, model=IMAGE_MODEL):
+    """save_generated_image 的异步版本"""
+    download = await image_download.save_image_async(image, dest_path)
+    latency_stats.record_download(model, ark_size, download['duration'])
+    return download
+
+# ==================== 组图生成（一次调用多张图片） ====================
+# ARK_MULTI_IMAGE_MODE: 需要多张同提示词图片时，先用一次组图调用请求全部图片，模型拒绝时自动退回逐张生成
+ARK_MULTI_IMAGE_MODE = os.environ.get('ARK_MULTI_IMAGE_MODE', 'false').lower() == 'true'
+# 组图调用单次最多请求的图片数（Seedream 组图上限为 15 张）
+ARK_MULTI_IMAGE_MAX = max(2, min(15, int(os.environ.get('ARK_MULTI_IMAGE_MAX', '15'))))
+
+# 已确认不支持组图参数的模型，之后直接逐张生成
+multi_image_unsupported_models = set()
+
+def _image_group_kwargs(model, full_prompt, ark_size, count, reference_images=None):
+    kwargs = {
+        'model': model,
+        'prompt': f"{full_prompt}\n生成{count}张图片",
+        'size': ark_size,
+        'response_format': ARK_RESPONSE_FORMAT,
+        'extra_body': {
+            "watermark": False,
+            "sequential_image_generation": "auto",
+            "sequential_image_generation_options": {"max_images": count},
+        }
+    }
+    if reference_images:
+        kwargs['extra_body']['image'] = list(reference_images)
+    return kwargs
+
+def _use_image_group(model, count):
+    return ARK_MULTI_IMAGE_MODE and count > 1 and model not in multi_image_unsupported_models
+
+def _handle_image_group_refusal(model, error, log_prefix):
+    """模型拒绝组图参数时记录下来（内容审核等其他 400 错误不影响组图模式）"""
+    code = str(getattr(error, 'code', '') or '')
+    if 'Parameter' in code or 'sequential' in str(error):
+        multi_image_unsupported_models.add(model)
+        app_logger.warning(f"{log_prefix} 模型 {model} 不支持组图生成，改为逐张生成: {error}")
+    else:
+        app_logger.warning(f"{log_prefix} 组图调用被拒绝，本次改为逐张生成: {error}")
+
+def _image_group_images(response, count):
+    images = [item for item in (response.data or []) if getattr(item, 'url', None) or getattr(item, 'b64_json', None)]
+    return images[:count]
+
+def request_image_group(client, full_prompt, ark_size, count, log_prefix='', model=IMAGE_MODEL, reference_images=None):
+    """
+    组图模式：一次 API 调用请求 count 张图片，返回 response.data 中的图片列表
+    
+    未开启组图模式、模型拒绝或调用失败时返回空列表；返回数量不足 count 时，
+    由调用方对剩余图片逐张生成。
+    """
+    if not _use_image_group(model, count):
+        return []
+    count = min(count, ARK_MULTI_IMAGE_MAX)
+    try:
+        kwargs = _image_group_kwargs(model, full_prompt, ark_size, count, reference_images)
+        # 组图调用同样由重试策略统一重试并计入预算；一次请求多张图片，不对冲
+        response, api_duration = retry_policy.call(lambda: rate_limiter.call(_timed_generate, client, kwargs), hedge=False)
+        images = _image_group_images(response, count)
+        if images:
+            image_download.record_api_time(ARK_RESPONSE_FORMAT, api_duration, len(images))
+            latency_stats.record_api(model, ark_size, api_duration, len(images))
+        app_logger.info(f"{log_prefix} 组图调用返回 {len(images)}/{count} 张图片，耗时: {api_duration:.2f}秒")
+        return images
+    except openai.BadRequestError as e:
+        _handle_image_group_refusal(model, e, log_prefix)
+    except Exception as e:
+        app_logger.warning(f"{log_prefix} 组图调用失败，改为逐张生成: {e}")
+    return []
+
+async def request_image_group_async(client, full_prompt, ark_size, count, log_prefix='', model=IMAGE_MODEL, reference_images=None):
+    """request_image_group 的异步版本（client 为 AsyncOpenAI）"""
+    if not _use_image_group(model, count):
+        return []
+    count = min(count, ARK_MULTI_IMAGE_MAX)
+    try:
+        kwargs = _image_group_kwargs(model, full_prompt, ark_size, count, reference_images)
+        response, api_duration = await retry_policy.call_async(lambda: rate_limiter.call_async(_timed_generate_async, client, kwargs), hedge=False)
+        images = _image_group_images(response, count)
+        if images:
+            image_download.record_api_time(ARK_RESPONSE_FORMAT, api_duration, len(images))
+            latency_stats.record_api(model, ark_size, api_duration, len(images))
+        app_logger.info(f"{log_prefix} 组图调用返回 {len(images)}/{count} 张图片，耗时: {api_duration:.2f}秒")
+        return images
+    except openai.BadRequestError as e:
+        _handle_image_group_refusal(model, e, log_prefix)
+    except Exception as e:
+        app_logger.warning(f"{log_prefix} 组图调用失败，改为逐张生成: {e}")
+    return []
+
 # ==================== 登录验证装饰器 ====================
 def login_required(f):
     """登录验证装饰器"""
@@ -366,16 +633,225 @@ def api_stats():
         print(f"获取统计数据失败: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/client-pool-stats')
+@login_required
+def api_client_pool_stats():
+    """连接池统计API（客户端注册表命中、连接复用）- 仅系统管理员可访问"""
+    user = get_current_user()
+    if user['username'] != 'system_admin':
+        return jsonify({'success': False, 'error': '权限不足'}), 403
+
+    return jsonify({
+        'success': True,
+        'stats': ark_clients.get_pool_stats(),
+        'batch_async': batch_async.get_stats(),
+        'pipeline': batch_pipeline.get_stats() if batch_pipeline is not None else [],
+        'oss_upload': dict(oss_upload_stats, limit=OSS_UPLOAD_WORKERS + OSS_UPLOAD_QUEUE_SIZE),
+        'response_format': ARK_RESPONSE_FORMAT,
+        'response_telemetry': image_download.get_telemetry(),
+        'result_cache': result_cache.get_stats(),
+        'rate_limiter': rate_limiter.get_stats(),
+        'retry_policy': retry_policy.get_stats(),
+        'singleflight': singleflight.get_stats(),
+        'reference_images': reference_cache.get_stats(),
+        'batch_queue': job_queue.get_stats(),
+        'event_stream': event_stream.get_stats(),
+        'latency_stats': dict(latency_stats.get_stats(), timings=latency_stats.get_timings()),
+        'registries': {
+            'task_state': state_store.get_stats(),
+            'batch_logs': database.get_batch_log_stats(),
+            'idempotency_keys': database.get_idempotency_stats()
+        }
+    })
+
+@app.route('/api/admin/scheduler', methods=['GET', 'POST'])
+@login_required
+def api_admin_scheduler():
+    """
+    批量任务调度状态 - 仅系统管理员可访问
+    
+    GET 返回每个用户的排队 / 执行中任务数、成本、权重、并发上限和虚拟时间；
+    POST {user_id, weight, max_concurrency} 设置用户的调度权重和并发上限。
+    """
+    user = get_current_user()
+    if user['username'] != 'system_admin':
+        return jsonify({'success': False, 'error': '权限不足'}), 403
+    
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            target_user_id = int(data['user_id'])
+            weight = float(data.get('weight') or 1.0)
+            max_concurrency = data.get('max_concurrency')
+            max_concurrency = None if max_concurrency in (None, '') else max(0, int(max_concurrency))
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'error': '参数错误'}), 400
+        database.set_scheduler_user(target_user_id, weight, max_concurrency)
+        app_logger.info(f"[用户:{user['username']}] 设置用户 {target_user_id} 调度参数: 权重 {weight}, 并发上限 {max_concurrency}")
+        job_queue.notify()
+    
+    queue_stats = job_queue.get_stats() or {}
+    return jsonify({
+        'success': True,
+        'workers': queue_stats.get('workers'),
+        'active': queue_stats.get('active'),
+        'settings': queue_stats.get('settings'),
+        'tasks': queue_stats.get('tasks'),
+        'users': queue_stats.get('scheduler', [])
+    })
+
 # ==================== 主页路由 ====================
 @app.route('/')
 @login_required
 def index():
     return render_template('index.html', user=get_current_user())
 
+# ==================== 进行中请求合并 ====================
+def _snapshot_response(rv):
+    """把视图返回值转成 (body, status, mimetype)，多个请求可以各自构建独立的响应"""
+    response = app.make_response(rv)
+    return response.get_data(), response.status_code, response.mimetype
+
+def _coalesced_response(group, key, view, weight=1):
+    """同一用户的相同请求正在处理时等待并共用其响应，否则执行 view"""
+    (body, status, mimetype), shared = group.do(key, lambda: _snapshot_response(view()), weight)
+    if shared:
+        app_logger.info(f"[用户:{session.get('username', 'unknown')}] 合并重复请求 {request.path}，共用进行中的生成结果")
+    return app.response_class(body, status=status, mimetype=mimetype)
+
+def _uploaded_files_digest():
+    """上传文件的内容摘要（参与请求去重的键）"""
+    digests = []
+    for file in request.files.getlist('images'):
+        if not (file and file.filename):
+            continue
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.stream.read(256 * 1024), b''):
+            digest.update(chunk)
+        file.stream.seek(0)
+        digests.append([file.filename, digest.hexdigest()])
+    return digests
+
+def _requested_image_count(value):
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+# ==================== 幂等键 ====================
+# 客户端在 Idempotency-Key 请求头（或表单 / JSON 中的 idempotency_key 字段）中携带幂等键，
+# 网络重试时重复提交同一个键会返回原来的 task_id / batch_id 和当前状态，不会再生成一次。
+# IDEMPOTENCY_TTL_SECONDS: 幂等键保留时间（默认 24 小时）
+IDEMPOTENCY_TTL_SECONDS = max(60, int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400')))
+
+def _idempotency_key(data=None):
+    """读取请求携带的幂等键，没有时返回 None"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        key = (data if data is not None else request.form).get('idempotency_key')
+    key = str(key).strip() if key else ''
+    return key or None
+
+def _claim_idempotency(scope, key, fingerprint, resource_id):
+    """
+    登记幂等键，返回 (原请求的资源ID, 错误响应)
+    
+    首次提交时以 resource_id 登记并返回 (None, None)；重复提交返回原来的资源ID；
+    同一个键用于内容不同的请求时返回 422。
+    """
+    if len(key) > 255:
+        return None, (jsonify({'success': False, 'error': 'Idempotency-Key 过长（最多 255 个字符）'}), 400)
+    row = database.claim_idempotency_key(session.get('user_id'), scope, key, fingerprint, resource_id, IDEMPOTENCY_TTL_SECONDS)
+    if row['resource_id'] == resource_id:
+        return None, None
+    if row['fingerprint'] != fingerprint:
+        return None, (jsonify({'success': False, 'error': 'Idempotency-Key 已用于内容不同的请求'}), 422)
+    app_logger.info(f"[用户:{session.get('username', 'unknown')}] 重复提交幂等键 {key}（{request.path}），返回原来的 {row['resource_id']}")
+    return row['resource_id'], None
+
+def _release_idempotency(scope, key, resource_id):
+    if key:
+        database.release_idempotency_key(session.get('user_id'), scope, key, resource_id)
+
+def generate_cache_key(full_prompt, ark_size, width, height, index, reference_keys, seed):
+    """
+    /generate 第 index 张图片的结果缓存键
+    
+    缓存的是缩放到请求尺寸后的图片，不同请求尺寸可能协商到同一个 Ark 尺寸，请求尺寸也要参与；
+    只有指定了种子的请求使用缓存，seed 为该图片实际使用的种子（请求种子 + 序号），
+    换一个种子表示想要另一张图片，不能命中原来的缓存；
+    reference_keys 为参考图的内容键（见 reference_cache.prepare）。
+    """
+    return result_cache.make_key({
+        'model': IMAGE_MODEL,
+        'prompt': full_prompt,
+        'size': ark_size,
+        'requested_size': [width, height],
+        'index': index,
+        'seed': seed,
+        'references': reference_keys,
+        'watermark': False,
+    })
+
 @app.route('/generate', methods=['POST'])
 @login_required
 def generate():
+    """
+    单图生成：校验参数、创建任务后立即返回 202 和 task_id，图片在后台线程池中生成
+    
+    进度和结果从 /api/single-generation-status/<task_id>（或 /stream 推送）获取；
+    相同用户的相同请求（双击、前端重试）在任务进行中时返回同一个 task_id，不会重复生成。
+    API 调用使用 interactive 优先级，先于后台批量任务获得名额。
+    """
+    key = singleflight.make_key('generate', session.get('user_id'), request.form.to_dict(flat=False), _uploaded_files_digest())
+    idempotency_key = _idempotency_key()
     task_id = str(uuid.uuid4())
+    # 检查和登记在同一把锁内完成，并发的重复请求只有一个会创建任务
+    with generate_inflight_lock:
+        existing = generate_inflight.get(key)
+        if existing is None:
+            generate_inflight[key] = task_id
+    if existing is not None:
+        if idempotency_key:
+            original, error = _claim_idempotency('generate', idempotency_key, key, existing)
+            if error:
+                return error
+            if original:
+                return _generate_replay(original)
+        task = single_generation_tasks.get(existing) or {}
+        app_logger.info(f"[用户:{session.get('username', 'unknown')}] [任务:{existing}] 合并重复请求 {request.path}，返回进行中的任务")
+        return jsonify({'success': True, 'task_id': existing, 'status': task.get('status', 'queued'), 'coalesced': True}), 202
+    
+    submitted = False
+    try:
+        if idempotency_key:
+            original, error = _claim_idempotency('generate', idempotency_key, key, task_id)
+            if error:
+                return error
+            if original:
+                return _generate_replay(original)
+        with rate_limiter.priority('interactive'):
+            response, submitted = _generate(task_id, key)
+        return response
+    finally:
+        # 校验失败或提交失败时释放登记；提交成功后由后台任务结束时释放
+        if not submitted:
+            with generate_inflight_lock:
+                if generate_inflight.get(key) == task_id:
+                    del generate_inflight[key]
+            _release_idempotency('generate', idempotency_key, task_id)
+
+def _generate_replay(task_id):
+    """幂等键重复提交：返回原任务的当前状态（已完成时包含结果）"""
+    task = single_generation_tasks.get(task_id)
+    status = task.get('status') if task else 'expired'
+    body = {'success': True, 'task_id': task_id, 'status': status, 'replayed': True}
+    if task and task.get('result'):
+        body['result'] = task['result']
+    return jsonify(body), (202 if status in ('queued', 'generating') else 200)
+
+def _generate(task_id, dedupe_key):
+    """校验请求、保存上传的参考图并提交后台任务，返回 (响应, 是否已提交)"""
     user_id = session.get('user_id')
     username = session.get('username', 'unknown')
     
@@ -389,19 +865,8 @@ def generate():
         output_filename = request.form.get('output_filename', 'generated').strip()
         steps = int(request.form.get('steps', 28))
         seed = int(request.form.get('seed', 0))
-        
-        # 记录任务开始
-        with single_generation_lock:
-            single_generation_tasks[task_id] = {
-                'user_id': user_id,
-                'username': username,
-                'status': 'generating',
-                'prompt': prompt,
-                'num_images': num_images,
-                'start_time': datetime.now().isoformat(),
-                'progress': 0,
-                'total': num_images
-            }
+        # 跳过结果缓存，强制重新生成
+        bypass_cache = request.form.get('bypass_cache', 'false').lower() in ('1', 'true', 'on')
         
         # 先获取示例图URL（需要在记录参数前获取）
         sample_image_urls = request.form.getlist('sample_image_urls')
@@ -416,243 +881,355 @@ def generate():
             'output_filename': output_filename,
             'steps': steps,
             'seed': seed,
+            'bypass_cache': bypass_cache,
             'sample_images_count': len(sample_image_urls) if sample_image_urls else 0
         }
         app_logger.info(f"[用户:{username}] [任务:{task_id}] ========== 开始单图生成 ==========")
         app_logger.info(f"[用户:{username}] [任务:{task_id}] 请求参数: {json.dumps(request_params, ensure_ascii=False, indent=2)}")
         
         if not prompt:
-            with single_generation_lock:
-                if task_id in single_generation_tasks:
-                    single_generation_tasks[task_id]['status'] = 'failed'
-                    single_generation_tasks[task_id]['error'] = '请输入提示词'
             app_logger.warning(f"[用户:{username}] [任务:{task_id}] 生成失败 - 缺少提示词")
-            return jsonify({'error': '请输入提示词', 'task_id': task_id}), 400
+            return (jsonify({'error': '请输入提示词'}), 400), False
         
-        # 获取尺寸
-        if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
-            width, height = ASPECT_RATIOS[aspect_ratio][resolution]
-        else:
-            width, height = 2048, 2048
-        
-        # 处理上传的图片和示例图
-        image_urls = []
-        
-        # 添加从OSS选择的示例图URL（已在上面获取）
-        if sample_image_urls:
-            image_urls.extend(sample_image_urls)
-            app_logger.info(f"[用户:{username}] [任务:{task_id}] 使用 {len(sample_image_urls)} 张示例图: {sample_image_urls}")
-            print(f"使用 {len(sample_image_urls)} 张示例图: {sample_image_urls}")
-        
-        uploaded_files = request.files.getlist('images')
+        if not os.environ.get('ARK_API_KEY'):
+            return (jsonify({'error': 'ARK_API_KEY 未配置'}), 500), False
         
-        # 检查是否配置了 OSS 上传（可选功能）
-        oss_enabled = os.environ.get('OSS_ENABLED', 'false').lower() == 'true'
-        
-        # 使用用户专属上传目录
+        # 上传的参考图在请求内保存到用户专属上传目录（请求结束后无法再读取），OSS 上传在后台进行
         user_upload_folder = get_user_upload_folder(user_id)
-        
-        for file in uploaded_files:
+        uploaded_paths = []
+        for file in request.files.getlist('images'):
             if file and file.filename:
                 filename = secure_filename(file.filename)
                 # 保留原始文件名
                 filepath = os.path.join(user_upload_folder, filename)
                 file.save(filepath)
-                
-                if oss_enabled:
-                    # 尝试上传到阿里云 OSS
-                    oss_url = upload_to_aliyun_oss(filepath)
-                    if oss_url:
-                        image_urls.append(oss_url)
-                        app_logger.info(f"[用户:{username}] [任务:{task_id}] 成功上传图片到阿里云 OSS: {oss_url}")
-                        print(f"成功上传图片到阿里云 OSS: {oss_url}")
-                    else:
-                        app_logger.warning(f"[用户:{username}] [任务:{task_id}] 阿里云 OSS 上传失败，跳过图片 {filename}")
-                        print(f"警告：阿里云 OSS 上传失败，跳过图片 {filename}")
-                else:
-                    # 如果没有配置 OSS，保存文件但不添加到 image_urls
-                    # 这样可以保留上传的文件，但不会导致 API 错误
-                    app_logger.info(f"[用户:{username}] [任务:{task_id}] 上传的图片已保存到 {filepath}，但未启用 OSS，将仅使用文字生成图片")
-                    print(f"提示：上传的图片已保存到 {filepath}，但未启用 OSS，将仅使用文字生成图片")
-        
-        # 如果用户上传了图片但没有配置 OSS，给出提示
-        if uploaded_files and any(f.filename for f in uploaded_files) and not image_urls:
-            print("注意：检测到图片上传，但未配置 OSS。当前仅支持文字生成图片模式。")
-            print("如需使用参考图片功能，请在 .env 中配置：")
-            print("  OSS_ENABLED=true")
-            print("  OSS_ENDPOINT=shor-file.oss-cn-wulanchabu.aliyuncs.com")
-            print("  OSS_ACCESS_KEY_ID=你的AccessKeyId")
-            print("  OSS_ACCESS_KEY_SECRET=你的AccessKeySecret")
-        
-        # 获取方舟大模型 API Key
-        api_key = os.environ.get('ARK_API_KEY')
-        base_url = os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+                uploaded_paths.append(filepath)
         
-        if not api_key:
-            return jsonify({'error': 'ARK_API_KEY 未配置'}), 500
+        # 记录任务（排队中）
+        single_generation_tasks.set(task_id, {
+            'user_id': user_id,
+            'username': username,
+            'status': 'queued',
+            'prompt': prompt,
+            'num_images': num_images,
+            'start_time': datetime.now().isoformat(),
+            'progress': 0,
+            'total': num_images,
+            'revision': 0
+        })
         
-        # 初始化 OpenAI 客户端（兼容方舟大模型）
-        client = OpenAI(api_key=api_key, base_url=base_url)
+        job = {
+            'user_id': user_id,
+            'username': username,
+            'dedupe_key': dedupe_key,
+            'prompt': prompt,
+            'negative_prompt': negative_prompt,
+            'aspect_ratio': aspect_ratio,
+            'resolution': resolution,
+            'num_images': num_images,
+            'output_filename': output_filename,
+            'steps': steps,
+            'seed': seed,
+            'bypass_cache': bypass_cache,
+            'sample_image_urls': sample_image_urls,
+            'uploaded_paths': uploaded_paths,
+        }
+        # 在当前上下文的副本中执行，保留 interactive 优先级
+        generate_task_executor.submit(contextvars.copy_context().run, _run_generate_task, task_id, job)
         
-        # 生成图片
-        generated_images = []
-        total_needed = num_images
-        
-        for i in range(total_needed):
-            # 更新任务进度
-            with single_generation_lock:
-                if task_id in single_generation_tasks:
-                    single_generation_tasks[task_id]['progress'] = i + 1
-                    single_generation_tasks[task_id]['current_image'] = i + 1
-            app_logger.info(f"[用户:{username}] [任务:{task_id}] 生成进度: {i+1}/{total_needed}")
-            # 计算种子（方舟大模型 API 限制：最大 99999999）
-            if seed and seed != 0:
-                per_seed = seed + i
-                # 确保不超过最大值
-                if per_seed > 99999999:
-                    per_seed = (per_seed % 99999999) + 1
+        return (jsonify({'success': True, 'task_id': task_id, 'status': 'queued'}), 202), True
+    
+    except Exception as e:
+        app_logger.error(f"[用户:{username}] [任务:{task_id}] 提交生成任务失败: {e}", exc_info=True)
+        print(f"错误: {e}")
+        return (jsonify({'error': f'服务器错误: {str(e)}'}), 500), False
+
+def _run_generate_task(task_id, job):
+    """后台执行 /generate 任务，进度和结果（包含图片列表）写入任务状态"""
+    try:
+        _execute_generate_task(task_id, job)
+    except Exception as e:
+        update_single_task(task_id, status='failed', error=f'服务器错误: {str(e)}', end_time=datetime.now().isoformat())
+        app_logger.error(f"[用户:{job['username']}] [任务:{task_id}] 服务器错误: {e}", exc_info=True)
+        print(f"错误: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        with generate_inflight_lock:
+            if generate_inflight.get(job['dedupe_key']) == task_id:
+                del generate_inflight[job['dedupe_key']]
+
+def _execute_generate_task(task_id, job):
+    user_id = job['user_id']
+    username = job['username']
+    prompt = job['prompt']
+    negative_prompt = job['negative_prompt']
+    aspect_ratio = job['aspect_ratio']
+    resolution = job['resolution']
+    num_images = job['num_images']
+    output_filename = job['output_filename']
+    steps = job['steps']
+    seed = job['seed']
+    bypass_cache = job['bypass_cache']
+    sample_image_urls = job['sample_image_urls']
+    
+    update_single_task(task_id, status='generating')
+    
+    # 获取尺寸
+    if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
+        width, height = ASPECT_RATIOS[aspect_ratio][resolution]
+    else:
+        width, height = 2048, 2048
+    
+    # 处理上传的图片和示例图
+    image_urls = []
+    local_references = {}
+    
+    # 添加从OSS选择的示例图URL
+    if sample_image_urls:
+        image_urls.extend(sample_image_urls)
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] 使用 {len(sample_image_urls)} 张示例图: {sample_image_urls}")
+        print(f"使用 {len(sample_image_urls)} 张示例图: {sample_image_urls}")
+    
+    # 检查是否配置了 OSS 上传（可选功能）
+    oss_enabled = os.environ.get('OSS_ENABLED', 'false').lower() == 'true'
+    
+    for filepath in job['uploaded_paths']:
+        filename = os.path.basename(filepath)
+        if oss_enabled:
+            # 尝试上传到阿里云 OSS
+            oss_url = upload_to_aliyun_oss(filepath)
+            if oss_url:
+                image_urls.append(oss_url)
+                local_references[oss_url] = filepath
+                app_logger.info(f"[用户:{username}] [任务:{task_id}] 成功上传图片到阿里云 OSS: {oss_url}")
+                print(f"成功上传图片到阿里云 OSS: {oss_url}")
             else:
-                per_seed = random.randint(1, 99999999)
-            
-            # 构建提示词
-            full_prompt = prompt
-            if negative_prompt:
-                full_prompt = f"{prompt}\n负面词: {negative_prompt}"
-            
-            # 根据分辨率映射到方舟大模型支持的size格式
-            size_map = {
-                '1024x1024': '1K',
-                '2048x2048': '2K',
-                '1536x1536': '2K',
-            }
-            ark_size = size_map.get(f"{width}x{height}", "2K")
+                app_logger.warning(f"[用户:{username}] [任务:{task_id}] 阿里云 OSS 上传失败，跳过图片 {filename}")
+                print(f"警告：阿里云 OSS 上传失败，跳过图片 {filename}")
+        else:
+            # 如果没有配置 OSS，保存文件但不添加到 image_urls
+            # 这样可以保留上传的文件，但不会导致 API 错误
+            app_logger.info(f"[用户:{username}] [任务:{task_id}] 上传的图片已保存到 {filepath}，但未启用 OSS，将仅使用文字生成图片")
+            print(f"提示：上传的图片已保存到 {filepath}，但未启用 OSS，将仅使用文字生成图片")
+    
+    # 如果用户上传了图片但没有配置 OSS，给出提示
+    if job['uploaded_paths'] and not image_urls:
+        print("注意：检测到图片上传，但未配置 OSS。当前仅支持文字生成图片模式。")
+        print("如需使用参考图片功能，请在 .env 中配置：")
+        print("  OSS_ENABLED=true")
+        print("  OSS_ENDPOINT=shor-file.oss-cn-wulanchabu.aliyuncs.com")
+        print("  OSS_ACCESS_KEY_ID=你的AccessKeyId")
+        print("  OSS_ACCESS_KEY_SECRET=你的AccessKeySecret")
+    
+    # 获取共享的 OpenAI 客户端（兼容方舟大模型，复用连接池）
+    api_key = os.environ.get('ARK_API_KEY')
+    base_url = os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+    client = ark_clients.get_ark_client(api_key, base_url)
+    
+    # 参考图预处理（缩小 / 去元数据 / 转码，按内容哈希复用）
+    references, reference_keys = prepare_reference_images(image_urls, local_references, with_keys=True)
+    
+    # 生成图片
+    total_needed = num_images
+    
+    def generate_one(i):
+        """生成第 i 张图片，成功返回图片信息，失败返回 None"""
+        # 更新任务进度
+        def mark_started(task_state):
+            task_state['in_flight'] = task_state.get('in_flight', 0) + 1
+            task_state['current_image'] = max(task_state.get('current_image', 0), i + 1)
+        
+        def mark_finished(task_state):
+            task_state['in_flight'] = max(task_state.get('in_flight', 1) - 1, 0)
+            task_state['progress'] = task_state.get('progress', 0) + 1
+        
+        modify_single_task(task_id, mark_started)
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] 开始生成: {i+1}/{total_needed}")
+        try:
+            return _generate_one_image(i)
+        finally:
+            task_state = modify_single_task(task_id, mark_finished)
+            finished = task_state['progress'] if task_state else 0
+            app_logger.info(f"[用户:{username}] [任务:{task_id}] 生成进度: {finished}/{total_needed}")
+    
+    # 构建提示词
+    full_prompt = prompt
+    if negative_prompt:
+        full_prompt = f"{prompt}\n负面词: {negative_prompt}"
+    
+    # 协商模型支持的最小且能覆盖请求尺寸的像素尺寸（需要时本地缩放回请求尺寸）
+    negotiation = size_negotiation.negotiate(width, height)
+    ark_size = negotiation['size']
+    
+    # 结果缓存：指定了种子表示请求确定性结果，参与缓存（种子参与缓存键）；
+    # 参考图按内容键参与缓存键，有参考图没能预处理（无法确认内容）时不使用缓存
+    use_cache = result_cache.is_enabled() and bool(seed) and not bypass_cache and None not in reference_keys
+    if bypass_cache:
+        result_cache.record_bypass()
+    
+    # 组图模式：先用一次调用请求全部图片，未返回的部分再逐张生成
+    # （组图调用无法指定每张图片的种子，使用缓存时逐张生成）
+    group_images = [] if use_cache else request_image_group(client, full_prompt, ark_size, total_needed, f"[用户:{username}] [任务:{task_id}]", reference_images=references)
+    
+    def _generate_one_image(i):
+        # 计算种子（方舟大模型 API 限制：最大 99999999）
+        if seed and seed != 0:
+            per_seed = seed + i
+            # 确保不超过最大值
+            if per_seed > 99999999:
+                per_seed = (per_seed % 99999999) + 1
+        else:
+            per_seed = random.randint(1, 99999999)
+        
+        cache_key = None
+        if use_cache:
+            cache_key = generate_cache_key(full_prompt, ark_size, width, height, i, reference_keys, per_seed)
+            cached = _save_cached_image(i, per_seed, cache_key)
+            if cached:
+                return cached
+        
+        if i < len(group_images):
+            return _save_image(i, per_seed, group_images[i])
+        
+        # 记录API请求详情
+        api_request = {
+            'model': IMAGE_MODEL,
+            'prompt': full_prompt,
+            'size': ark_size,
+            'width': width,
+            'height': height,
+            'seed': per_seed,
+            'image_count': i + 1,
+            'total': total_needed,
+            'sample_images': len(image_urls)
+        }
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 调用API生成图片")
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API请求参数: {json.dumps(api_request, ensure_ascii=False, indent=2)}")
+        
+        # 调用方舟大模型生成图片
+        try:
+            api_start_time = time.time()
+            image = request_image(client, full_prompt, ark_size, reference_images=references)
+            api_duration = time.time() - api_start_time
+            app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API响应时间: {api_duration:.2f}秒")
             
-            # 记录API请求详情
-            api_request = {
-                'model': 'doubao-seedream-4-5-251128',
-                'prompt': full_prompt,
-                'size': ark_size,
+            # 处理响应
+            if image is not None:
+                if getattr(image, 'url', None):
+                    app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API返回成功，图片URL: {image.url}")
+                else:
+                    app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API返回成功（b64_json）")
+                return _save_image(i, per_seed, image, cache_key)
+            else:
+                app_logger.warning(f"[用户:{username}] [任务:{task_id}] API 返回错误: 无法获取图片")
+                print(f"API 返回错误: 无法获取图片")
+        except Exception as e:
+            app_logger.error(f"[用户:{username}] [任务:{task_id}] 生成第 {i+1} 张图片时出错: {e}")
+            print(f"生成第 {i+1} 张图片时出错: {e}")
+        return None
+    
+    def _output_target(i):
+        """返回第 i 张图片的文件名和本地保存路径（用户专属输出目录）"""
+        if num_images > 1:
+            filename = f"{output_filename}_{i+1}.jpg"
+        else:
+            filename = f"{output_filename}.jpg"
+        return filename, os.path.join(get_user_output_folder(user_id), filename)
+    
+    def _record_image(per_seed, filename, actual_size):
+        """写入生成记录，返回图片信息"""
+        try:
+            sample_images_list = [{'url': url, 'filename': os.path.basename(url)} for url in image_urls]
+            database.save_generation_record({
+                'user_id': user_id,
+                'prompt': prompt,
+                'negative_prompt': negative_prompt,
+                'aspect_ratio': aspect_ratio,
+                'resolution': resolution,
                 'width': width,
                 'height': height,
+                'num_images': 1,
                 'seed': per_seed,
-                'image_count': i + 1,
-                'total': total_needed,
-                'sample_images': len(image_urls)
-            }
-            app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 调用API生成图片")
-            app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API请求参数: {json.dumps(api_request, ensure_ascii=False, indent=2)}")
-            
-            # 调用方舟大模型生成图片
-            try:
-                api_start_time = time.time()
-                response = client.images.generate(
-                    model="doubao-seedream-4-5-251128",
-                    prompt=full_prompt,
-                    size=ark_size,
-                    response_format="url",
-                    extra_body={
-                        "watermark": False,
-                    }
-                )
-                api_duration = time.time() - api_start_time
-                app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API响应时间: {api_duration:.2f}秒")
-                
-                # 处理响应
-                if response.data and len(response.data) > 0:
-                    img_url = response.data[0].url
-                    app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] API返回成功，图片URL: {img_url}")
-                    
-                    # 下载图片
-                    import requests
-                    download_start_time = time.time()
-                    img_response = requests.get(img_url)
-                    download_duration = time.time() - download_start_time
-                    app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 图片下载时间: {download_duration:.2f}秒，状态码: {img_response.status_code}")
-                    
-                    if img_response.status_code == 200:
-                        img_data = img_response.content
-                        img_size = len(img_data)
-                        app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 图片大小: {img_size / 1024:.2f} KB")
-                        
-                        # 生成文件名
-                        if num_images > 1:
-                            filename = f"{output_filename}_{i+1}.jpg"
-                        else:
-                            filename = f"{output_filename}.jpg"
-                        
-                        # 使用用户专属输出目录
-                        user_output_folder = get_user_output_folder(user_id)
-                        output_path = os.path.join(user_output_folder, filename)
-                        with open(output_path, 'wb') as f:
-                            f.write(img_data)
-                        
-                        generated_images.append({
-                            'filename': filename,
-                            'url': f'/output/{user_id}/{filename}',
-                            'seed': per_seed
-                        })
-                        
-                        # 保存记录到数据库
-                        try:
-                            sample_images_list = [{'url': url, 'filename': os.path.basename(url)} for url in image_urls]
-                            database.save_generation_record({
-                                'user_id': user_id,
-                                'prompt': prompt,
-                                'negative_prompt': negative_prompt,
-                                'aspect_ratio': aspect_ratio,
-                                'resolution': resolution,
-                                'width': width,
-                                'height': height,
-                                'num_images': 1,
-                                'seed': per_seed,
-                                'steps': steps,
-                                'sample_images': sample_images_list,
-                                'image_path': f'/output/{user_id}/{filename}',
-                                'filename': filename,
-                                'status': 'success'
-                            })
-                        except Exception as db_err:
-                            app_logger.error(f"[用户:{username}] [任务:{task_id}] 保存记录失败: {db_err}")
-                            print(f"保存记录失败: {db_err}")
-                else:
-                    app_logger.warning(f"[用户:{username}] [任务:{task_id}] API 返回错误: 无法获取图片")
-                    print(f"API 返回错误: 无法获取图片")
-            except Exception as e:
-                app_logger.error(f"[用户:{username}] [任务:{task_id}] 生成第 {i+1} 张图片时出错: {e}")
-                print(f"生成第 {i+1} 张图片时出错: {e}")
-                continue
-        
-        if not generated_images:
-            with single_generation_lock:
-                if task_id in single_generation_tasks:
-                    single_generation_tasks[task_id]['status'] = 'failed'
-                    single_generation_tasks[task_id]['error'] = '图片生成失败，请检查参数'
-            app_logger.error(f"[用户:{username}] [任务:{task_id}] 生成失败 - 所有图片生成失败")
-            return jsonify({'error': '图片生成失败，请检查参数', 'task_id': task_id}), 500
-        
-        # 更新任务状态为完成
-        with single_generation_lock:
-            if task_id in single_generation_tasks:
-                single_generation_tasks[task_id]['status'] = 'completed'
-                single_generation_tasks[task_id]['end_time'] = datetime.now().isoformat()
-                single_generation_tasks[task_id]['result'] = {
-                    'images_count': len(generated_images),
-                    'filenames': [img['filename'] for img in generated_images]
-                }
+                'steps': steps,
+                'sample_images': sample_images_list,
+                'image_path': f'/output/{user_id}/{filename}',
+                'filename': filename,
+                'status': 'success',
+                'actual_width': actual_size[0],
+                'actual_height': actual_size[1]
+            })
+        except Exception as db_err:
+            app_logger.error(f"[用户:{username}] [任务:{task_id}] 保存记录失败: {db_err}")
+            print(f"保存记录失败: {db_err}")
         
-        # 记录最终结果
-        result_summary = {
-            'total_requested': num_images,
-            'total_generated': len(generated_images),
-            'filenames': [img['filename'] for img in generated_images],
-            'seeds': [img['seed'] for img in generated_images]
+        return {
+            'filename': filename,
+            'url': f'/output/{user_id}/{filename}',
+            'seed': per_seed
         }
-        app_logger.info(f"[用户:{username}] [任务:{task_id}] ========== 生成完成 ==========")
-        app_logger.info(f"[用户:{username}] [任务:{task_id}] 生成结果: {json.dumps(result_summary, ensure_ascii=False, indent=2)}")
-        
-        return jsonify({
-            'success': True,
-            'task_id': task_id,
+    
+    def _save_cached_image(i, per_seed, cache_key):
+        """命中结果缓存时直接使用已保存的图片，未命中返回 None"""
+        try:
+            filename, output_path = _output_target(i)
+            entry = result_cache.lookup(cache_key, output_path)
+        except Exception as e:
+            app_logger.warning(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 读取结果缓存失败: {e}")
+            return None
+        if entry is None:
+            return None
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 命中结果缓存，SHA-256: {entry['sha256']}")
+        return _record_image(per_seed, filename, (negotiation['actual_width'], negotiation['actual_height']))
+    
+    def _save_image(i, per_seed, image, cache_key=None):
+        """保存图片（下载或解码 b64_json）、写入生成记录，成功返回图片信息"""
+        try:
+            # 流式写入用户专属输出目录（临时文件 + 原子重命名）
+            filename, output_path = _output_target(i)
+            download = save_generated_image(image, output_path, ark_size)
+            app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 图片获取方式: {download['mode']}，耗时: {download['duration']:.2f}秒，大小: {download['bytes'] / 1024:.2f} KB，SHA-256: {download['sha256']}")
+            
+            # 模型生成尺寸大于请求尺寸时，在缩放线程池中裁剪缩放
+            actual_size = size_negotiation.fit_image(output_path, negotiation)
+            if negotiation['needs_resize']:
+                app_logger.info(f"[用户:{username}] [任务:{task_id}] [图片 {i+1}/{total_needed}] 生成尺寸 {actual_size[0]}x{actual_size[1]}，请求尺寸 {width}x{height}")
+                download['bytes'], download['sha256'] = image_download.file_digest(output_path)
+            
+            if cache_key:
+                try:
+                    result_cache.store(cache_key, output_path, download['bytes'], download['sha256'])
+                except Exception as cache_err:
+                    app_logger.warning(f"[用户:{username}] [任务:{task_id}] 写入结果缓存失败: {cache_err}")
+            
+            # 保存记录到数据库
+            return _record_image(per_seed, filename, actual_size)
+        except Exception as e:
+            app_logger.error(f"[用户:{username}] [任务:{task_id}] 生成第 {i+1} 张图片时出错: {e}")
+            print(f"生成第 {i+1} 张图片时出错: {e}")
+        return None
+    
+    # 多张图片时并发生成（受单请求与进程级并发上限约束），结果仍按序号排列
+    if GENERATE_CONCURRENT and total_needed > 1:
+        app_logger.info(f"[用户:{username}] [任务:{task_id}] 并发生成模式，单请求并发数: {min(GENERATE_PER_REQUEST_CONCURRENCY, total_needed)}")
+        results = run_bounded(generate_one, range(total_needed), GENERATE_PER_REQUEST_CONCURRENCY)
+    else:
+        results = [generate_one(i) for i in range(total_needed)]
+    generated_images = [img for img in results if img]
+    
+    if not generated_images:
+        update_single_task(task_id, status='failed', error='图片生成失败，请检查参数', end_time=datetime.now().isoformat())
+        app_logger.error(f"[用户:{username}] [任务:{task_id}] 生成失败 - 所有图片生成失败")
+        return
+    
+    # 更新任务状态为完成，结果中包含图片列表，状态查询直接返回
+    update_single_task(
+        task_id,
+        status='completed',
+        end_time=datetime.now().isoformat(),
+        result={
+            'images_count': len(generated_images),
+            'filenames': [img['filename'] for img in generated_images],
             'images': generated_images,
             'params': {
                 'prompt': prompt,
@@ -663,18 +1240,68 @@ def generate():
                 'height': height,
                 'num_images': num_images
             }
-        })
+        }
+    )
     
-    except Exception as e:
-        with single_generation_lock:
-            if task_id in single_generation_tasks:
-                single_generation_tasks[task_id]['status'] = 'failed'
-                single_generation_tasks[task_id]['error'] = str(e)
-        app_logger.error(f"[用户:{username}] [任务:{task_id}] 服务器错误: {e}", exc_info=True)
-        print(f"错误: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'服务器错误: {str(e)}', 'task_id': task_id}), 500
+    # 记录最终结果
+    result_summary = {
+        'total_requested': num_images,
+        'total_generated': len(generated_images),
+        'filenames': [img['filename'] for img in generated_images],
+        'seeds': [img['seed'] for img in generated_images]
+    }
+    app_logger.info(f"[用户:{username}] [任务:{task_id}] ========== 生成完成 ==========")
+    app_logger.info(f"[用户:{username}] [任务:{task_id}] 生成结果: {json.dumps(result_summary, ensure_ascii=False, indent=2)}")
+
+def collect_sample_images(user_id, category=None):
+    """用户的示例图：OSS 中的示例图加上人物/场景库中的条目（按 URL 去重），category 为 person / scene 时只返回该类别"""
+    # 先从 OSS 列表中读取（如果配置了 OSS）
+    sample_images = list_sample_images_from_oss(user_id)
+
+    # 再从数据库读取人物/场景库中的条目（包含本地保存的备份路径）
+    # 为避免同一文件既存在于 OSS 又存在于数据库中导致重复显示，按 URL 去重
+    try:
+        existing_urls = set([s.get('url') for s in sample_images if s.get('url')])
+
+        person_assets = database.get_person_assets(user_id)
+        for a in person_assets:
+            a_url = a.get('url')
+            if a_url and a_url in existing_urls:
+                # 已由 OSS 列表包含，跳过添加 DB 条目以避免重复
+                continue
+            sample_images.append({
+                'url': a_url,
+                'filename': a.get('filename'),
+                'size': None,
+                'key': f"db_person_{a.get('id')}",
+                'category': 'person'
+            })
+
+        # 更新已存在 URL 集合
+        existing_urls.update([a.get('url') for a in person_assets if a.get('url')])
+    except Exception:
+        pass
+
+    try:
+        scene_assets = database.get_scene_assets(user_id)
+        for a in scene_assets:
+            a_url = a.get('url')
+            if a_url and a_url in existing_urls:
+                continue
+            sample_images.append({
+                'url': a_url,
+                'filename': a.get('filename'),
+                'size': None,
+                'key': f"db_scene_{a.get('id')}",
+                'category': 'scene'
+            })
+    except Exception:
+        pass
+
+    # 如果请求了特定类别，则过滤
+    if category in ('person', 'scene'):
+        sample_images = [s for s in sample_images if s.get('category') == category]
+    return sample_images
 
 @app.route('/api/sample-images')
 @login_required
@@ -683,52 +1310,7 @@ def get_sample_images():
     try:
         user_id = session.get('user_id')
         category = request.args.get('category')
-        # 先从 OSS 列表中读取（如果配置了 OSS）
-        sample_images = list_sample_images_from_oss(user_id)
-
-        # 再从数据库读取人物/场景库中的条目（包含本地保存的备份路径）
-        # 为避免同一文件既存在于 OSS 又存在于数据库中导致重复显示，按 URL 去重
-        try:
-            existing_urls = set([s.get('url') for s in sample_images if s.get('url')])
-
-            person_assets = database.get_person_assets(user_id)
-            for a in person_assets:
-                a_url = a.get('url')
-                if a_url and a_url in existing_urls:
-                    # 已由 OSS 列表包含，跳过添加 DB 条目以避免重复
-                    continue
-                sample_images.append({
-                    'url': a_url,
-                    'filename': a.get('filename'),
-                    'size': None,
-                    'key': f"db_person_{a.get('id')}",
-                    'category': 'person'
-                })
-
-            # 更新已存在 URL 集合
-            existing_urls.update([a.get('url') for a in person_assets if a.get('url')])
-        except Exception:
-            pass
-
-        try:
-            scene_assets = database.get_scene_assets(user_id)
-            for a in scene_assets:
-                a_url = a.get('url')
-                if a_url and a_url in existing_urls:
-                    continue
-                sample_images.append({
-                    'url': a_url,
-                    'filename': a.get('filename'),
-                    'size': None,
-                    'key': f"db_scene_{a.get('id')}",
-                    'category': 'scene'
-                })
-        except Exception:
-            pass
-
-        # 如果请求了特定类别，则过滤
-        if category in ('person', 'scene'):
-            sample_images = [s for s in sample_images if s.get('category') == category]
+        sample_images = collect_sample_images(user_id, category)
 
         return jsonify({
             'success': True,
@@ -769,11 +1351,40 @@ def script_analysis():
 @app.route('/api/batch-generate', methods=['POST'])
 @login_required
 def batch_generate():
+    """批量生成API（相同用户的相同请求正在进行时共用结果）"""
+    data = request.get_json(silent=True) or {}
+    key = singleflight.make_key('batch-generate', session.get('user_id'), data)
+    idempotency_key = _idempotency_key(data)
+    batch_id = str(uuid.uuid4())
+    if idempotency_key:
+        original, error = _claim_idempotency('batch-generate', idempotency_key, key, batch_id)
+        if error:
+            return error
+        if original:
+            return _batch_generate_replay(original)
+        # 携带幂等键的请求只和同一个键的请求合并，响应中的 batch_id 与登记的一致
+        key = singleflight.make_key(key, idempotency_key)
+    weight = _requested_image_count(data.get('num_images', 1))
+    response = _coalesced_response(singleflight.get_group('batch-generate'), key, lambda: _batch_generate(batch_id), weight)
+    if response.status_code != 200:
+        # 没有生成出图片，允许用同一个键重试
+        _release_idempotency('batch-generate', idempotency_key, batch_id)
+    return response
+
+def _batch_generate_replay(batch_id):
+    """幂等键重复提交：返回原请求已生成的图片，原请求仍在进行时返回 409"""
+    user_id = session.get('user_id')
+    records = [r for r in database.get_records_by_batch(batch_id) if r.get('user_id') == user_id]
+    if not records:
+        return jsonify({'success': False, 'error': '相同 Idempotency-Key 的请求正在处理中', 'batch_id': batch_id}), 409
+    images = [{'filename': r['filename'], 'url': r['image_path'], 'seed': r['seed']} for r in sorted(records, key=lambda r: r['id'])]
+    return jsonify({'success': True, 'images': images, 'batch_id': batch_id, 'replayed': True})
+
+def _batch_generate(batch_id):
     """批量生成API"""
     try:
         user_id = session.get('user_id')
         data = request.json
-        batch_id = str(uuid.uuid4())
         
         # 获取参数
         prompt = data.get('prompt', '').strip()
@@ -793,8 +1404,9 @@ def batch_generate():
         else:
             width, height = 2048, 2048
         
-        # 准备示例图 URL
+        # 准备示例图 URL（预处理后发送给模型）
         image_urls = [img['url'] for img in sample_images_data if 'url' in img]
+        references = prepare_reference_images(image_urls)
         
         # 获取方舟大模型 API Key
         api_key = os.environ.get('ARK_API_KEY')
@@ -803,86 +1415,75 @@ def batch_generate():
         if not api_key:
             return jsonify({'success': False, 'error': 'ARK_API_KEY 未配置'}), 500
         
-        # 初始化 OpenAI 客户端
-        client = OpenAI(api_key=api_key, base_url=base_url)
+        # 获取共享的 OpenAI 客户端（复用连接池）
+        client = ark_clients.get_ark_client(api_key, base_url)
         
         # 生成图片
         generated_images = []
         
+        # 构建提示词
+        full_prompt = prompt
+        if negative_prompt:
+            full_prompt = f"{prompt}\n负面词: {negative_prompt}"
+        
+        # 协商模型支持的最小且能覆盖请求尺寸的像素尺寸（需要时本地缩放回请求尺寸）
+        negotiation = size_negotiation.negotiate(width, height)
+        ark_size = negotiation['size']
+        
+        # 组图模式：先用一次调用请求全部图片，未返回的部分再逐张生成
+        group_images = request_image_group(client, full_prompt, ark_size, num_images, f"[批次:{batch_id}]", reference_images=references)
+        
         for i in range(num_images):
             per_seed = random.randint(1, 99999999)
             
-            # 构建提示词
-            full_prompt = prompt
-            if negative_prompt:
-                full_prompt = f"{prompt}\n负面词: {negative_prompt}"
-            
-            # 根据分辨率映射到方舟大模型支持的size格式
-            size_map = {
-                '1024x1024': '1K',
-                '2048x2048': '2K',
-                '1536x1536': '2K',
-            }
-            ark_size = size_map.get(f"{width}x{height}", "2K")
-            
             try:
-                response = client.images.generate(
-                    model="doubao-seedream-4-5-251128",
-                    prompt=full_prompt,
-                    size=ark_size,
-                    response_format="url",
-                    extra_body={
-                        "watermark": False,
-                    }
-                )
+                if i < len(group_images):
+                    image = group_images[i]
+                else:
+                    image = request_image(client, full_prompt, ark_size, reference_images=references)
+                    if image is None:
+                        continue
+                
+                if num_images > 1:
+                    filename = f"{filename_base}_{i+1}.jpg"
+                else:
+                    filename = f"{filename_base}.jpg"
+                
+                # 流式写入用户专属输出目录，需要时缩放到请求尺寸
+                user_output_folder = get_user_output_folder(user_id)
+                output_path = os.path.join(user_output_folder, filename)
+                save_generated_image(image, output_path, ark_size)
+                actual_size = size_negotiation.fit_image(output_path, negotiation)
+                
+                generated_images.append({
+                    'filename': filename,
+                    'url': f'/output/{user_id}/{filename}',
+                    'seed': per_seed
+                })
                 
-                if response.data and len(response.data) > 0:
-                    img_url = response.data[0].url
-                    
-                    # 下载图片
-                    import requests
-                    img_response = requests.get(img_url)
-                    if img_response.status_code == 200:
-                        img_data = img_response.content
-                        
-                        if num_images > 1:
-                            filename = f"{filename_base}_{i+1}.jpg"
-                        else:
-                            filename = f"{filename_base}.jpg"
-                        
-                        # 使用用户专属输出目录
-                        user_output_folder = get_user_output_folder(user_id)
-                        output_path = os.path.join(user_output_folder, filename)
-                        with open(output_path, 'wb') as f:
-                            f.write(img_data)
-                        
-                        generated_images.append({
-                            'filename': filename,
-                            'url': f'/output/{user_id}/{filename}',
-                            'seed': per_seed
-                        })
-                        
-                        # 保存记录
-                        try:
-                            database.save_generation_record({
-                                'user_id': user_id,
-                                'prompt': prompt,
-                                'negative_prompt': negative_prompt,
-                                'aspect_ratio': aspect_ratio,
-                                'resolution': resolution,
-                                'width': width,
-                                'height': height,
-                                'num_images': 1,
-                                'seed': per_seed,
-                                'steps': 28,
-                                'sample_images': sample_images_data,
-                                'image_path': f'/output/{user_id}/{filename}',
-                                'filename': filename,
-                                'batch_id': batch_id,
-                                'status': 'success'
-                            })
-                        except Exception as db_err:
-                            print(f"保存记录失败: {db_err}")
+                # 保存记录
+                try:
+                    database.save_generation_record({
+                        'user_id': user_id,
+                        'prompt': prompt,
+                        'negative_prompt': negative_prompt,
+                        'aspect_ratio': aspect_ratio,
+                        'resolution': resolution,
+                        'width': width,
+                        'height': height,
+                        'num_images': 1,
+                        'seed': per_seed,
+                        'steps': 28,
+                        'sample_images': sample_images_data,
+                        'image_path': f'/output/{user_id}/{filename}',
+                        'filename': filename,
+                        'batch_id': batch_id,
+                        'status': 'success',
+                        'actual_width': actual_size[0],
+                        'actual_height': actual_size[1]
+                    })
+                except Exception as db_err:
+                    print(f"保存记录失败: {db_err}")
             except Exception as e:
                 print(f"生成第 {i+1} 张图片时出错: {e}")
                 continue
@@ -1138,8 +1739,7 @@ def add_to_person_library():
                 public_url = '/' + dest_path.replace('\\', '/')
         else:
             # 若为远程 URL，尝试下载再上传
-            import requests
-            resp = requests.get(url, timeout=10)
+            resp = ark_clients.get_http_session().get(url, timeout=10)
             if resp.status_code == 200:
                 if bucket:
                     bucket.put_object(target_key, resp.content)
@@ -1199,8 +1799,7 @@ def add_to_scene_library():
                 shutil.copy(local_path, dest_path)
                 public_url = '/' + dest_path.replace('\\', '/')
         else:
-            import requests
-            resp = requests.get(url, timeout=10)
+            resp = ark_clients.get_http_session().get(url, timeout=10)
             if resp.status_code == 200:
                 if bucket:
                     bucket.put_object(target_key, resp.content)
@@ -1227,6 +1826,93 @@ def add_to_scene_library():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+# ==================== 批量任务进度 ====================
+# 批次进度、任务状态和日志保存在数据库中（见 job_queue），进程重启后仍可查询并继续执行
+# BATCH_LOG_MAX_ENTRIES: 每个批次保留的日志条数，超出时丢弃最早的日志（0 表示不限制）
+BATCH_LOG_MAX_ENTRIES = max(0, int(os.environ.get('BATCH_LOG_MAX_ENTRIES', '500')))
+
+def append_batch_log(batch_id, message, log_type='info', close=False):
+    """
+    追加一条批量任务日志（每个批次最多保留 BATCH_LOG_MAX_ENTRIES 条），并通知进度推送的订阅者
+    
+    close 为 True 表示这可能是批次的最后一条日志（见 database.add_batch_log），进度推送读到后结束。
+    """
+    try:
+        database.add_batch_log(batch_id, message, log_type, BATCH_LOG_MAX_ENTRIES or None, close)
+    except Exception as e:
+        print(f"写入批次日志失败: {e}")
+        return
+    event_stream.publish(f'batch:{batch_id}')
+
+def log_batch_task_start(batch_id, username, index, total, task):
+    """记录批次中第 index 个任务开始处理"""
+    task_info = {
+        'prompt': task.get('prompt', '')[:100],
+        'aspect_ratio': task.get('aspect_ratio', '1:1'),
+        'resolution': task.get('resolution', '2k'),
+        'num_images': task.get('num_images', 1),
+        'sample_images_count': len(task.get('sample_images', []))
+    }
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}/{total}] 开始处理")
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}/{total}] 任务参数: {json.dumps(task_info, ensure_ascii=False)}")
+    append_batch_log(batch_id, f"开始任务 {index+1}/{total}: {task.get('prompt', '')[:30]}...")
+
+def record_batch_task_result(claim, result):
+    """任务结束：写回任务状态、更新批次计数和日志，最后一个任务结束时标记批次完成"""
+    batch_id = claim['batch_id']
+    index = claim['task_index']
+    username = claim.get('username') or 'unknown'
+    if result.get('stopped'):
+        record_batch_task_stopped(claim)
+        return
+    progress = database.complete_batch_task(claim['id'], claim['lease_owner'], bool(result.get('success')), result.get('error'))
+    if progress is None:
+        # 租约已过期，任务已被其他工作线程领取，以对方的结果为准
+        app_logger.warning(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}] 租约已失效，结果不再写入")
+        return
+    
+    if result.get('success'):
+        append_batch_log(batch_id, f"✓ 任务 {index+1} 完成", 'success')
+    else:
+        append_batch_log(batch_id, f"✗ 任务 {index+1} 失败: {result.get('error', '未知错误')}", 'error')
+    
+    done = progress['completed'] + progress['failed']
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] 任务进度: {done}/{progress['total']}")
+    print(f"批量任务进度: {done}/{progress['total']}")
+    
+    if progress['finished']:
+        finish_batch(progress)
+
+def record_batch_task_stopped(claim):
+    """任务因批次暂停或取消在图片之间停止：取消时任务结束，暂停时放回队列等待继续"""
+    batch_id = claim['batch_id']
+    index = claim['task_index']
+    username = claim.get('username') or 'unknown'
+    progress = database.stop_batch_task(claim['id'], claim['lease_owner'])
+    if progress is None:
+        app_logger.warning(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}] 租约已失效，结果不再写入")
+        return
+    
+    done_images = len(database.get_batch_task_done_images(claim['id']))
+    if progress['task_status'] == 'cancelled':
+        append_batch_log(batch_id, f"任务 {index+1} 已取消（已完成 {done_images} 张图片）", 'error', close=True)
+    else:
+        append_batch_log(batch_id, f"任务 {index+1} 已暂停（已完成 {done_images} 张图片，继续后跳过）")
+        # 停止检查与继续之间批次可能已经恢复运行，唤醒工作线程重新领取
+        job_queue.notify()
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}] 停止执行，任务状态: {progress['task_status']}")
+
+def finish_batch(progress):
+    """批次的所有任务都已结束（数据库中的状态已由 complete_batch_task 更新）"""
+    batch_id = progress['batch_id']
+    username = progress.get('username') or 'unknown'
+    completed_count = progress['completed']
+    failed_count = progress['failed']
+    append_batch_log(batch_id, f"批量生成完成！成功: {completed_count}, 失败: {failed_count}", 'success', close=True)
+    
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] 批量生成完成 - 成功: {completed_count}, 失败: {failed_count}")
+    print(f"批量生成完成，批次ID: {batch_id}")
+
 @app.route('/api/batch-generate-all', methods=['POST'])
 @login_required
 def batch_generate_all():
@@ -1241,11 +1927,26 @@ def batch_generate_all():
             app_logger.warning(f"[用户:{username}] 批量生成失败 - 没有任务")
             return jsonify({'success': False, 'error': '没有任务'}), 400
         
+        # batch（默认）或 backfill：backfill 批次只在没有其他批量任务等待时执行
+        priority = data.get('priority', 'batch')
+        if priority not in ('batch', 'backfill'):
+            return jsonify({'success': False, 'error': f'不支持的优先级: {priority}'}), 400
+        
         # 生成批次ID
         batch_id = str(uuid.uuid4())
         
+        # 携带幂等键的重复提交（如网络重试）返回原来的批次
+        idempotency_key = _idempotency_key(data)
+        if idempotency_key:
+            fingerprint = singleflight.make_key('batch-generate-all', user_id, tasks, priority, _reuse_results_requested(data))
+            original, error = _claim_idempotency('batch-generate-all', idempotency_key, fingerprint, batch_id)
+            if error:
+                return error
+            if original:
+                return _batch_generate_all_replay(original)
+        
         app_logger.info(f"[用户:{username}] [批次:{batch_id}] ========== 开始批量生成 ==========")
-        app_logger.info(f"[用户:{username}] [批次:{batch_id}] 总任务数: {len(tasks)}")
+        app_logger.info(f"[用户:{username}] [批次:{batch_id}] 总任务数: {len(tasks)}，优先级: {priority}")
         # 记录所有任务的详细信息（只记录前3个任务的完整信息，避免日志过长）
         for idx, task in enumerate(tasks[:3]):
             task_info = {
@@ -1260,101 +1961,24 @@ def batch_generate_all():
         if len(tasks) > 3:
             app_logger.info(f"[用户:{username}] [批次:{batch_id}] ... 还有 {len(tasks) - 3} 个任务（详情略）")
         
-        # 初始化进度
-        with batch_progress_lock:
-            batch_progress[batch_id] = {
-                'user_id': user_id,
-                'username': username,
-                'total': len(tasks),
-                'completed': 0,
-                'failed': 0,
-                'status': 'running',
-                'start_time': datetime.now().isoformat(),
-                'logs': []
-            }
+        # 选择复用时参数相同的行只生成一次，与最近成功记录相同的行复用已有图片
+        dedupe = dedupe_batch_tasks(tasks, user_id, reuse_results=_reuse_results_requested(data))
         
-        # 创建一个函数在后台线程中执行批量生成
-        def process_batch():
-            for i, task in enumerate(tasks):
-                try:
-                    # 更新进度
-                    task_start_time = datetime.now()
-                    task_info = {
-                        'prompt': task.get('prompt', '')[:100],
-                        'aspect_ratio': task.get('aspect_ratio', '1:1'),
-                        'resolution': task.get('resolution', '2k'),
-                        'num_images': task.get('num_images', 1),
-                        'sample_images_count': len(task.get('sample_images', []))
-                    }
-                    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {i+1}/{len(tasks)}] 开始处理")
-                    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {i+1}/{len(tasks)}] 任务参数: {json.dumps(task_info, ensure_ascii=False)}")
-                    
-                    with batch_progress_lock:
-                        batch_progress[batch_id]['logs'].append({
-                            'time': datetime.now().isoformat(),
-                            'message': f"开始任务 {i+1}/{len(tasks)}: {task.get('prompt', '')[:30]}...",
-                            'type': 'info'
-                        })
-                    
-                    # 调用原有的批量生成逻辑
-                    result = process_single_batch_task(task, batch_id, user_id)
-                    
-                    task_duration = (datetime.now() - task_start_time).total_seconds()
-                    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {i+1}/{len(tasks)}] 处理完成，耗时: {task_duration:.2f}秒")
-                    
-                    with batch_progress_lock:
-                        if result.get('success'):
-                            batch_progress[batch_id]['completed'] += 1
-                            batch_progress[batch_id]['logs'].append({
-                                'time': datetime.now().isoformat(),
-                                'message': f"✓ 任务 {i+1} 完成",
-                                'type': 'success'
-                            })
-                        else:
-                            batch_progress[batch_id]['failed'] += 1
-                            batch_progress[batch_id]['logs'].append({
-                                'time': datetime.now().isoformat(),
-                                'message': f"✗ 任务 {i+1} 失败: {result.get('error', '未知错误')}",
-                                'type': 'error'
-                            })
-                    
-                    app_logger.info(f"[用户:{batch_progress[batch_id].get('username', 'unknown')}] [批次:{batch_id}] 任务进度: {i+1}/{len(tasks)}")
-                    print(f"批量任务进度: {i+1}/{len(tasks)}")
-                except Exception as e:
-                    app_logger.error(f"[用户:{batch_progress[batch_id].get('username', 'unknown')}] [批次:{batch_id}] 任务 {i+1} 失败: {e}")
-                    print(f"批量任务 {i+1} 失败: {e}")
-                    with batch_progress_lock:
-                        batch_progress[batch_id]['failed'] += 1
-                        batch_progress[batch_id]['logs'].append({
-                            'time': datetime.now().isoformat(),
-                            'message': f"✗ 任务 {i+1} 失败: {str(e)}",
-                            'type': 'error'
-                        })
-            
-            # 标记完成
-            with batch_progress_lock:
-                completed_count = batch_progress[batch_id]['completed']
-                failed_count = batch_progress[batch_id]['failed']
-                batch_progress[batch_id]['status'] = 'completed'
-                batch_progress[batch_id]['end_time'] = datetime.now().isoformat()
-                batch_progress[batch_id]['logs'].append({
-                    'time': datetime.now().isoformat(),
-                    'message': f"批量生成完成！成功: {completed_count}, 失败: {failed_count}",
-                    'type': 'success'
-                })
-            
-            app_logger.info(f"[用户:{batch_progress[batch_id].get('username', 'unknown')}] [批次:{batch_id}] 批量生成完成 - 成功: {completed_count}, 失败: {failed_count}")
-            print(f"批量生成完成，批次ID: {batch_id}")
-        
-        # 在后台线程启动处理
-        thread = threading.Thread(target=process_batch, daemon=True)
-        thread.start()
+        # 批次和任务写入持久化队列，由队列工作线程领取执行（进程重启后从中断处继续）
+        try:
+            database.create_batch_job(batch_id, user_id, username, tasks, [batch_task_cost(task) for task in tasks], priority)
+        except Exception:
+            _release_idempotency('batch-generate-all', idempotency_key, batch_id)
+            raise
+        log_batch_dedupe(batch_id, username, dedupe)
+        job_queue.notify()
         
         return jsonify({
             'success': True,
             'message': '批量任务已在后台启动',
             'batch_id': batch_id,
-            'total_tasks': len(tasks)
+            'total_tasks': len(tasks),
+            'dedupe': dedupe
         })
     
     except Exception as e:
@@ -1365,28 +1989,608 @@ def batch_generate_all():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def process_single_batch_task(task, batch_id, user_id):
-    """处理单个批量任务"""
-    try:
-        prompt = task.get('prompt', '').strip()
-        negative_prompt = task.get('negative_prompt', '').strip()
+def _batch_generate_all_replay(batch_id):
+    """幂等键重复提交：返回原批次和它的当前进度"""
+    progress = database.get_batch_job(batch_id, log_limit=0)
+    if progress is None:
+        # 原请求刚登记幂等键，批次还没有写入
+        return jsonify({'success': False, 'error': '相同 Idempotency-Key 的请求正在处理中', 'batch_id': batch_id}), 409
+    progress.pop('logs', None)
+    return jsonify({
+        'success': True,
+        'message': '批量任务已提交过，返回原来的批次',
+        'batch_id': batch_id,
+        'total_tasks': progress['total'],
+        'progress': progress,
+        'replayed': True
+    })
+
+# ==================== 批量预估 ====================
+# 按历史耗时（latency_stats，按模型和尺寸持久化）和当前的并发配置，预测一组任务的 API 调用数和总耗时
+# 没有任何历史耗时时每张图片按这么多秒估算（API + 下载）
+BATCH_ESTIMATE_DEFAULT_SECONDS = 20.0
+
+def _size_pixels(size):
+    width, height = (int(v) for v in size.split('x'))
+    return width * height
+
+def _image_latency(timings, size):
+    """返回 (每张图片的 API 耗时, 每张图片的下载耗时, 依据)；没有该尺寸的记录时按像素数从其他尺寸换算"""
+    timing = timings.get(size)
+    if timing and timing['api_seconds_per_image']:
+        return timing['api_seconds_per_image'], timing['download_seconds'] or 0.0, 'history'
+    known = [t for t in timings.values() if t['api_seconds_per_image']]
+    if not known:
+        return BATCH_ESTIMATE_DEFAULT_SECONDS, 0.0, 'default'
+    ratios = [_size_pixels(size) / _size_pixels(t['size']) for t in known]
+    api = sum(t['api_seconds_per_image'] * r for t, r in zip(known, ratios)) / len(known)
+    download = sum((t['download_seconds'] or 0.0) * r for t, r in zip(known, ratios)) / len(known)
+    return api, download, 'scaled'
+
+def _batch_image_concurrency(user_id, task_count, avg_images):
+    """当前配置下这个用户的批量任务同时进行的图片数，以及用户之间公平调度时分到的份额"""
+    scheduler = {entry['user_id']: entry for entry in database.get_scheduler_state()}
+    me = scheduler.get(user_id, {})
+    user_cap = me.get('max_concurrency')
+    if user_cap is None:
+        user_cap = job_queue.get_settings()['user_max_concurrency']
+    parallel_tasks = min(BATCH_QUEUE_WORKERS, user_cap or BATCH_QUEUE_WORKERS, max(1, task_count))
+    if BATCH_EXECUTOR == 'async':
+        executor_images = min(parallel_tasks * avg_images, batch_async.get_concurrency())
+    elif BATCH_EXECUTOR == 'pipeline':
+        executor_images = min(parallel_tasks * avg_images, _env_workers('PIPELINE_GENERATE_WORKERS', 8))
+    else:
+        # 工作线程内的图片顺序生成
+        executor_images = parallel_tasks
+    limiter = rate_limiter.get_stats()
+    api_slots = max(1.0, limiter['limit'] - limiter['interactive_reserved'])
+    # 其他用户有排队或执行中的任务时按权重分享工作线程
+    weight = me.get('weight') or 1.0
+    other_weights = sum(entry['weight'] or 1.0 for uid, entry in scheduler.items() if uid != user_id and (entry['pending'] or entry['running']))
+    return {
+        'executor': BATCH_EXECUTOR,
+        'queue_workers': BATCH_QUEUE_WORKERS,
+        'user_max_concurrency': user_cap or None,
+        'api_concurrency_limit': round(api_slots, 2),
+        'rate_limit_rps': limiter['rate'],
+        'images_in_parallel': round(max(1.0, min(executor_images, api_slots)), 2),
+        'fair_share': round(weight / (weight + other_weights), 3),
+        'own_pending_cost': me.get('pending_cost') or 0,
+    }
+
+def estimate_batch(tasks, user_id, reuse_results=False):
+    """
+    预估一组批量任务：去重 / 复用后实际需要的 API 调用数、图片数和总耗时（秒）
+    
+    每张图片的耗时取该尺寸最近的平均 API 耗时和下载耗时；总耗时按当前的工作线程数、
+    每用户并发上限、限流器的并发上限与速率、以及其他用户排队时的公平份额计算，
+    queue_wait_seconds 为自己已在排队的任务预计占用的时间。
+    """
+    tasks = json.loads(json.dumps(tasks))
+    dedupe = dedupe_batch_tasks(tasks, user_id, reuse_results)
+    timings = {t['size']: t for t in latency_stats.get_timings(IMAGE_MODEL)}
+    
+    sizes = {}
+    invalid = 0
+    for task in tasks:
+        if not isinstance(task, dict) or not (task.get('prompt') or '').strip():
+            invalid += 1
+            continue
+        if task.get('linked_to') is not None or task.get('reuse'):
+            continue
         aspect_ratio = task.get('aspect_ratio', '1:1')
         resolution = task.get('resolution', '2k')
-        sample_images_data = task.get('sample_images', [])
-        num_images = int(task.get('num_images', 1))
-        filename_base = task.get('filename', 'batch')
-        
-        if not prompt:
-            return {'success': False, 'error': '缺少提示词'}
-        
-        # 获取尺寸
         if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
             width, height = ASPECT_RATIOS[aspect_ratio][resolution]
         else:
             width, height = 2048, 2048
-        
-        # 准备示例图 URL
-        image_urls = [img['url'] for img in sample_images_data if 'url' in img]
+        size = size_negotiation.negotiate(width, height)['size']
+        num_images = _requested_image_count(task.get('num_images', 1))
+        if _use_image_group(IMAGE_MODEL, num_images):
+            api_calls = -(-num_images // ARK_MULTI_IMAGE_MAX)
+        else:
+            api_calls = num_images
+        entry = sizes.setdefault(size, {'size': size, 'tasks': 0, 'images': 0, 'api_calls': 0, 'max_task_images': 0})
+        entry['tasks'] += 1
+        entry['images'] += num_images
+        entry['api_calls'] += api_calls
+        entry['max_task_images'] = max(entry['max_task_images'], num_images)
+    
+    task_count = sum(entry['tasks'] for entry in sizes.values())
+    images = sum(entry['images'] for entry in sizes.values())
+    api_calls = sum(entry['api_calls'] for entry in sizes.values())
+    concurrency = _batch_image_concurrency(user_id, task_count, images / task_count if task_count else 1)
+    
+    work_seconds = 0.0
+    longest_task = 0.0
+    cost = 0.0
+    for entry in sizes.values():
+        api, download, basis = _image_latency(timings, entry['size'])
+        # 流水线模式下载在单独的阶段进行，不占用生成名额
+        slot_seconds = api + (download if BATCH_EXECUTOR != 'pipeline' else 0.0)
+        entry.update({
+            'api_seconds_per_image': round(api, 2),
+            'download_seconds_per_image': round(download, 2),
+            'basis': basis,
+            'samples': timings[entry['size']]['api_calls'] if entry['size'] in timings else 0,
+        })
+        work_seconds += entry['images'] * slot_seconds
+        cost += entry['images'] * _size_pixels(entry['size']) / (2048 * 2048)
+        if BATCH_EXECUTOR == 'thread':
+            longest_task = max(longest_task, entry['max_task_images'] * slot_seconds)
+        else:
+            longest_task = max(longest_task, slot_seconds)
+        del entry['max_task_images']
+    
+    parallel = concurrency['images_in_parallel']
+    seconds = max(work_seconds / parallel, longest_task, api_calls / concurrency['rate_limit_rps'] if concurrency['rate_limit_rps'] else 0.0)
+    seconds /= concurrency['fair_share']
+    # 自己排队中的任务先执行：按本批次每单位成本的耗时换算
+    queue_wait = concurrency['own_pending_cost'] * (work_seconds / cost) / parallel / concurrency['fair_share'] if cost else 0.0
+    return {
+        'tasks': len(tasks),
+        'invalid_tasks': invalid,
+        'dedupe': dedupe,
+        'tasks_to_generate': task_count,
+        'images_to_generate': images,
+        'api_calls': api_calls,
+        'work_seconds': round(work_seconds, 1),
+        'estimated_seconds': round(seconds, 1),
+        'queue_wait_seconds': round(queue_wait, 1),
+        'estimated_total_seconds': round(seconds + queue_wait, 1),
+        'concurrency': concurrency,
+        'sizes': sorted(sizes.values(), key=lambda e: -e['images']),
+    }
+
+@app.route('/api/batch/estimate', methods=['POST'])
+@login_required
+def batch_estimate():
+    """
+    预估批量任务的 API 调用数和耗时（不创建批次），请求体与 /api/batch-generate-all 相同
+    
+    依据为按模型和尺寸持久化的历史耗时；没有历史记录的尺寸按像素数从其他尺寸换算，
+    完全没有记录时每张图片按 BATCH_ESTIMATE_DEFAULT_SECONDS 估算（basis 字段注明依据）。
+    """
+    user_id = session.get('user_id')
+    data = request.get_json(silent=True) or {}
+    tasks = data.get('tasks')
+    if not isinstance(tasks, list) or not tasks:
+        return jsonify({'success': False, 'error': '没有任务'}), 400
+    try:
+        estimate = estimate_batch(tasks, user_id, _reuse_results_requested(data))
+    except Exception as e:
+        app_logger.error(f"[用户:{session.get('username', 'unknown')}] 批量预估失败: {e}", exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+    return jsonify(dict(estimate, success=True))
+
+# ==================== 服务端表格导入 ====================
+# 上传的 .xlsx / .csv 在后台线程中逐行解析、校验并分块写入批次队列，接口在解析开始前就返回 batch_id
+# BATCH_IMPORT_CHUNK_SIZE: 每次写入队列的任务数
+BATCH_IMPORT_CHUNK_SIZE = max(1, int(os.environ.get('BATCH_IMPORT_CHUNK_SIZE', '500')))
+# 每个批次最多记录这么多条被跳过的行（其余只计数）
+BATCH_IMPORT_MAX_ERROR_LOGS = 50
+
+batch_import_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='batch-import')
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """请求体超过上限（见 AppRequest）时返回 JSON，页面可以直接显示错误"""
+    limit_mb = (request.max_content_length or 0) / 1024 / 1024
+    return jsonify({'success': False, 'error': f'上传的文件过大（上限 {limit_mb:.0f} MB）'}), 413
+
+@app.route('/api/batch-import', methods=['POST'])
+@login_required
+def batch_import_file():
+    """
+    上传 .xlsx / .csv 表格创建批量任务（列名与页面上的 Excel 模板相同）
+    
+    文件保存后立即返回 202 和 batch_id，解析、校验和写入队列在后台进行，任务边导入边执行；
+    进度和被跳过的行通过 /api/batch-progress/<batch_id>（或 /stream）查看。
+    """
+    user_id = session.get('user_id')
+    username = session.get('username', 'unknown')
+    file = request.files.get('file')
+    if not (file and file.filename):
+        return jsonify({'success': False, 'error': '请选择要导入的 .xlsx 或 .csv 文件'}), 400
+    try:
+        ext = batch_import.check_format(file.filename)
+    except batch_import.BatchImportError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    priority = request.form.get('priority', 'batch')
+    if priority not in ('batch', 'backfill'):
+        return jsonify({'success': False, 'error': f'不支持的优先级: {priority}'}), 400
+    
+    batch_id = str(uuid.uuid4())
+    path = os.path.join(get_user_upload_folder(user_id), f'import_{batch_id}{ext}')
+    try:
+        file.save(path)
+        database.create_batch_job(batch_id, user_id, username, [], priority=priority, importing=True)
+    except Exception as e:
+        if os.path.exists(path):
+            os.remove(path)
+        app_logger.error(f"[用户:{username}] 批量导入启动失败: {e}", exc_info=True)
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] ========== 开始导入 {file.filename}（{os.path.getsize(path) / 1024:.1f} KB）==========")
+    append_batch_log(batch_id, f"开始导入 {file.filename}")
+    batch_import_executor.submit(run_batch_import, batch_id, user_id, username, path, request.form.get('sample_category'),
+                                 _reuse_results_requested(request.form))
+    
+    return jsonify({
+        'success': True,
+        'message': '文件已上传，正在后台导入',
+        'batch_id': batch_id,
+        'status': 'importing'
+    }), 202
+
+def run_batch_import(batch_id, user_id, username, path, sample_category=None, reuse_results=False):
+    """逐行解析表格，校验后分块写入批次；批次被取消时停止导入"""
+    imported = 0
+    skipped = 0
+    chunk = []
+    dedupe = {'duplicates': 0, 'reused': 0}
+    
+    def flush():
+        nonlocal imported, chunk
+        # 只在块内合并重复行：前面块中的任务可能已经执行完，之后的重复行在执行时按参数哈希复用其结果
+        for key, count in dedupe_batch_tasks(chunk, user_id, reuse_results, start_index=imported).items():
+            dedupe[key] += count
+        if not database.append_batch_tasks(batch_id, imported, chunk, [batch_task_cost(task) for task in chunk]):
+            return False
+        if chunk:
+            imported += len(chunk)
+            append_batch_log(batch_id, f"已导入 {imported} 个任务")
+            job_queue.notify()
+        chunk = []
+        return True
+    
+    try:
+        sample_images = collect_sample_images(user_id, sample_category)
+        # 读取示例图列表可能较慢（OSS），开始解析前先刷新一次导入心跳
+        flush()
+        last_flush = time.time()
+        for row_number, values in batch_import.iter_rows(path):
+            task, error = batch_import.row_to_task(values, sample_images, ASPECT_RATIOS)
+            if error:
+                skipped += 1
+                if skipped <= BATCH_IMPORT_MAX_ERROR_LOGS:
+                    append_batch_log(batch_id, f"第 {row_number} 行已跳过: {error}", 'error')
+                continue
+            chunk.append(task)
+            # 按块写入，长时间没有有效行时也定期刷新导入心跳
+            if len(chunk) >= BATCH_IMPORT_CHUNK_SIZE or time.time() - last_flush > 5:
+                if not flush():
+                    append_batch_log(batch_id, "批次已取消，停止导入", 'error')
+                    break
+                last_flush = time.time()
+        else:
+            flush()
+    except batch_import.BatchImportError as e:
+        app_logger.warning(f"[用户:{username}] [批次:{batch_id}] 导入失败: {e}")
+        append_batch_log(batch_id, f"导入失败: {e}", 'error')
+    except Exception as e:
+        app_logger.error(f"[用户:{username}] [批次:{batch_id}] 导入失败: {e}", exc_info=True)
+        append_batch_log(batch_id, f"导入失败: {e}（已导入的 {imported} 个任务照常执行）", 'error')
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    if skipped > BATCH_IMPORT_MAX_ERROR_LOGS:
+        append_batch_log(batch_id, f"另有 {skipped - BATCH_IMPORT_MAX_ERROR_LOGS} 行被跳过（日志略）", 'error')
+    append_batch_log(batch_id, f"导入完成：{imported} 个任务，跳过 {skipped} 行", 'success' if imported else 'error')
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] 导入完成 - 任务: {imported}，跳过: {skipped}")
+    log_batch_dedupe(batch_id, username, dedupe)
+    _finish_batch_import(batch_id)
+
+def _finish_batch_import(batch_id):
+    progress = database.finish_batch_import(batch_id)
+    if progress and progress['finished']:
+        # 导入结束前所有任务都已执行完（或没有有效的行）
+        finish_batch(progress)
+
+def recover_batch_import(batch_id):
+    """导入心跳超时（导入所在的进程已退出）：结束导入，已写入的任务照常执行"""
+    append_batch_log(batch_id, "导入进程已退出，导入中断（已导入的任务照常执行）", 'error')
+    _finish_batch_import(batch_id)
+
+# ==================== 批量任务去重 / 复用 ====================
+# 每张生成的图片记录生成参数（提示词、负面词、实际请求尺寸、参考图内容）的哈希。
+# 提交批次时选择复用（reuse_results，默认不复用）后：同一批次中参数和数量都相同的行只生成一次，
+# 其余行关联到它并复用它的图片；与最近成功记录相同的行直接复用已有图片，不再调用 API。
+# BATCH_REUSE_WINDOW_HOURS: 选择复用时复用多久以内的成功记录（默认 7 天，0 表示不复用历史记录，只合并批次内的重复行）
+BATCH_REUSE_WINDOW_HOURS = max(0.0, float(os.environ.get('BATCH_REUSE_WINDOW_HOURS', '168')))
+
+def _reuse_results_requested(data):
+    """请求是否选择复用相同参数的结果（reuse_results 为真且没有要求 force_regenerate）"""
+    def flag(name):
+        return str(data.get(name, 'false')).lower() in ('1', 'true', 'on')
+    return flag('reuse_results') and not flag('force_regenerate')
+
+def task_image_urls(task):
+    # 参考图的顺序会影响生成结果（提示词中的"图1""图2"），保持原顺序
+    return [img['url'] for img in task.get('sample_images', []) if isinstance(img, dict) and img.get('url')]
+
+def batch_task_fingerprint(task, reference_keys=None):
+    """
+    批量任务的生成参数哈希（与文件名和生成数量无关），相同哈希的图片可以互相复用
+    
+    参考图按 reference_cache 的内容键计算（同一 URL 的内容被覆盖后不再匹配，不同 URL 的相同图片可以匹配）；
+    reference_keys 为 None 时预处理参考图取得内容键，没有内容键（未经预处理）的参考图按 URL 计算。
+    """
+    aspect_ratio = task.get('aspect_ratio', '1:1')
+    resolution = task.get('resolution', '2k')
+    if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
+        width, height = ASPECT_RATIOS[aspect_ratio][resolution]
+    else:
+        width, height = 2048, 2048
+    image_urls = task_image_urls(task)
+    if reference_keys is None:
+        _, reference_keys = prepare_reference_images(image_urls, with_keys=True)
+    references = [key or url for url, key in zip(image_urls, reference_keys)]
+    return singleflight.make_key(
+        'batch-image',
+        (task.get('prompt') or '').strip(),
+        (task.get('negative_prompt') or '').strip(),
+        width, height, references
+    )
+
+def _reuse_since():
+    return (datetime.now() - timedelta(hours=BATCH_REUSE_WINDOW_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+
+def dedupe_batch_tasks(tasks, user_id, reuse_results=False, start_index=0):
+    """
+    批次入队前的去重（直接修改 tasks 中的任务），只在批次选择复用（reuse_results）时进行
+    
+    选择复用的任务写入 reuse_results 和 params_hash；与同一批次中较早的行参数和数量都相同的行写入
+    linked_to（较早行的序号），不单独执行；与最近成功记录相同的行标记 reuse，执行时复用已有图片。
+    行内 force_regenerate 为真的任务不合并也不复用。
+    返回 {'duplicates': 合并的行数, 'reused': 复用已有结果的行数}
+    """
+    seen = {}
+    duplicates = 0
+    reused = 0
+    if not reuse_results:
+        return {'duplicates': duplicates, 'reused': reused}
+    since = _reuse_since()
+    for offset, task in enumerate(tasks):
+        if not isinstance(task, dict) or not (task.get('prompt') or '').strip():
+            continue
+        if task.get('force_regenerate'):
+            continue
+        task['reuse_results'] = True
+        task['params_hash'] = batch_task_fingerprint(task)
+        num_images = _requested_image_count(task.get('num_images', 1))
+        key = (task['params_hash'], num_images)
+        if key in seen:
+            task['linked_to'] = seen[key]
+            duplicates += 1
+            continue
+        seen[key] = start_index + offset
+        if BATCH_REUSE_WINDOW_HOURS and len(database.find_reusable_records(user_id, task['params_hash'], num_images, since)) >= num_images:
+            task['reuse'] = True
+            reused += 1
+    return {'duplicates': duplicates, 'reused': reused}
+
+def log_batch_dedupe(batch_id, username, dedupe):
+    if dedupe['duplicates'] or dedupe['reused']:
+        app_logger.info(f"[用户:{username}] [批次:{batch_id}] 去重: 合并重复行 {dedupe['duplicates']} 个，复用已有结果 {dedupe['reused']} 个")
+        append_batch_log(batch_id, f"{dedupe['duplicates']} 个任务与批次内其他任务相同，将复用其结果；{dedupe['reused']} 个任务与最近的生成记录相同，将直接复用")
+
+def reuse_batch_task_images(task, batch_id, user_id, records):
+    """为任务写入指向已有图片的生成记录（不复制图片），文件名按任务自己的命名规则"""
+    params = prepare_batch_task(task, with_references=False)
+    for i, record in enumerate(sorted(records, key=lambda r: r['id'])[:params['num_images']]):
+        filename, _ = batch_image_target(params, user_id, i)
+        actual_size = (record['actual_width'], record['actual_height']) if record.get('actual_width') else None
+        save_batch_record(params, batch_id, user_id, record['seed'], filename, record['image_path'], actual_size, reused_from=record['id'])
+
+def fulfil_linked_batch_tasks(claim, task):
+    """任务成功后，关联到它的重复任务复用它的图片（随后由 complete_batch_task 一起标记完成）"""
+    batch_id = claim['batch_id']
+    linked = database.get_linked_batch_tasks(batch_id, claim['task_index'])
+    if not linked or not task.get('params_hash'):
+        return
+    num_images = _requested_image_count(task.get('num_images', 1))
+    records = database.find_reusable_records(claim['user_id'], task['params_hash'], num_images, batch_id=batch_id)
+    for item in linked:
+        reuse_batch_task_images(item['task'], batch_id, claim['user_id'], records)
+        append_batch_log(batch_id, f"任务 {item['task_index']+1} 与任务 {claim['task_index']+1} 相同，复用其 {len(records)} 张图片", 'success')
+
+def batch_task_cost(task):
+    """
+    任务的调度成本：图片数 x 实际请求尺寸的像素数（以 2048x2048 为 1）
+    
+    公平调度按成本而不是任务数分配工作线程，一个 4k 任务占用的份额约为 2k 任务的 4 倍；
+    复用已有结果的任务不调用 API，成本为 0。
+    """
+    if task.get('linked_to') is not None or task.get('reuse'):
+        return 0.0
+    aspect_ratio = task.get('aspect_ratio', '1:1')
+    resolution = task.get('resolution', '2k')
+    if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
+        width, height = ASPECT_RATIOS[aspect_ratio][resolution]
+    else:
+        width, height = 2048, 2048
+    negotiation = size_negotiation.negotiate(width, height)
+    try:
+        num_images = max(1, int(task.get('num_images', 1)))
+    except (TypeError, ValueError):
+        num_images = 1
+    return round(num_images * negotiation['actual_width'] * negotiation['actual_height'] / (2048 * 2048), 3)
+
+def prepare_batch_task(task, with_references=True):
+    """解析批量任务参数，返回生成所需的参数字典（缺少提示词时返回 None；复用已有图片时不需要预处理参考图）"""
+    prompt = task.get('prompt', '').strip()
+    if not prompt:
+        return None
+    
+    negative_prompt = task.get('negative_prompt', '').strip()
+    aspect_ratio = task.get('aspect_ratio', '1:1')
+    resolution = task.get('resolution', '2k')
+    sample_images_data = task.get('sample_images', [])
+    
+    # 获取尺寸
+    if aspect_ratio in ASPECT_RATIOS and resolution in ASPECT_RATIOS[aspect_ratio]:
+        width, height = ASPECT_RATIOS[aspect_ratio][resolution]
+    else:
+        width, height = 2048, 2048
+    
+    # 构建提示词
+    full_prompt = prompt
+    if negative_prompt:
+        full_prompt = f"{prompt}\n负面词: {negative_prompt}"
+    
+    # 协商模型支持的最小且能覆盖请求尺寸的像素尺寸
+    negotiation = size_negotiation.negotiate(width, height)
+    
+    # 准备示例图 URL，预处理参考图（同一示例图在多个任务间只处理一次）
+    image_urls = [img['url'] for img in sample_images_data if 'url' in img]
+    reference_images = []
+    params_hash = task.get('params_hash')
+    if with_references:
+        reference_images, reference_keys = prepare_reference_images(image_urls, with_keys=True)
+        # 按本次实际使用的参考图内容记录参数哈希；写回任务，关联的重复任务按它查找本任务的图片
+        params_hash = task['params_hash'] = batch_task_fingerprint(task, reference_keys)
+    
+    return {
+        'prompt': prompt,
+        'negative_prompt': negative_prompt,
+        'aspect_ratio': aspect_ratio,
+        'resolution': resolution,
+        'sample_images': sample_images_data,
+        'image_urls': image_urls,
+        'reference_images': reference_images,
+        'num_images': int(task.get('num_images', 1)),
+        'filename_base': task.get('filename', 'batch'),
+        'width': width,
+        'height': height,
+        'full_prompt': full_prompt,
+        'negotiation': negotiation,
+        'ark_size': negotiation['size'],
+        'params_hash': params_hash,
+    }
+
+def batch_image_target(params, user_id, index):
+    """返回批量任务第 index 张图片的文件名和本地保存路径"""
+    if params['num_images'] > 1:
+        filename = f"{params['filename_base']}_{index+1}.jpg"
+    else:
+        filename = f"{params['filename_base']}.jpg"
+    
+    # 使用用户专属输出目录
+    user_output_folder = os.path.join('output', str(user_id))
+    os.makedirs(user_output_folder, exist_ok=True)
+    return filename, os.path.join(user_output_folder, filename)
+
+def save_batch_record(params, batch_id, user_id, per_seed, filename, image_path, actual_size=None, reused_from=None):
+    """写入批量任务单张图片的生成记录并返回记录 ID（actual_size 为模型实际生成的尺寸，reused_from 为复用的原记录 ID）"""
+    if actual_size is None:
+        actual_size = (params['negotiation']['actual_width'], params['negotiation']['actual_height'])
+    record_id = database.save_generation_record({
+        'user_id': user_id,
+        'prompt': params['prompt'],
+        'negative_prompt': params['negative_prompt'],
+        'aspect_ratio': params['aspect_ratio'],
+        'resolution': params['resolution'],
+        'width': params['width'],
+        'height': params['height'],
+        'num_images': 1,
+        'seed': per_seed,
+        'steps': 28,
+        'sample_images': params['sample_images'],
+        'image_path': image_path,
+        'filename': filename,
+        'batch_id': batch_id,
+        'status': 'success',
+        'actual_width': actual_size[0],
+        'actual_height': actual_size[1],
+        'params_hash': params.get('params_hash'),
+        'reused_from': reused_from
+    })
+    event_stream.publish(f'batch:{batch_id}')
+    return record_id
+
+def attach_oss_url(record_id, filepath):
+    """把记录对应的本地图片上传 OSS，成功后记录改为 OSS URL；失败时保留本地地址"""
+    try:
+        oss_url = upload_to_aliyun_oss(filepath)
+        if oss_url:
+            database.update_record_image_path(record_id, oss_url)
+        return oss_url
+    except Exception as e:
+        app_logger.error(f"记录 {record_id} 的图片上传 OSS 失败，保留本地地址: {e}")
+        print(f"图片上传 OSS 失败，保留本地地址: {e}")
+        return None
+
+def save_batch_image(params, batch_id, user_id, per_seed, filename, filepath, actual_size=None):
+    """
+    写入批量任务单张图片的生成记录并返回记录 ID
+    
+    记录先以本地地址（/output/...）写入，OSS 上传在后台进行，完成后再改为 OSS URL；
+    返回时记录已经写入，调用方可以据此标记图片完成。
+    """
+    record_id = save_batch_record(params, batch_id, user_id, per_seed, filename, f'/output/{user_id}/{filename}', actual_size)
+    submit_oss_upload(record_id, filepath)
+    return record_id
+
+def submit_oss_upload(record_id, filepath):
+    """
+    提交后台 OSS 上传（见 attach_oss_url）
+    
+    上传中和排队的图片数达到 OSS_UPLOAD_WORKERS + OSS_UPLOAD_QUEUE_SIZE 时阻塞等待，
+    不要在事件循环线程中直接调用。
+    """
+    if not oss_upload_slots.acquire(blocking=False):
+        with oss_upload_lock:
+            oss_upload_stats['waits'] += 1
+        oss_upload_slots.acquire()
+    with oss_upload_lock:
+        oss_upload_stats['pending'] += 1
+    
+    def release(_future=None):
+        with oss_upload_lock:
+            oss_upload_stats['pending'] -= 1
+        oss_upload_slots.release()
+    
+    try:
+        future = oss_upload_executor.submit(attach_oss_url, record_id, filepath)
+    except Exception:
+        release()
+        raise
+    future.add_done_callback(release)
+    return future
+
+def batch_images_result(total, failed):
+    """
+    按失败的图片数返回任务结果：全部成功时成功，否则任务失败
+    
+    部分成功时 error 中注明张数；成功的图片已写入记录并标记完成，不会重复生成。
+    """
+    if not failed:
+        return {'success': True}
+    if failed >= total:
+        return {'success': False, 'error': f'{total} 张图片全部生成失败'}
+    return {'success': False, 'partial': True, 'error': f'{failed}/{total} 张图片生成失败'}
+
+def pending_image_indices(params, done_images):
+    """任务中尚未完成的图片序号（恢复执行时跳过已完成的图片）"""
+    return [i for i in range(params['num_images']) if i not in done_images]
+
+def process_single_batch_task(task, batch_id, user_id, done_images=(), on_image_done=None, should_stop=None):
+    """
+    处理单个批量任务
+    
+    done_images 为已完成的图片序号（中断后恢复时跳过），每张图片的记录写入后调用 on_image_done(序号)；
+    每次 API 调用前检查 should_stop()，批次被暂停或取消时停止并返回 {'stopped': True}（已生成的图片照常保存）。
+    有图片失败时任务失败（见 batch_images_result）。
+    """
+    try:
+        params = prepare_batch_task(task)
+        if params is None:
+            return {'success': False, 'error': '缺少提示词'}
         
         # 获取方舟大模型 API Key
         api_key = os.environ.get('ARK_API_KEY')
@@ -1395,235 +2599,558 @@ def process_single_batch_task(task, batch_id, user_id):
         if not api_key:
             return {'success': False, 'error': 'ARK_API_KEY 未配置'}
         
-        # 初始化 OpenAI 客户端
-        client = OpenAI(api_key=api_key, base_url=base_url)
+        # 获取共享的 OpenAI 客户端（复用连接池）
+        client = ark_clients.get_ark_client(api_key, base_url)
+        
+        indices = pending_image_indices(params, done_images)
+        if should_stop and should_stop():
+            return {'success': False, 'stopped': True}
+        
+        # 组图模式：先用一次调用请求全部图片，未返回的部分再逐张生成
+        group_images = request_image_group(client, params['full_prompt'], params['ark_size'], len(indices), f"[批次:{batch_id}]", reference_images=params['reference_images'])
         
         # 生成图片
-        for i in range(num_images):
+        failed = 0
+        for pos, i in enumerate(indices):
             per_seed = random.randint(1, 99999999)
             
-            # 构建提示词
-            full_prompt = prompt
-            if negative_prompt:
-                full_prompt = f"{prompt}\n负面词: {negative_prompt}"
-            
-            # 根据分辨率映射到方舟大模型支持的size格式
-            size_map = {
-                '1024x1024': '1K',
-                '2048x2048': '2K',
-                '1536x1536': '2K',
-            }
-            ark_size = size_map.get(f"{width}x{height}", "2K")
-            
             try:
-                response = client.images.generate(
-                    model="doubao-seedream-4-5-251128",
-                    prompt=full_prompt,
-                    size=ark_size,
-                    response_format="url",
-                    extra_body={
-                        "watermark": False,
-                    }
-                )
+                if pos < len(group_images):
+                    image = group_images[pos]
+                else:
+                    if should_stop and should_stop():
+                        return {'success': False, 'stopped': True}
+                    image = request_image(client, params['full_prompt'], params['ark_size'], reference_images=params['reference_images'])
+                    if image is None:
+                        failed += 1
+                        continue
                 
-                if response.data and len(response.data) > 0:
-                    img_url = response.data[0].url
-                    
-                    # 下载图片
-                    import requests
-                    img_response = requests.get(img_url)
-                    if img_response.status_code == 200:
-                        img_data = img_response.content
-                    
-                        if num_images > 1:
-                            filename = f"{filename_base}_{i+1}.jpg"
-                        else:
-                            filename = f"{filename_base}.jpg"
-                        
-                        # 使用用户专属输出目录
-                        user_output_folder = os.path.join('output', str(user_id))
-                        os.makedirs(user_output_folder, exist_ok=True)
-                        filepath = os.path.join(user_output_folder, filename)
-                        with open(filepath, 'wb') as f:
-                            f.write(img_data)
-                        
-                        # 上传到 OSS
-                        oss_url = upload_to_aliyun_oss(filepath)
-                        
-                        # 保存记录
-                        if oss_url:
-                            database.save_generation_record({
-                                'user_id': user_id,
-                                'prompt': prompt,
-                                'negative_prompt': negative_prompt,
-                                'aspect_ratio': aspect_ratio,
-                                'resolution': resolution,
-                                'width': width,
-                                'height': height,
-                                'num_images': 1,
-                                'seed': per_seed,
-                                'steps': 28,
-                                'sample_images': sample_images_data,
-                                'image_path': oss_url,
-                                'filename': filename,
-                                'batch_id': batch_id,
-                                'status': 'success'
-                            })
+                # 流式下载图片（b64_json 响应直接解码写盘）
+                filename, filepath = batch_image_target(params, user_id, i)
+                save_generated_image(image, filepath, params['ark_size'])
+                actual_size = size_negotiation.fit_image(filepath, params['negotiation'])
+                # 记录写入后才标记完成，否则恢复时会跳过没有记录的图片
+                save_batch_image(params, batch_id, user_id, per_seed, filename, filepath, actual_size)
+                if on_image_done:
+                    on_image_done(i)
             except Exception as e:
                 print(f"生成第 {i+1} 张图片时出错: {e}")
+                failed += 1
                 continue
         
-        return {'success': True}
+        return batch_images_result(len(indices), failed)
+    
+    except Exception as e:
+        print(f"处理单个任务失败: {e}")
+        return {'success': False, 'error': str(e)}
+
+async def process_single_batch_task_async(task, batch_id, user_id, done_images=(), on_image_done=None, should_stop=None):
+    """
+    处理单个批量任务（asyncio 版本）
+    
+    任务内的多张图片并发请求，每张图片的 API 调用与下载都占用一个全局并发名额；
+    done_images / on_image_done / should_stop 与 process_single_batch_task 相同。
+    """
+    try:
+        # 参考图预处理可能需要下载和转码，放到线程中执行
+        params = await asyncio.to_thread(prepare_batch_task, task)
+        if params is None:
+            return {'success': False, 'error': '缺少提示词'}
+        
+        api_key = os.environ.get('ARK_API_KEY')
+        base_url = os.environ.get('ARK_BASE_URL', 'https://ark.cn-beijing.volces.com/api/v3')
+        
+        if not api_key:
+            return {'success': False, 'error': 'ARK_API_KEY 未配置'}
+        
+        client = ark_clients.get_async_ark_client(api_key, base_url)
+        indices = pending_image_indices(params, done_images)
+        stopped = []
+        
+        async def stop_requested():
+            if should_stop and await asyncio.to_thread(should_stop):
+                stopped.append(True)
+            return bool(stopped)
+        
+        if await stop_requested():
+            return {'success': False, 'stopped': True}
+        
+        # 组图模式：先用一次调用请求全部图片，未返回的部分再逐张生成
+        group_images = []
+        if _use_image_group(IMAGE_MODEL, len(indices)):
+            async with batch_async.slot():
+                group_images = await request_image_group_async(client, params['full_prompt'], params['ark_size'], len(indices), f"[批次:{batch_id}]", reference_images=params['reference_images'])
+        
+        async def generate_one(pos, i):
+            """返回 True（成功）/ False（失败）/ None（因暂停或取消跳过）"""
+            per_seed = random.randint(1, 99999999)
+            try:
+                async with batch_async.slot():
+                    if pos < len(group_images):
+                        image = group_images[pos]
+                    else:
+                        # 拿到名额时再检查一次：排队期间批次可能已被暂停或取消
+                        if await stop_requested():
+                            return None
+                        image = await request_image_async(client, params['full_prompt'], params['ark_size'], reference_images=params['reference_images'])
+                        if image is None:
+                            return False
+                    filename, filepath = batch_image_target(params, user_id, i)
+                    await save_generated_image_async(image, filepath, params['ark_size'])
+                
+                actual_size = await size_negotiation.fit_image_async(filepath, params['negotiation'])
+                # 数据库写入是阻塞操作，放到线程中执行；记录写入后才标记完成
+                await asyncio.to_thread(save_batch_image, params, batch_id, user_id, per_seed, filename, filepath, actual_size)
+                if on_image_done:
+                    await asyncio.to_thread(on_image_done, i)
+                return True
+            except Exception as e:
+                print(f"生成第 {i+1} 张图片时出错: {e}")
+                return False
+        
+        results = await asyncio.gather(*(generate_one(pos, i) for pos, i in enumerate(indices)))
+        if stopped:
+            return {'success': False, 'stopped': True}
+        return batch_images_result(len(indices), results.count(False))
     
     except Exception as e:
         print(f"处理单个任务失败: {e}")
         return {'success': False, 'error': str(e)}
 
+# ==================== 分阶段流水线执行器 ====================
+# PIPELINE_*_WORKERS: 各阶段的工作线程数；PIPELINE_QUEUE_SIZE: 每个阶段的队列长度上限
+# 下游阶段（如 OSS 上传）变慢时队列逐级占满，上游暂停取新任务，而不是无限堆积已下载的图片
+batch_pipeline = None
+batch_pipeline_lock = threading.Lock()
+
+class BatchTaskStopped(Exception):
+    """批次被暂停或取消，流水线中尚未请求 API 的图片不再生成"""
+
+def _pipeline_generate(job):
+    """流水线生成阶段：调用 API 获取图片（url 或 b64_json），组图任务在这里拆成单张图片"""
+    # 阶段线程不继承提交方的上下文，按作业记录的优先级发起 API 调用
+    with rate_limiter.priority(job['priority']):
+        return _pipeline_generate_images(job)
+
+def _pipeline_generate_images(job):
+    params = job['params']
+    indices = job['indices']
+    should_stop = job['should_stop']
+    if should_stop and should_stop():
+        for i in indices:
+            job['on_done'](dict(job, indices=[i], count=1, index=i), BatchTaskStopped())
+        return []
+    client = ark_clients.get_ark_client()
+    group_images = request_image_group(client, params['full_prompt'], params['ark_size'], len(indices), f"[批次:{job['batch_id']}]", reference_images=params['reference_images'])
+    
+    outputs = []
+    for pos, i in enumerate(indices):
+        image_job = dict(job, indices=[i], count=1, index=i, per_seed=random.randint(1, 99999999))
+        try:
+            if pos < len(group_images):
+                image = group_images[pos]
+            else:
+                if should_stop and should_stop():
+                    raise BatchTaskStopped()
+                image = request_image(client, params['full_prompt'], params['ark_size'], reference_images=params['reference_images'])
+                if image is None:
+                    raise RuntimeError('API 未返回图片')
+        except Exception as e:
+            job['on_done'](image_job, e)
+            continue
+        image_job['image'] = image
+        outputs.append(image_job)
+    return outputs
+
+def _pipeline_download(job):
+    """流水线下载阶段：流式下载或解码到用户输出目录（临时文件 + 原子重命名）"""
+    filename, filepath = batch_image_target(job['params'], job['user_id'], job['index'])
+    save_generated_image(job.pop('image'), filepath, job['params']['ark_size'])
+    job['filename'] = filename
+    job['filepath'] = filepath
+    return job
+
+def _pipeline_resize(job):
+    """流水线缩放阶段：模型生成尺寸大于请求尺寸时裁剪缩放"""
+    job['actual_size'] = size_negotiation.fit_image(job['filepath'], job['params']['negotiation'])
+    return job
+
+def _pipeline_record(job):
+    """流水线记录阶段：以本地地址写入生成记录（单线程写 SQLite），写入后标记图片完成"""
+    job['record_id'] = save_batch_record(job['params'], job['batch_id'], job['user_id'], job['per_seed'], job['filename'], f"/output/{job['user_id']}/{job['filename']}", job['actual_size'])
+    job['on_recorded'](job)
+    return job
+
+def _pipeline_upload(job):
+    """流水线上传阶段：上传 OSS 后把记录改为 OSS URL，上传失败时保留本地地址，不算图片失败"""
+    attach_oss_url(job['record_id'], job['filepath'])
+    return job
+
+def _env_workers(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+def get_batch_pipeline():
+    """获取批量生成流水线，首次调用时创建各阶段的工作线程"""
+    global batch_pipeline
+    with batch_pipeline_lock:
+        if batch_pipeline is None:
+            queue_size = _env_workers('PIPELINE_QUEUE_SIZE', 32)
+            batch_pipeline = pipeline.StagedPipeline([
+                pipeline.PipelineStage('generate', _pipeline_generate, _env_workers('PIPELINE_GENERATE_WORKERS', 8), queue_size),
+                pipeline.PipelineStage('download', _pipeline_download, _env_workers('PIPELINE_DOWNLOAD_WORKERS', 8), queue_size),
+                pipeline.PipelineStage('resize', _pipeline_resize, _env_workers('PIPELINE_RESIZE_WORKERS', 2), queue_size),
+                pipeline.PipelineStage('record', _pipeline_record, _env_workers('PIPELINE_RECORD_WORKERS', 1), queue_size),
+                pipeline.PipelineStage('upload', _pipeline_upload, _env_workers('PIPELINE_UPLOAD_WORKERS', 4), queue_size),
+            ], name='batch')
+        return batch_pipeline
+
+def process_single_batch_task_pipeline(task, batch_id, user_id, done_images=(), on_image_done=None, should_stop=None):
+    """
+    使用分阶段流水线处理单个批量任务
+    
+    每张图片依次经过 生成 -> 下载 -> 缩放 -> 写记录 -> 上传 五个阶段，各阶段并行处理不同图片；
+    记录写入后即标记图片完成，OSS 上传失败不影响记录（保留本地地址）；
+    任务的所有图片走完流水线（成功、失败或因暂停/取消跳过）后返回。
+    done_images / on_image_done / should_stop 与 process_single_batch_task 相同。
+    """
+    params = prepare_batch_task(task)
+    if params is None:
+        return {'success': False, 'error': '缺少提示词'}
+    if not os.environ.get('ARK_API_KEY'):
+        return {'success': False, 'error': 'ARK_API_KEY 未配置'}
+    
+    indices = pending_image_indices(params, done_images)
+    if not indices:
+        return {'success': True}
+    
+    pipe = get_batch_pipeline()
+    state_lock = threading.Lock()
+    all_done = threading.Event()
+    remaining = [len(indices)]
+    stopped = []
+    failed = []
+    
+    def on_image_recorded(job):
+        if on_image_done:
+            on_image_done(job['index'])
+    
+    def on_image_finished(job, error):
+        if isinstance(error, BatchTaskStopped):
+            stopped.append(job['index'])
+        elif error is not None:
+            print(f"生成第 {job['indices'][0]+1} 张图片时出错: {error}")
+            failed.append(job['index'])
+        with state_lock:
+            remaining[0] -= job['count']
+            last = remaining[0] <= 0
+        if last:
+            all_done.set()
+    
+    job = {
+        'batch_id': batch_id,
+        'user_id': user_id,
+        'params': params,
+        'priority': rate_limiter.current_priority(),
+        'should_stop': should_stop,
+        'on_recorded': on_image_recorded,
+        'on_done': on_image_finished,
+    }
+    # 组图模式下整个任务作为一个生成作业，否则每张图片单独进入流水线
+    if _use_image_group(IMAGE_MODEL, len(indices)):
+        jobs = [dict(job, indices=indices, count=len(indices))]
+    else:
+        jobs = [dict(job, indices=[k], count=1) for k in indices]
+    for item in jobs:
+        # 生成队列已满时在这里阻塞（背压）
+        pipe.submit(item)
+    
+    all_done.wait()
+    if stopped:
+        return {'success': False, 'stopped': True}
+    return batch_images_result(len(indices), len(failed))
+
+# ==================== 持久化批量任务队列 ====================
+# BATCH_QUEUE_WORKERS: 同时执行的批量任务数（所有批次共享）；thread 模式下每个任务内的图片顺序生成，
+# async / pipeline 模式下工作线程只负责提交和等待，图片并发由各自的并发配置控制
+BATCH_QUEUE_WORKERS = max(1, int(os.environ.get('BATCH_QUEUE_WORKERS', '4' if BATCH_EXECUTOR == 'thread' else '32')))
+
+def run_batch_task(claim):
+    """队列工作线程执行一个已领取的批量任务，按 BATCH_EXECUTOR 选择执行方式"""
+    batch_id = claim['batch_id']
+    user_id = claim['user_id']
+    username = claim.get('username') or 'unknown'
+    index = claim['task_index']
+    task = claim['task']
+    done_images = claim.get('done_images') or set()
+    
+    if claim['attempts'] > 1:
+        app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}/{claim['total']}] 中断后恢复执行，已完成 {len(done_images)} 张图片")
+        append_batch_log(batch_id, f"任务 {index+1} 从中断处恢复（已完成 {len(done_images)} 张图片）")
+    log_batch_task_start(batch_id, username, index, claim['total'], task)
+    task_start_time = time.time()
+    
+    def on_image_done(image_index):
+        database.mark_batch_image_done(claim['id'], image_index)
+    
+    def should_stop():
+        return database.get_batch_job_status(batch_id) in ('paused', 'cancelled')
+    
+    # 批次的优先级（batch / backfill）作用于任务内所有 API 调用，交互式请求等待时在图片之间让出名额
+    try:
+        result = _reuse_batch_task(claim, task, done_images)
+        if result is None:
+            with rate_limiter.priority(claim.get('priority') or 'batch'):
+                result = _run_batch_task_executor(task, batch_id, user_id, done_images, on_image_done, should_stop)
+        if result.get('success'):
+            fulfil_linked_batch_tasks(claim, task)
+    except Exception as e:
+        app_logger.error(f"[用户:{username}] [批次:{batch_id}] 任务 {index+1} 失败: {e}")
+        print(f"批量任务 {index+1} 失败: {e}")
+        result = {'success': False, 'error': str(e)}
+    
+    app_logger.info(f"[用户:{username}] [批次:{batch_id}] [任务 {index+1}/{claim['total']}] 处理完成，耗时: {time.time() - task_start_time:.2f}秒")
+    return result
+
+def _reuse_batch_task(claim, task, done_images):
+    """
+    参数与最近成功记录相同的任务直接复用已有图片，返回结果；不能复用时返回 None（照常生成）
+    
+    执行时重新查询（入队时的记录可能已被删除，之前的导入块中的相同任务可能刚刚完成），图片不足时重新生成。
+    """
+    if not task.get('reuse_results') or task.get('force_regenerate') or done_images or not BATCH_REUSE_WINDOW_HOURS:
+        return None
+    # 参考图的内容可能在入队之后变化，按当前内容重新计算参数哈希
+    task['params_hash'] = batch_task_fingerprint(task)
+    num_images = _requested_image_count(task.get('num_images', 1))
+    records = database.find_reusable_records(claim['user_id'], task['params_hash'], num_images, _reuse_since())
+    if len(records) < num_images:
+        if task.get('reuse'):
+            append_batch_log(claim['batch_id'], f"任务 {claim['task_index']+1} 的已有结果已不可用，重新生成")
+        return None
+    reuse_batch_task_images(task, claim['batch_id'], claim['user_id'], records)
+    app_logger.info(f"[用户:{claim.get('username') or 'unknown'}] [批次:{claim['batch_id']}] 任务 {claim['task_index']+1} 复用最近的 {num_images} 张生成结果")
+    append_batch_log(claim['batch_id'], f"任务 {claim['task_index']+1} 复用最近的生成结果（{num_images} 张），未调用 API", 'success')
+    return {'success': True, 'reused': True}
+
+def _run_batch_task_executor(task, batch_id, user_id, done_images, on_image_done, should_stop):
+    """按 BATCH_EXECUTOR 执行任务内的图片"""
+    if BATCH_EXECUTOR == 'async':
+        # 在 asyncio 事件循环中并发生成任务内的图片（全局信号量限制同时进行的图片请求数）；
+        # 协程在提交时的上下文副本中运行，优先级随之带入
+        return batch_async.submit(process_single_batch_task_async(task, batch_id, user_id, done_images, on_image_done, should_stop)).result()
+    if BATCH_EXECUTOR == 'pipeline':
+        return process_single_batch_task_pipeline(task, batch_id, user_id, done_images, on_image_done, should_stop)
+    return process_single_batch_task(task, batch_id, user_id, done_images, on_image_done, should_stop)
+
+@app.route('/api/single-generation-status/<task_id>/stream', methods=['GET'])
+@login_required
+def stream_single_generation_status(task_id):
+    """
+    单图生成任务状态推送（SSE）：连接建立时推送 task（完整的任务状态），之后状态变化时只推送 update
+    （变化的字段，已删除的字段为 null），任务结束后推送 end 并关闭连接
+    
+    事件ID 为任务状态的 revision；断线重连时 Last-Event-ID 与当前 revision 相同则不再推送完整状态。
+    """
+    task = single_generation_tasks.get(task_id)
+    if task is None:
+        return jsonify({'success': False, 'error': '任务不存在或已过期'}), 404
+    if task.get('user_id') != session.get('user_id'):
+        return jsonify({'success': False, 'error': '无权访问此任务'}), 403
+    try:
+        last_revision = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    except (TypeError, ValueError):
+        last_revision = None
+    
+    def poll(last):
+        task = single_generation_tasks.get(task_id)
+        if task is None:
+            return [('end', {'status': 'expired'}, None)], last, True
+        revision = task.get('revision', 0)
+        events = []
+        if last is None:
+            if revision != last_revision:
+                events.append(('task', task, revision))
+        elif revision != last.get('revision', 0):
+            delta = {key: value for key, value in task.items() if key not in last or last[key] != value}
+            delta.update({key: None for key in last if key not in task})
+            events.append(('update', delta, revision))
+        finished = task.get('status') in ('completed', 'failed')
+        if finished:
+            events.append(('end', {'status': task['status']}, revision))
+        return events, task, finished
+    
+    return _sse_response(event_stream.stream(f'single:{task_id}', poll))
+
 @app.route('/api/single-generation-status/<task_id>', methods=['GET'])
 @login_required
 def get_single_generation_status(task_id):
-    """查询单图生成任务状态"""
+    """
+    查询单图生成任务状态
+    
+    状态、进度（progress/total/in_flight）和结果（图片列表）都由后台任务写入状态存储，这里原样返回。
+    """
     user_id = session.get('user_id')
     username = session.get('username', 'unknown')
     
-    with single_generation_lock:
-        if task_id in single_generation_tasks:
-            # 任务在内存中
-            # 验证任务属于当前用户
-            if single_generation_tasks[task_id].get('user_id') != user_id:
-                app_logger.warning(f"[用户:{username}] 尝试访问其他用户的任务: {task_id}")
-                return jsonify({'success': False, 'error': '无权访问此任务'}), 403
-            
-            task = single_generation_tasks[task_id].copy()
-            task_status = task.get('status')
-            app_logger.debug(f"[用户:{username}] 查询任务状态: {task_id} - {task_status}")
-            
-            # 如果任务状态是generating，但已经过了较长时间（超过30秒），检查数据库是否有记录
-            if task_status == 'generating':
-                start_time_str = task.get('start_time')
-                if start_time_str:
-                    try:
-                        if 'T' in start_time_str:
-                            start_time = datetime.fromisoformat(start_time_str.replace('Z', '+00:00'))
-                        else:
-                            start_time = datetime.strptime(start_time_str, '%Y-%m-%d %H:%M:%S')
-                        
-                        elapsed = (datetime.now() - start_time.replace(tzinfo=None)).total_seconds()
-                        
-                        # 如果任务开始超过30秒，检查数据库是否有记录（图片生成通常很快）
-                        if elapsed > 30:  # 30秒
-                            records = database.get_all_records(user_id, limit=10, offset=0)
-                            if records:
-                                # 检查是否有在任务开始时间之后创建的记录
-                                for record in records:
-                                    try:
-                                        if 'T' in record['created_at']:
-                                            record_time = datetime.fromisoformat(record['created_at'].replace('Z', '+00:00'))
-                                        else:
-                                            record_time = datetime.strptime(record['created_at'], '%Y-%m-%d %H:%M:%S')
-                                        
-                                        # 如果记录时间在任务开始时间之后，且时间差合理（不超过10分钟），认为任务已完成
-                                        record_elapsed = (record_time.replace(tzinfo=None) - start_time.replace(tzinfo=None)).total_seconds()
-                                        if record_elapsed >= 0 and record_elapsed < 600:  # 在任务开始后10分钟内
-                                            app_logger.info(f"[用户:{username}] 任务 {task_id} 状态为generating但检测到数据库记录（{int(record_elapsed)}秒后），更新为已完成")
-                                            # 更新内存中的任务状态
-                                            task['status'] = 'completed'
-                                            task['end_time'] = record['created_at']
-                                            task['result'] = {
-                                                'images_count': 1,
-                                                'filenames': [record['filename']]
-                                            }
-                                            single_generation_tasks[task_id] = task
-                                            # 更新task变量，确保返回最新状态
-                                            task = task.copy()
-                                            break
-                                    except Exception as e:
-                                        app_logger.error(f"[用户:{username}] 解析记录时间失败: {e}")
-                                        continue
-                    except Exception as e:
-                        app_logger.error(f"[用户:{username}] 检查任务完成状态失败: {e}", exc_info=True)
-            
-            # 确保返回更新后的任务状态
-            final_task = single_generation_tasks.get(task_id, task)
-            app_logger.debug(f"[用户:{username}] 返回任务状态: {task_id} - {final_task.get('status')}")
-            return jsonify({
-                'success': True,
-                'task': final_task.copy() if isinstance(final_task, dict) else final_task
-            })
-        else:
-            # 任务不在内存中，可能是服务重启或任务已过期
-            # 检查数据库中是否有最近生成的记录（10分钟内）
-            try:
-                from datetime import timedelta
-                records = database.get_all_records(user_id, limit=10, offset=0)
-                
-                # 检查是否有最近生成的记录
-                if records:
-                    latest_record = records[0]
-                    # 处理不同的时间格式
-                    try:
-                        if 'T' in latest_record['created_at']:
-                            # ISO格式: 2024-01-01T12:00:00
-                            record_time = datetime.fromisoformat(latest_record['created_at'].replace('Z', '+00:00'))
-                        else:
-                            # SQLite格式: 2024-01-01 12:00:00
-                            record_time = datetime.strptime(latest_record['created_at'], '%Y-%m-%d %H:%M:%S')
-                    except:
-                        # 如果解析失败，尝试其他格式
-                        try:
-                            record_time = datetime.strptime(latest_record['created_at'], '%Y-%m-%d %H:%M:%S.%f')
-                        except:
-                            record_time = datetime.now()
-                    
-                    time_diff = (datetime.now() - record_time.replace(tzinfo=None)).total_seconds()
-                    
-                    # 如果记录在10分钟内，认为任务可能已完成
-                    if time_diff < 600:  # 10分钟
-                        app_logger.info(f"[用户:{username}] 任务 {task_id} 不在内存中，但检测到最近有生成记录（{int(time_diff)}秒前），标记为已完成")
-                        # 返回一个完成状态的任务对象
-                        return jsonify({
-                            'success': True,
-                            'task': {
-                                'user_id': user_id,
-                                'username': username,
-                                'status': 'completed',
-                                'start_time': latest_record['created_at'],
-                                'end_time': latest_record['created_at'],
-                                'result': {
-                                    'images_count': 1,
-                                    'filenames': [latest_record['filename']]
-                                }
-                            }
-                        })
-            except Exception as e:
-                app_logger.error(f"[用户:{username}] 检查数据库记录失败: {e}", exc_info=True)
-            
-            # 如果找不到相关记录，返回任务不存在
-            app_logger.warning(f"[用户:{username}] 任务不存在: {task_id}")
-            return jsonify({'success': False, 'error': '任务ID不存在或已过期'}), 404
+    # 从状态存储读取（STATE_BACKEND=sqlite 时其他工作进程创建的任务也能查到）
+    task = single_generation_tasks.get(task_id)
+    if task is None:
+        # 任务已过期，或服务重启后丢失（memory 后端）
+        app_logger.warning(f"[用户:{username}] 任务不存在: {task_id}")
+        return jsonify({'success': False, 'error': '任务ID不存在或已过期'}), 404
+    
+    # 验证任务属于当前用户
+    if task.get('user_id') != user_id:
+        app_logger.warning(f"[用户:{username}] 尝试访问其他用户的任务: {task_id}")
+        return jsonify({'success': False, 'error': '无权访问此任务'}), 403
+    
+    app_logger.debug(f"[用户:{username}] 查询任务状态: {task_id} - {task.get('status')}")
+    return jsonify({
+        'success': True,
+        'task': task
+    })
 
 @app.route('/api/batch-progress/<batch_id>', methods=['GET'])
 @login_required
 def get_batch_progress(batch_id):
     """查询批量任务进度"""
     user_id = session.get('user_id')
-    with batch_progress_lock:
-        if batch_id not in batch_progress:
-            return jsonify({'success': False, 'error': '批次ID不存在'}), 404
-        
-        # 验证批次属于当前用户
-        if batch_progress[batch_id].get('user_id') != user_id:
-            return jsonify({'success': False, 'error': '无权访问此批次'}), 403
-        
-        progress = batch_progress[batch_id].copy()
-        # 只返回最近100条日志
-        if len(progress['logs']) > 100:
-            progress['logs'] = progress['logs'][-100:]
-        
-        return jsonify({
-            'success': True,
-            'progress': progress
-        })
+    # 从数据库读取（只返回最近100条日志），进程重启后仍可查询
+    progress = database.get_batch_job(batch_id, log_limit=100)
+    if progress is None:
+        return jsonify({'success': False, 'error': '批次ID不存在'}), 404
+    
+    # 验证批次属于当前用户
+    if progress.get('user_id') != user_id:
+        return jsonify({'success': False, 'error': '无权访问此批次'}), 403
+    
+    return jsonify({
+        'success': True,
+        'progress': progress
+    })
+
+def _own_batch_job(batch_id):
+    """读取属于当前用户的批次，返回 (批次, 错误响应)"""
+    progress = database.get_batch_job(batch_id, log_limit=0)
+    if progress is None:
+        return None, (jsonify({'success': False, 'error': '批次ID不存在'}), 404)
+    if progress.get('user_id') != session.get('user_id'):
+        return None, (jsonify({'success': False, 'error': '无权访问此批次'}), 403)
+    return progress, None
+
+def _sse_response(generator):
+    """
+    SSE 响应：关闭缓存和反向代理缓冲，事件立即送达浏览器
+    
+    每个推送连接占用一个处理线程直到任务结束（见 event_stream），推送连接数达到 SSE_MAX_STREAMS 时返回 503，
+    浏览器的 EventSource 不再重连，页面改为轮询状态接口。
+    """
+    if not event_stream.acquire_stream():
+        generator.close()
+        return jsonify({'success': False, 'error': '推送连接数已满，请使用轮询'}), 503
+    response = Response(generator, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(event_stream.release_stream)
+    return response
+
+def _parse_batch_event_id(value):
+    """批次事件ID 为 <日志ID>.<图片记录ID>，无法解析时从头推送"""
+    try:
+        log_id, record_id = (int(part) for part in value.split('.'))
+        return log_id, record_id
+    except (AttributeError, ValueError):
+        return 0, 0
+
+@app.route('/api/batch-progress/<batch_id>/stream', methods=['GET'])
+@login_required
+def stream_batch_progress(batch_id):
+    """
+    批量任务进度推送（SSE），只推送增量事件：
+    progress（计数或状态变化）、log（新日志）、image（新生成的图片）、end（批次结束，随后关闭连接）
+    
+    断线重连时浏览器通过 Last-Event-ID（或 last_event_id 参数）带回最后收到的事件ID，
+    只推送其后的日志和图片；连接建立时总会先推送一次当前进度。
+    """
+    progress, error = _own_batch_job(batch_id)
+    if error:
+        return error
+    log_id, record_id = _parse_batch_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    
+    def read_new(cursor, events):
+        for log in database.get_batch_logs_after(batch_id, cursor['log']):
+            cursor['log'] = log['id']
+            events.append(('log', log, f"{cursor['log']}.{cursor['record']}"))
+        for image in database.get_batch_records_after(batch_id, cursor['record']):
+            cursor['record'] = image['id']
+            events.append(('image', image, f"{cursor['log']}.{cursor['record']}"))
+    
+    def poll(cursor):
+        events = []
+        job = database.get_batch_job(batch_id, log_limit=0)
+        read_new(cursor, events)
+        snapshot = {key: job[key] for key in ('status', 'total', 'completed', 'failed', 'cancelled', 'running', 'importing')}
+        if snapshot != cursor['progress']:
+            cursor['progress'] = snapshot
+            events.append(('progress', snapshot, f"{cursor['log']}.{cursor['record']}"))
+        # 已取消的批次要等执行中的任务在图片之间停下来
+        finished = snapshot['status'] == 'completed' or (snapshot['status'] == 'cancelled' and not snapshot['running'])
+        if finished and not job['closed']:
+            # 结束日志在批次状态更新之后写入（写入时批次标记为已关闭），写入时的发布会再次唤醒推送；
+            # 写入方异常退出、批次一直没有关闭时，最迟在一个保活间隔之后结束
+            cursor['finished_at'] = cursor['finished_at'] or time.time()
+            finished = time.time() - cursor['finished_at'] >= event_stream.keepalive_interval()
+        if finished:
+            events.append(('end', snapshot, f"{cursor['log']}.{cursor['record']}"))
+        return events, cursor, finished
+    
+    cursor = {'log': log_id, 'record': record_id, 'progress': None, 'finished_at': None}
+    return _sse_response(event_stream.stream(f'batch:{batch_id}', poll, cursor))
+
+@app.route('/api/batch/<batch_id>/pause', methods=['POST'])
+@login_required
+def pause_batch(batch_id):
+    """暂停批次：不再领取新任务，执行中的任务在两张图片之间停止，已完成的图片保留"""
+    progress, error = _own_batch_job(batch_id)
+    if error:
+        return error
+    if not database.set_batch_job_paused(batch_id, True):
+        return jsonify({'success': False, 'error': f"批次当前状态为 {progress['status']}，无法暂停"}), 409
+    append_batch_log(batch_id, '批次已暂停')
+    app_logger.info(f"[用户:{session.get('username', 'unknown')}] [批次:{batch_id}] 暂停批次")
+    return jsonify({'success': True, 'status': 'paused'})
+
+@app.route('/api/batch/<batch_id>/resume', methods=['POST'])
+@login_required
+def resume_batch(batch_id):
+    """继续已暂停的批次，已完成的图片不会重新生成"""
+    progress, error = _own_batch_job(batch_id)
+    if error:
+        return error
+    if not database.set_batch_job_paused(batch_id, False):
+        return jsonify({'success': False, 'error': f"批次当前状态为 {progress['status']}，无法继续"}), 409
+    append_batch_log(batch_id, '批次已继续')
+    app_logger.info(f"[用户:{session.get('username', 'unknown')}] [批次:{batch_id}] 继续批次")
+    job_queue.notify()
+    return jsonify({'success': True, 'status': 'running'})
+
+@app.route('/api/batch/<batch_id>/cancel', methods=['POST'])
+@login_required
+def cancel_batch(batch_id):
+    """取消批次：未开始的任务直接取消，执行中的任务在两张图片之间停止"""
+    progress, error = _own_batch_job(batch_id)
+    if error:
+        return error
+    cancelled = database.cancel_batch_job(batch_id)
+    if cancelled is None:
+        return jsonify({'success': False, 'error': f"批次当前状态为 {progress['status']}，无法取消"}), 409
+    append_batch_log(batch_id, f"批次已取消，{cancelled} 个未开始的任务不再执行", 'error', close=True)
+    app_logger.info(f"[用户:{session.get('username', 'unknown')}] [批次:{batch_id}] 取消批次，未开始的任务: {cancelled}")
+    return jsonify({'success': True, 'status': 'cancelled', 'cancelled_tasks': cancelled})
 
 @app.route('/output/<int:user_id>/<filename>')
 @login_required
@@ -1668,8 +3195,8 @@ def analyze_script():
         
         app_logger.info(f"[用户:{username}] API配置 - Base URL: {base_url}, Model: {model}")
         
-        # 初始化 OpenAI 兼容客户端
-        client = OpenAI(api_key=api_key, base_url=base_url)
+        # 获取共享的 OpenAI 兼容客户端（复用连接池）
+        client = ark_clients.get_ark_client(api_key, base_url)
         
         # 构建分析提示词
         analysis_prompt = f"""假如你是一位知名导演，现需要拍摄一部极具吸引力的短片，具体要求如下：
@@ -1859,7 +3386,22 @@ def analyze_script():
             'error': f'分析失败: {str(e)}'
         }), 500
 
+def init_app():
+    """
+    进程启动时调用一次（重复调用无影响）：读取会话密钥，启动批量任务队列（上次进程退出时未完成的任务会被重新领取）
+    
+    不在导入时执行，导入 web_app（脚本、测试、debug 模式下重载器的监控进程）不会启动工作线程或写入密钥文件。
+    python web_app.py 启动时自动调用；gunicorn 在 gunicorn.conf.py 的 post_worker_init 中调用，其他 WSGI 服务器需在入口中调用。
+    """
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = state_store.load_secret_key()
+    return job_queue.start(run_batch_task, record_batch_task_result, BATCH_QUEUE_WORKERS, recover_batch_import)
+
 if __name__ == '__main__':
+    debug = True
+    # debug 模式下重载器的监控进程（没有 WERKZEUG_RUN_MAIN）只负责重启子进程，不处理请求，不启动工作线程
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_app()
     print("启动 Web 应用...")
     print(f"访问地址: http://localhost:5050")
-    app.run(debug=True, host='0.0.0.0', port=5050)
+    app.run(debug=debug, host='0.0.0.0', port=5050)